@@ -1,36 +1,15 @@
-"""Script Auto restarter"""
+"""Script Auto restarter
+
+Kept for the restarter scripts, same as `python -m ecorcon watchdog`.
+Works from a source checkout with the system python, the watchdog only
+needs the standard library.
+"""
 
-from configparser import ConfigParser
-import logging
 import os
-from pathlib import Path
-import subprocess
-from subprocess import Popen
 import sys
-from time import sleep
 
-logger: logging.Logger = logging.getLogger(__name__)
+sys.path.insert(0, os.path.join(os.getcwd(), "src"))
+
+from ecorcon.watchdog import main
 
-while True:
-  method: str = "venv"
-  path: Path = Path.cwd()
-  try:
-    config: ConfigParser = ConfigParser()
-    # ~ config.read(os.path.join(path.parents[0], "instance", "config.ini"))
-    config.read(os.path.join("instance", "config.ini"))
-    method = config["script"]["method"]
-  except Exception as e:
-    logger.exception(e)
-    logger.warning("""Couldn't read configuration file. Please make \
-sure instance/config.ini exists. Use example.config.ini""")
-  try:
-    proc: Popen = Popen(
-      os.path.join(path, "scripts", f"start-{method}.bat"),
-      # ~ cwd = path.parents[0],
-      cwd = path,
-      creationflags = subprocess.CREATE_NEW_PROCESS_GROUP,
-    )
-    proc.communicate()
-  except Exception as e:
-    logger.exception(e)
-  sleep(1e-15)
+main()
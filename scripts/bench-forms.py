@@ -0,0 +1,75 @@
+"""Form construction microbenchmark
+
+Compares building a FlaskForm subclass inside the request handler, the
+way the web pages used to, with instantiating the module level form
+classes of ecorcon.web. Run from the repository root:
+
+  python scripts/bench-forms.py [iterations]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.getcwd(), "src"))
+
+## ecorcon.web has to come first, it patches flask for quart
+from ecorcon.web import (
+  app,
+  get_server_choices,
+  server_action_map,
+  server_actions,
+  ServerActionForm,
+  storage,
+)
+from flask_wtf import FlaskForm
+from wtforms import RadioField, SubmitField, validators
+
+def per_request_form() -> FlaskForm:
+  """Old style, a new class for every request"""
+  class ServerForm(FlaskForm):
+    """Form for server and action selection"""
+    server_field: RadioField = RadioField(
+      "Select Eco Server",
+      [validators.DataRequired()],
+      choices = [("0", "None")],
+    )
+    action_field: RadioField = RadioField(
+      "Select Action",
+      [validators.DataRequired()],
+      choices = [("0", "None")],
+    )
+    submit: SubmitField = SubmitField("Send")
+  form: FlaskForm = ServerForm(formdata = None)
+  form.server_field.choices = [(str(index), server) for index, server \
+    in enumerate(storage.names("servers"))]
+  form.action_field.choices = [(k, server_actions[v][0]) for k, v in \
+    sorted(server_action_map.items())]
+  return form
+
+def module_form() -> FlaskForm:
+  """New style, module level class"""
+  form: FlaskForm = ServerActionForm(formdata = None)
+  form.server_field.choices = get_server_choices()
+  return form
+
+def measure(function, iterations: int) -> float:
+  """Microseconds per call"""
+  function()
+  start: float = time.perf_counter()
+  for _ in range(iterations):
+    function()
+  return (time.perf_counter() - start) / iterations * 1e6
+
+async def main(iterations: int) -> None:
+  """Run both inside a request context, forms need one for CSRF"""
+  async with app.test_request_context("/server", method = "GET"):
+    for label, function in [
+      ("class per request", per_request_form),
+      ("module level class", module_form),
+    ]:
+      print(f"{label:>20}: {measure(function, iterations):8.1f} us")
+
+if __name__ == "__main__":
+  asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
@@ -45,8 +45,22 @@ __all__: list = [
   __name__,
   __version__,
   __description__,
+  'api',
+  'auth',
+  'catalog',
+  'client',
+  'console',
+  'events',
+  'jobs',
+  'logs',
   'manager',
+  'metrics',
+  'monitor',
+  'pool',
   'rcon',
+  'scheduler',
+  'supervisor',
+  'watchdog',
   'web',
 ]
 
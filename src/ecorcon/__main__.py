@@ -24,49 +24,69 @@ from configparser import ConfigParser
 import logging
 import os
 import sys
-import uvicorn
-from .web import app
 from . import name
 
 logger = logging.getLogger(name)
 
-try:
-  if (len(sys.argv) > 1 and sys.argv[1] in \
-    ["testing", "stage", "staging"]) or \
-    os.environ.get("ENV", None) in \
-    ["staging", "testing"]\
-  :
-    app.run()
-  else:
-    config: ConfigParser = ConfigParser()
-    config_file: str = os.path.join("instance", "config.ini")
-    if not os.path.exists(config_file):
-      logger.warning("""Could not find configuration file, please \
+def main(*args, **kwargs) -> None:
+  """Command line entry point. `ecorcon watchdog` keeps the web server \
+running, `ecorcon migrate [database]` copies ini users and servers to \
+sqlite, anything else runs the web server"""
+  if len(sys.argv) > 1 and sys.argv[1] == "watchdog":
+    from .watchdog import main as watchdog
+    watchdog()
+    return
+  if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+    ## Copy ini users and servers into the sqlite database
+    from .config import database_file, IniStorage, migrate, SQLiteStorage
+    target: SQLiteStorage = SQLiteStorage(sys.argv[2] if \
+      len(sys.argv) > 2 else database_file)
+    logger.info(f"Added records: {migrate(IniStorage(), target)}")
+    target.close()
+    return
+  ## Only the web server needs quart and friends
+  import uvicorn
+  from .web import app
+  try:
+    if (len(sys.argv) > 1 and sys.argv[1] in \
+      ["testing", "stage", "staging"]) or \
+      os.environ.get("ENV", None) in \
+      ["staging", "testing"]\
+    :
+      app.run()
+    else:
+      config: ConfigParser = ConfigParser()
+      config_file: str = os.path.join("instance", "config.ini")
+      if not os.path.exists(config_file):
+        logger.warning("""Could not find configuration file, please \
 create directory `instance` and copy example.config.ini to config.ini\
 """)
-      config_file = "example.config.ini"
-    config.read(config_file)
-    try:
-      uvicorn.run(
-        app,
-        uds = config["uvicorn"].get("socket"),
-        forwarded_allow_ips = '*',
-        proxy_headers = True,
-        timeout_keep_alive = 0,
-        log_level = "info",
-      )
-    except (OSError, NotImplementedError,
-      asyncio.exceptions.CancelledError):
-      logger.info("""Operational system can't handle UNIX sockets, \
+        config_file = "example.config.ini"
+      config.read(config_file)
+      try:
+        uvicorn.run(
+          app,
+          uds = config["uvicorn"].get("socket"),
+          forwarded_allow_ips = '*',
+          proxy_headers = True,
+          timeout_keep_alive = 0,
+          log_level = "info",
+        )
+      except (OSError, NotImplementedError,
+        asyncio.exceptions.CancelledError):
+        logger.info("""Operational system can't handle UNIX sockets, \
 using TCP/IP (Hint: You're most likely using Windows)...""")
-      uvicorn.run(
-        app,
-        host = config["uvicorn"].get("host"),
-        port = int(config["uvicorn"].get("port")),
-        forwarded_allow_ips = '*',
-        proxy_headers = True,
-        timeout_keep_alive = 0,
-        log_level = "info",
-      )
-except Exception as e:
-  logger.exception(e)
+        uvicorn.run(
+          app,
+          host = config["uvicorn"].get("host"),
+          port = int(config["uvicorn"].get("port")),
+          forwarded_allow_ips = '*',
+          proxy_headers = True,
+          timeout_keep_alive = 0,
+          log_level = "info",
+        )
+  except Exception as e:
+    logger.exception(e)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,410 @@
+"""JSON API for automation
+
+Same actions as the web pages without forms or templates. Every
+response is a JSON object with at least `status` and `exception`.
+"""
+
+from quart import (
+  Blueprint,
+  jsonify,
+  make_response,
+  request,
+  url_for,
+)
+
+import asyncio
+from asyncio.subprocess import Process
+import logging
+import re
+import time
+from typing import AsyncIterator
+from .catalog import catalog
+from .console import ConsoleBuffer, consoles
+from .events import event_log, parse_time
+from .jobs import Job, jobs
+from .logs import log_viewer
+from .manager import (
+  is_alive,
+  sampler,
+  server_action,
+  server_actions,
+  server_state,
+  servers,
+  supervisor,
+)
+from .rcon import rcon_broadcast, rcon_send
+from .scheduler import delete_schedule, edit_schedule, scheduler
+from .script import (
+  update_git,
+  update_pipenv,
+  update_reinstall,
+  update_restart,
+  update_venv,
+)
+from .system import (
+  reboot_hard,
+  reboot_soft,
+)
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+api: Blueprint = Blueprint("api", __name__, url_prefix = "/api/v1")
+
+script_actions: dict = {
+  "venv": update_venv,
+  "pipenv": update_pipenv,
+  "git": update_git,
+  "reinstall": update_reinstall,
+  "restart": update_restart,
+}
+system_actions: dict = {
+  "reboot": reboot_soft,
+  "force_reboot": reboot_hard,
+}
+
+def error(message: str, code: int = 400) -> tuple:
+  """Error response"""
+  return (jsonify({"status": False, "exception": message}), code)
+
+def flag(value: str | None) -> bool:
+  """Query or form value as bool, true for 1, true, yes and on"""
+  return str(value).strip().lower() in ["1", "true", "yes", "on"]
+
+def to_json(_return: dict) -> dict:
+  """Action result without the process object, exception as text"""
+  return {
+    "status": _return.get("status", False),
+    "message": _return.get("message"),
+    "exception": repr(_return["exception"]) if \
+      _return.get("exception") is not None else None,
+  }
+
+def describe(server_name: str) -> dict:
+  """Current state of a managed server"""
+  process: Process | None = servers.get(server_name)
+  series = sampler.series.get(server_name)
+  return {
+    "running": is_alive(server_name),
+    "state": server_state(server_name),
+    "pid": getattr(process, "pid", None),
+    "returncode": getattr(process, "returncode", None),
+    "desired": supervisor.desired.get(server_name),
+    "metrics": series.latest() if series is not None else None,
+  }
+
+async def get_payload() -> dict:
+  """JSON body, or form fields"""
+  payload: dict | None = await request.get_json(silent = True)
+  if payload is None:
+    payload = (await request.form).to_dict()
+  return payload
+
+@api.route("/servers")
+# ~ @login_required
+async def list_servers() -> dict:
+  """Every managed server"""
+  return jsonify({
+    "status": True,
+    "exception": None,
+    "servers": {server_name: describe(server_name) for server_name in \
+      servers},
+  })
+
+@api.route("/servers/<server_name>")
+# ~ @login_required
+async def get_server(server_name: str) -> dict:
+  """One managed server"""
+  if server_name not in servers:
+    return error(f"Unknown server {server_name}", 404)
+  return jsonify({"status": True, "exception": None,
+    "server": describe(server_name)})
+
+@api.route("/servers/<server_name>/<action>", methods = ['POST'])
+# ~ @login_required
+async def post_server_action(server_name: str, action: str) -> dict:
+  """Run one of `server_actions` on a server"""
+  if server_name not in servers:
+    return error(f"Unknown server {server_name}", 404)
+  if action not in server_actions:
+    return error(f"""Unknown action {action}, use one of \
+{', '.join(server_actions)}""", 404)
+  try:
+    _return: dict = to_json(await server_action(server_name, action))
+  except Exception as e:
+    logger.exception(e)
+    return error(repr(e), 500)
+  _return["server"] = describe(server_name)
+  return jsonify(_return)
+
+@api.route("/servers/<server_name>/console")
+# ~ @login_required
+async def get_server_console(server_name: str) -> dict:
+  """Last `lines` lines of server output, none before its first start"""
+  if server_name not in servers:
+    return error(f"Unknown server {server_name}", 404)
+  buffer: ConsoleBuffer | None = consoles.get(server_name)
+  return jsonify({
+    "status": True,
+    "exception": None,
+    "sequence": buffer.sequence if buffer is not None else 0,
+    "lines": buffer.tail(request.args.get("lines", 100, type = int)) \
+      if buffer is not None else [],
+  })
+
+@api.route("/servers/<server_name>/history")
+# ~ @login_required
+async def get_server_history(server_name: str) -> dict:
+  """Crash and automatic restart events"""
+  return jsonify({"status": True, "exception": None,
+    "history": list(supervisor.history.get(server_name, []))})
+
+@api.route("/servers/<server_name>/events")
+# ~ @login_required
+async def get_server_events(server_name: str) -> dict:
+  """Newest `limit` events, optionally of one `kind` or `player` and \
+`before` a time (seconds since the epoch or ISO)"""
+  try:
+    _events: list[dict] = await event_log.recent(
+      server = server_name,
+      kind = request.args.get("kind") or None,
+      player = request.args.get("player") or None,
+      before = parse_time(request.args.get("before")),
+      limit = request.args.get("limit", 100, type = int),
+    )
+  except ValueError as e:
+    return error(repr(e))
+  return jsonify({"status": True, "exception": None, "events": _events})
+
+@api.route("/servers/<server_name>/online")
+# ~ @login_required
+async def get_server_online(server_name: str) -> dict:
+  """Players online `at` a time, now by default"""
+  try:
+    at: float = parse_time(request.args.get("at")) or time.time()
+  except ValueError as e:
+    return error(repr(e))
+  return jsonify({"status": True, "exception": None, "at": at,
+    "players": await event_log.online(server_name, at)})
+
+@api.route("/servers/<server_name>/logs")
+# ~ @login_required
+async def list_server_logs(server_name: str) -> dict:
+  """Log files next to the server binary, newest first"""
+  try:
+    files: list[dict] = await asyncio.to_thread(log_viewer.files,
+      server_name)
+  except KeyError:
+    return error(f"Unknown server {server_name}", 404)
+  return jsonify({"status": True, "exception": None, "files": files})
+
+@api.route("/servers/<server_name>/logs/<path:file_name>")
+# ~ @login_required
+async def get_server_log(server_name: str, file_name: str) -> dict:
+  """`count` lines from line `start` (negative counts from the end, \
+the last lines by default). With `q`, the lines matching it from \
+`start` on, as a `regex` and ignoring case if asked"""
+  count: int = request.args.get("count", 100, type = int)
+  try:
+    if request.args.get("q"):
+      _return: dict = await log_viewer.search(server_name, file_name,
+        request.args["q"],
+        regex = flag(request.args.get("regex")),
+        start = request.args.get("start", 0, type = int),
+        limit = count,
+        ignore_case = flag(request.args.get("ignore_case")),
+      )
+    else:
+      _return = await log_viewer.read(server_name, file_name,
+        request.args.get("start", None, type = int), count)
+  except KeyError:
+    return error(f"Unknown log {file_name} of {server_name}", 404)
+  except re.error as e:
+    return error(repr(e))
+  return jsonify({"status": True, "exception": None, **_return})
+
+@api.route("/metrics")
+# ~ @login_required
+async def get_metrics() -> dict:
+  """Sampled resource usage, only the `last` samples if given"""
+  return jsonify({"status": True, "exception": None,
+    **sampler.to_dict(request.args.get("last", None, type = int))})
+
+@api.route("/rcon", methods = ['POST'])
+# ~ @login_required
+async def post_rcon() -> dict:
+  """Send `command`, or a list of commands pipelined, to `server` \
+(default is the [rcon] section of config.ini)"""
+  try:
+    payload: dict = await get_payload()
+    command: str | list[str] | None = payload.get("command")
+    if not command:
+      return error("Missing command")
+    server_name: str | None = payload.get("server")
+    timeout: float | None = None
+    if payload.get("timeout") not in [None, ""]:
+      try:
+        timeout = float(payload["timeout"])
+      except (TypeError, ValueError):
+        return error(f"Invalid timeout {payload['timeout']!r}")
+    status, response = await rcon_send(command, server_name = None if \
+      server_name in [None, "", "default"] else server_name,
+      timeout = timeout, cache = payload.get("cache",
+      True) not in [False, "0", "false", "no"])
+  except Exception as e:
+    logger.exception(e)
+    return error(repr(e), 500)
+  return jsonify({"status": status, "exception": None if status else \
+    response, "response": response if status else None})
+
+@api.route("/rcon/commands")
+# ~ @login_required
+async def get_rcon_catalog() -> dict:
+  """Command tree of `server` from the cache, or fresh from the server \
+with `refresh`"""
+  server_name: str | None = request.args.get("server")
+  if server_name in ["", "default"]:
+    server_name = None
+  try:
+    commands: list = await catalog.refresh(server_name) if \
+      request.args.get("refresh") else catalog.get(server_name)
+  except Exception as e:
+    logger.exception(e)
+    return error(repr(e), 502)
+  return jsonify({"status": True, "exception": None,
+    "commands": [command.to_dict() for command in commands]})
+
+@api.route("/rcon/broadcast", methods = ['POST'])
+# ~ @login_required
+async def post_rcon_broadcast() -> dict:
+  """Send `command` to every server, or to the `servers` listed"""
+  try:
+    payload: dict = await get_payload()
+    command: str | list[str] | None = payload.get("command")
+    if not command:
+      return error("Missing command")
+    server_names: list[str] | str | None = payload.get("servers")
+    if isinstance(server_names, str):
+      server_names = [server.strip() for server in \
+        server_names.split(",") if server.strip()]
+    results: dict = await rcon_broadcast(command, server_names or None)
+  except Exception as e:
+    logger.exception(e)
+    return error(repr(e), 500)
+  return jsonify({
+    "status": all(result[0] for result in results.values()),
+    "exception": None,
+    "results": {server_name: {"status": result[0],
+      "response": result[1]} for server_name, result in results.items()},
+  })
+
+def submitted(job: Job) -> tuple:
+  """Response for a queued job, poll its url for the result"""
+  return (jsonify({"status": True, "exception": None,
+    "job": job.to_dict()}), 202, {"Location": url_for("api.get_job",
+    job_id = job.id)})
+
+@api.route("/system/<action>", methods = ['POST'])
+# ~ @login_required
+async def post_system(action: str) -> dict:
+  """Reboot the operational system, as a background job"""
+  if action not in system_actions:
+    return error(f"""Unknown action {action}, use one of \
+{', '.join(system_actions)}""", 404)
+  return submitted(jobs.submit(f"system {action}",
+    system_actions[action], stream = True))
+
+@api.route("/script/<action>", methods = ['POST'])
+# ~ @login_required
+async def post_script(action: str) -> dict:
+  """Update this program as a background job, or restart it"""
+  if action not in script_actions:
+    return error(f"""Unknown action {action}, use one of \
+{', '.join(script_actions)}""", 404)
+  if action == "restart":
+    ## Exits right away, there is no job to wait for
+    await update_restart()
+  else:
+    return submitted(jobs.submit(f"script {action}",
+      script_actions[action], stream = True))
+
+@api.route("/schedules")
+# ~ @login_required
+async def list_schedules() -> dict:
+  """Schedules with their next and last run times, and recent events"""
+  return jsonify({"status": True, "exception": None,
+    "schedules": scheduler.to_list(), "history": list(scheduler.history)})
+
+@api.route("/schedules/<schedule_name>", methods = ['PUT'])
+# ~ @login_required
+async def put_schedule(schedule_name: str) -> dict:
+  """Create or replace a schedule, the payload holds its options"""
+  _return: dict = to_json(await edit_schedule(schedule_name,
+    await get_payload()))
+  return (jsonify(_return), 200 if _return["status"] else 400)
+
+@api.route("/schedules/<schedule_name>", methods = ['DELETE'])
+# ~ @login_required
+async def remove_schedule(schedule_name: str) -> dict:
+  """Delete a schedule"""
+  return jsonify(to_json(await delete_schedule(schedule_name)))
+
+@api.route("/schedules/<schedule_name>/run", methods = ['POST'])
+# ~ @login_required
+async def run_schedule(schedule_name: str) -> dict:
+  """Run a schedule now, as a background job"""
+  if schedule_name not in scheduler.schedules:
+    return error(f"Unknown schedule {schedule_name}", 404)
+  return submitted(scheduler.run_now(schedule_name))
+
+@api.route("/jobs")
+# ~ @login_required
+async def list_jobs() -> dict:
+  """Known jobs, newest first"""
+  return jsonify({"status": True, "exception": None,
+    "jobs": jobs.to_list()})
+
+@api.route("/jobs/<job_id>")
+# ~ @login_required
+async def get_job(job_id: str) -> dict:
+  """Job status and result. With `wait` seconds, answers as soon as the \
+job finishes or the time is up"""
+  job: Job | None = jobs.get(job_id)
+  if job is None:
+    return error(f"Unknown job {job_id}", 404)
+  wait: float | None = request.args.get("wait", None, type = float)
+  if wait:
+    await job.wait(min(wait, 60.0))
+  return jsonify({"status": True, "exception": None,
+    "job": job.to_dict()})
+
+@api.route("/jobs/<job_id>/cancel", methods = ['POST'])
+# ~ @login_required
+async def cancel_job(job_id: str) -> dict:
+  """Cancel queued or running job"""
+  job: Job | None = jobs.get(job_id)
+  if job is None:
+    return error(f"Unknown job {job_id}", 404)
+  cancelled: bool = jobs.cancel(job_id)
+  return jsonify({"status": cancelled, "exception": None if cancelled \
+    else f"Job {job_id} is already {job.state}", "job": job.to_dict()})
+
+@api.route("/jobs/<job_id>/output")
+# ~ @login_required
+async def get_job_output(job_id: str):
+  """Job output as chunked plain text, line by line while the job runs, \
+ending with the final state"""
+  job: Job | None = jobs.get(job_id)
+  if job is None:
+    return error(f"Unknown job {job_id}", 404)
+  async def generate() -> AsyncIterator[bytes]:
+    """Response body"""
+    async for lines, dropped in job.follow():
+      if dropped:
+        lines.insert(0, f"### {dropped} lines skipped")
+      yield ("\n".join(lines) + "\n").encode("utf8")
+    yield f"### job {job.id} {job.state}\n".encode("utf8")
+  response = await make_response(generate(), 200,
+    {"Content-Type": "text/plain; charset=utf-8"})
+  ## Updates take minutes
+  response.timeout = None
+  return response
@@ -0,0 +1,100 @@
+"""Password hashing off the event loop"""
+
+import asyncio
+from argon2 import PasswordHasher
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+import logging
+from typing import Callable
+from .config import config_file, store
+from .metrics import counter, gauge, histogram, registry
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+argon2_seconds = histogram("ecorcon_argon2_seconds",
+  "Password hash or verify time, queue wait included", ("operation",))
+argon2_pending = gauge("ecorcon_argon2_pending",
+  "Password operations running or waiting")
+argon2_rejected = counter("ecorcon_argon2_rejected_total",
+  "Password operations refused because the queue was full")
+
+class HasherBusy(Exception):
+  """Too many hash operations already waiting"""
+
+class Hasher:
+  """argon2 in a dedicated, size limited thread pool. argon2-cffi \
+releases the GIL, so workers really run in parallel with the event \
+loop"""
+  def __init__(
+    self,
+    workers: int = 2,
+    queue: int = 16,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.hasher: PasswordHasher = PasswordHasher(*args, **kwargs)
+    self.workers: int = max(1, workers)
+    self.queue: int = max(0, queue)
+    self.pending: int = 0
+    self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+      max_workers = self.workers,
+      thread_name_prefix = "argon2",
+    )
+
+  async def run(self, function: Callable, *args) -> str | bool:
+    """Run `function` in the pool, refusing work past queue depth"""
+    if self.pending >= self.workers + self.queue:
+      argon2_rejected.inc()
+      raise HasherBusy("""Too many password operations in progress, \
+try again later""")
+    self.pending += 1
+    try:
+      return await asyncio.get_running_loop().run_in_executor(
+        self.executor, function, *args)
+    finally:
+      self.pending -= 1
+
+  async def hash(self, password: str) -> str:
+    """Hash password"""
+    with argon2_seconds.time(operation = "hash"):
+      return await self.run(self.hasher.hash, password)
+
+  async def verify(self, _hash: str, password: str) -> bool:
+    """Verify password, raises argon2.exceptions.VerifyMismatchError \
+like PasswordHasher.verify"""
+    with argon2_seconds.time(operation = "verify"):
+      return await self.run(self.hasher.verify, _hash, password)
+
+  def check_needs_rehash(self, _hash: str) -> bool:
+    """Whether hash was made with other parameters, cheap"""
+    return self.hasher.check_needs_rehash(_hash)
+
+  def close(self) -> None:
+    """Stop worker threads"""
+    self.executor.shutdown(wait = False, cancel_futures = True)
+
+def get_hasher(*args, **kwargs) -> Hasher:
+  """Hasher configured from the [argon2] section of config file"""
+  defaults: PasswordHasher = PasswordHasher()
+  try:
+    config: ConfigParser = store.get(config_file)
+    return Hasher(
+      workers = config.getint("argon2", "workers", fallback = 2),
+      queue = config.getint("argon2", "queue", fallback = 16),
+      time_cost = config.getint("argon2", "time_cost",
+        fallback = defaults.time_cost),
+      memory_cost = config.getint("argon2", "memory_cost",
+        fallback = defaults.memory_cost),
+      parallelism = config.getint("argon2", "parallelism",
+        fallback = defaults.parallelism),
+    )
+  except Exception as e:
+    logger.exception(e)
+  return Hasher()
+
+hasher: Hasher = get_hasher()
+
+@registry.collector
+def collect_hasher() -> None:
+  """Refresh pending operations gauge"""
+  argon2_pending.set(hasher.pending)
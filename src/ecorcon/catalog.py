@@ -0,0 +1,210 @@
+"""RCON command catalog discovered from the Eco server help"""
+
+import asyncio
+from configparser import ConfigParser
+import logging
+import re
+import time
+from typing import Iterator
+from .config import config_file, store
+from .metrics import counter
+from .rcon import rcon_commands, rcon_send
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+catalog_refreshes = counter("ecorcon_rcon_catalog_refreshes_total",
+  "RCON command catalog refreshes", ("server", "result"))
+
+## Eco formats chat and console text with rich text tags
+tag_pattern: re.Pattern = re.compile(r"<[^>]+>")
+## /command sub (/alias, /other) -- description
+line_pattern: re.Pattern = re.compile(
+  r"^(?P<indent>\s*)(?P<name>/?[\w?][\w ?-]*?)\s*"
+  r"(?:\((?P<aliases>[^)]*)\))?\s*--\s*(?P<description>.*)$")
+
+class Command:
+  """One command and its subcommands"""
+  def __init__(self, path: tuple[str, ...], *args, **kwargs) -> None:
+    self.path: tuple[str, ...] = path
+    self.description: str = ""
+    self.aliases: list[str] = []
+    self.category: str | None = None
+    self.subcommands: dict[str, "Command"] = {}
+
+  @property
+  def command(self) -> str:
+    """Text to send"""
+    return "/" + " ".join(self.path)
+
+  def walk(self) -> Iterator["Command"]:
+    """This command then every subcommand, depth first"""
+    yield self
+    for subcommand in self.subcommands.values():
+      yield from subcommand.walk()
+
+  def to_dict(self) -> dict:
+    """JSON friendly"""
+    return {
+      "command": self.command,
+      "description": self.description,
+      "aliases": self.aliases,
+      "category": self.category,
+      "subcommands": [subcommand.to_dict() for subcommand in \
+        self.subcommands.values()],
+    }
+
+def parse_help(text: str) -> list[Command]:
+  """Command tree from /help or /helpful output. Lines ending with a \
+colon start a category, indented lines without a slash are subcommands \
+of the last top level command"""
+  roots: dict[str, Command] = {}
+  category: str | None = None
+  parent: Command | None = None
+  for line in tag_pattern.sub("", text).splitlines():
+    if not line.strip():
+      continue
+    match: re.Match | None = line_pattern.match(line)
+    if match is None:
+      if line.strip().endswith(":"):
+        category = line.strip()[:-1].strip()
+      continue
+    words: tuple[str, ...] = tuple(match["name"].lstrip("/").split())
+    if not words:
+      continue
+    if match["indent"] and not match["name"].startswith("/") and \
+      parent is not None:
+      words = parent.path + words
+    node: Command | None = None
+    children: dict[str, Command] = roots
+    for depth in range(len(words)):
+      if words[depth] not in children:
+        children[words[depth]] = Command(words[:depth + 1])
+        children[words[depth]].category = category
+      node = children[words[depth]]
+      children = node.subcommands
+    node.description = match["description"].strip()
+    if match["aliases"]:
+      node.aliases = [alias.strip() for alias in \
+        match["aliases"].split(",") if alias.strip()]
+    if len(words) == 1:
+      parent = node
+  return list(roots.values())
+
+def fallback() -> list[Command]:
+  """Built in list, used until the server answers"""
+  return parse_help("\n".join(description for command, description in \
+    rcon_commands if command))
+
+class Catalog:
+  """Parsed command tree per server. Entries older than `ttl` seconds \
+are still served while a refresh runs in the background, so pages never \
+wait for /help"""
+  def __init__(
+    self,
+    ttl: float = 600.0,
+    commands: tuple[str, ...] = ("/helpful", "/help"),
+    *args,
+    **kwargs,
+  ) -> None:
+    self.ttl: float = ttl
+    self.commands: tuple[str, ...] = commands
+    ## server -> (monotonic time fetched, commands)
+    self.entries: dict[str, tuple[float, list[Command]]] = {}
+    self.refreshing: dict[str, asyncio.Task] = {}
+
+  def key(self, server_name: str | None) -> str:
+    """Cache key, None is the [rcon] section"""
+    return server_name or "default"
+
+  async def fetch(self, server_name: str | None) -> list[Command]:
+    """Ask the server, first help command that parses wins"""
+    for command in self.commands:
+      status, response = await rcon_send(command, cache = False,
+        server_name = server_name)
+      if not status:
+        raise ConnectionError(response)
+      commands: list[Command] = parse_help(response)
+      if commands:
+        return commands
+    raise ValueError(f"""No commands found in the output of \
+{', '.join(self.commands)}""")
+
+  async def refresh(self, server_name: str | None) -> list[Command]:
+    """Fetch again now, concurrent callers share one fetch"""
+    key: str = self.key(server_name)
+    task: asyncio.Task | None = self.refreshing.get(key)
+    if task is None or task.done():
+      task = asyncio.create_task(self.update(server_name))
+      self.refreshing[key] = task
+    return await asyncio.shield(task)
+
+  async def update(self, server_name: str | None) -> list[Command]:
+    """Fetch and store"""
+    key: str = self.key(server_name)
+    try:
+      commands: list[Command] = await self.fetch(server_name)
+      self.entries[key] = (time.monotonic(), commands)
+      catalog_refreshes.inc(server = key, result = "ok")
+      return commands
+    except Exception as e:
+      logger.warning(f"Could not refresh commands of {key}: {repr(e)}")
+      catalog_refreshes.inc(server = key, result = "error")
+      ## Keep serving what we had, try again after another ttl
+      previous: list[Command] = self.entries.get(key, (0.0,
+        fallback()))[1]
+      self.entries[key] = (time.monotonic(), previous)
+      raise
+    finally:
+      self.refreshing.pop(key, None)
+
+  def get(self, server_name: str | None = None) -> list[Command]:
+    """Cached commands, never waits. Starts a background refresh when \
+missing or stale"""
+    key: str = self.key(server_name)
+    entry: tuple[float, list[Command]] | None = self.entries.get(key)
+    if entry is None or time.monotonic() - entry[0] > self.ttl:
+      if key not in self.refreshing:
+        self.refreshing[key] = asyncio.create_task(self.update(
+          server_name))
+        ## Errors are logged by update
+        self.refreshing[key].add_done_callback(lambda task: \
+          task.cancelled() or task.exception())
+    return entry[1] if entry is not None else fallback()
+
+  def choices(self, server_name: str | None = None) -> list[tuple]:
+    """(command, label) of every command and subcommand, for forms"""
+    return [(command.command, f"""{command.command} -- \
+{command.description}""") for root in self.get(server_name) for \
+      command in root.walk()]
+
+  async def run(self, interval: float = 60.0) -> None:
+    """Background task refreshing known servers before they get stale"""
+    while True:
+      await asyncio.sleep(interval)
+      for key, (fetched, _) in list(self.entries.items()):
+        if time.monotonic() - fetched > self.ttl - interval:
+          try:
+            await self.refresh(None if key == "default" else key)
+          except Exception:
+            pass
+
+def get_catalog(*args, **kwargs) -> Catalog:
+  """Catalog configured by the [rcon] section of config.ini"""
+  try:
+    config: ConfigParser = store.get(config_file)
+    return Catalog(
+      ttl = config.getfloat("rcon", "catalog_ttl", fallback = 600.0),
+      commands = tuple(command.strip() for command in config.get("rcon",
+        "catalog_commands", fallback = "/helpful, /help").split(",") \
+        if command.strip()),
+    )
+  except Exception as e:
+    logger.exception(e)
+  return Catalog()
+
+catalog: Catalog = get_catalog()
+
+async def get_rcon_commands(*args, server_name: str | None = None,
+  **kwargs) -> tuple[bool, list[tuple]]:
+  """Get RCON Commands, the empty command first"""
+  return (True, rcon_commands[:1] + catalog.choices(server_name))
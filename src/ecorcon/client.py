@@ -0,0 +1,251 @@
+"""Asyncio RCON client
+
+Source RCON protocol as used by Eco, see
+https://developer.valvesoftware.com/wiki/Source_RCON_Protocol
+"""
+
+import asyncio
+import codecs
+import itertools
+import logging
+import struct
+from typing import AsyncIterator
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+SERVERDATA_AUTH: int = 3
+SERVERDATA_AUTH_RESPONSE: int = 2
+SERVERDATA_EXECCOMMAND: int = 2
+SERVERDATA_RESPONSE_VALUE: int = 0
+
+## Servers split responses bigger than this in several packets
+FRAGMENT_SIZE: int = 4096
+## How long to wait for the next fragment of a full sized packet
+FRAGMENT_TIMEOUT: float = 0.05
+
+class RCONException(Exception):
+  """Generic RCON failure"""
+
+class RCONAuthenticationError(RCONException):
+  """Server refused the RCON password"""
+
+def encode_packet(request_id: int, _type: int, body: str) -> bytes:
+  """Frame a Source RCON packet"""
+  payload: bytes = struct.pack("<ii", request_id, _type) + \
+    body.encode("utf8") + b"\x00\x00"
+  return struct.pack("<i", len(payload)) + payload
+
+class RCONClient:
+  """One authenticated RCON session over asyncio streams"""
+  def __init__(
+    self,
+    host: str,
+    password: str,
+    port: int = 3002,
+    timeout: float = 10.0,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.host: str = host
+    self.password: str = password
+    self.port: int = port
+    self.timeout: float = timeout
+    self.reader: asyncio.StreamReader | None = None
+    self.writer: asyncio.StreamWriter | None = None
+    self.lock: asyncio.Lock = asyncio.Lock()
+    self.ids: itertools.count = itertools.count(1)
+
+  def __repr__(self) -> str:
+    return f"<RCONClient {self.host}:{self.port}>"
+
+  async def __aenter__(self) -> "RCONClient":
+    await self.connect()
+    return self
+
+  async def __aexit__(self, *args, **kwargs) -> None:
+    await self.disconnect()
+
+  @property
+  def connected(self) -> bool:
+    """True while the underlying connection looks usable"""
+    return self.writer is not None and \
+      not self.writer.is_closing() and \
+      not self.reader.at_eof()
+
+  def next_id(self) -> int:
+    """Request IDs are positive 32 bit integers, -1 means auth failure"""
+    request_id: int = next(self.ids)
+    if request_id >= 2**31 - 1:
+      self.ids = itertools.count(1)
+      request_id = next(self.ids)
+    return request_id
+
+  async def connect(self, timeout: float | None = None) -> None:
+    """Open the TCP connection and authenticate"""
+    timeout = timeout or self.timeout
+    try:
+      async with asyncio.timeout(timeout):
+        self.reader, self.writer = await asyncio.open_connection(
+          self.host, self.port)
+        await self.authenticate()
+    except BaseException:
+      await self.disconnect()
+      raise
+
+  async def authenticate(self) -> None:
+    """Send SERVERDATA_AUTH and wait for SERVERDATA_AUTH_RESPONSE"""
+    request_id: int = self.next_id()
+    self.writer.write(encode_packet(request_id, SERVERDATA_AUTH,
+      self.password))
+    await self.writer.drain()
+    while True:
+      ## Servers usually send an empty SERVERDATA_RESPONSE_VALUE first
+      in_id, in_type, _ = await self.read_packet()
+      if in_type == SERVERDATA_AUTH_RESPONSE:
+        if in_id == -1:
+          raise RCONAuthenticationError(f"""Login failed for \
+{self.host}:{self.port}""")
+        return
+
+  async def disconnect(self) -> None:
+    """Close connection, never raises"""
+    writer: asyncio.StreamWriter | None = self.writer
+    self.reader, self.writer = None, None
+    if writer is None:
+      return
+    try:
+      writer.close()
+      await writer.wait_closed()
+    except Exception as e:
+      logger.debug(repr(e))
+
+  async def read_packet(self, wait: float | None = None
+  ) -> tuple[int, int, bytes] | None:
+    """Read one packet, returns (id, type, body) or None if nothing \
+arrived within `wait` seconds"""
+    try:
+      async with asyncio.timeout(wait):
+        header: bytes = await self.reader.readexactly(4)
+    except TimeoutError:
+      return None
+    (length,) = struct.unpack("<i", header)
+    if length < 10:
+      raise RCONException(f"Invalid packet length {length}")
+    payload: bytes = await self.reader.readexactly(length)
+    in_id, in_type = struct.unpack("<ii", payload[:8])
+    if payload[-2:] != b"\x00\x00":
+      raise RCONException("Incorrect packet padding")
+    return (in_id, in_type, payload[8:-2])
+
+  async def fragments(self, request_ids: list[int]
+  ) -> AsyncIterator[tuple[int, bytes]]:
+    """Yield (request id, body) for every packet answering \
+`request_ids`, in the order they were sent"""
+    pending: list[int] = list(request_ids)
+    wait: float | None = None
+    while pending:
+      packet: tuple[int, int, bytes] | None = await self.read_packet(
+        wait)
+      if packet is None:
+        ## Full sized packet was the last fragment after all
+        pending.pop(0)
+        wait = None
+        continue
+      in_id, in_type, body = packet
+      if in_id not in pending:
+        ## Leftover from an earlier request that timed out
+        logger.debug(f"Discarding stale RCON packet {in_id}")
+        continue
+      ## Responses come back in order, so earlier requests are done
+      del pending[:pending.index(in_id)]
+      if len(body) < FRAGMENT_SIZE:
+        pending.pop(0)
+        wait = None
+      else:
+        wait = FRAGMENT_TIMEOUT
+      yield (in_id, body)
+
+  async def receive(self, request_ids: list[int]) -> dict[int, str]:
+    """Collect responses for `request_ids`, in the order they were sent"""
+    fragments: dict[int, list[bytes]] = {request_id: [] for \
+      request_id in request_ids}
+    async for in_id, body in self.fragments(request_ids):
+      fragments[in_id].append(body)
+    return {request_id: b"".join(body).decode("utf8", "replace") for \
+      request_id, body in fragments.items()}
+
+  async def command(self, command: str, timeout: float | None = None
+  ) -> str:
+    """Send one command and return the whole response"""
+    timeout = timeout or self.timeout
+    if not self.connected:
+      await self.connect(timeout)
+    async with self.lock:
+      try:
+        async with asyncio.timeout(timeout):
+          request_id: int = self.next_id()
+          self.writer.write(encode_packet(request_id,
+            SERVERDATA_EXECCOMMAND, command))
+          await self.writer.drain()
+          return (await self.receive([request_id]))[request_id]
+      except BaseException:
+        ## Stream state is unknown after a failure, don't reuse it
+        await self.disconnect()
+        raise
+
+  async def commands(self, commands: list[str],
+    timeout: float | None = None) -> list[str]:
+    """Pipeline several commands over this session, responses are \
+matched by request ID and returned in the same order"""
+    timeout = timeout or self.timeout
+    if not commands:
+      return []
+    if not self.connected:
+      await self.connect(timeout)
+    async with self.lock:
+      try:
+        async with asyncio.timeout(timeout):
+          request_ids: list[int] = [self.next_id() for _ in commands]
+          self.writer.write(b"".join(encode_packet(request_id,
+            SERVERDATA_EXECCOMMAND, command) for request_id, command in \
+            zip(request_ids, commands)))
+          await self.writer.drain()
+          responses: dict[int, str] = await self.receive(request_ids)
+          return [responses[request_id] for request_id in request_ids]
+      except BaseException:
+        await self.disconnect()
+        raise
+
+  async def stream(self, command: str, timeout: float | None = None
+  ) -> AsyncIterator[str]:
+    """Send one command and yield the response as packets arrive. \
+`timeout` applies to each packet instead of the whole response"""
+    timeout = timeout or self.timeout
+    if not self.connected:
+      await self.connect(timeout)
+    async with self.lock:
+      try:
+        request_id: int = self.next_id()
+        async with asyncio.timeout(timeout):
+          self.writer.write(encode_packet(request_id,
+            SERVERDATA_EXECCOMMAND, command))
+          await self.writer.drain()
+        decoder: codecs.IncrementalDecoder = \
+          codecs.getincrementaldecoder("utf8")("replace")
+        fragments: AsyncIterator[tuple[int, bytes]] = self.fragments(
+          [request_id])
+        while True:
+          try:
+            async with asyncio.timeout(timeout):
+              _, body = await anext(fragments)
+          except StopAsyncIteration:
+            break
+          text: str = decoder.decode(body)
+          if text:
+            yield text
+        text = decoder.decode(b"", final = True)
+        if text:
+          yield text
+      except BaseException:
+        await self.disconnect()
+        raise
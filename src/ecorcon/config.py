@@ -1,16 +1,517 @@
 """Configuration callbacks"""
 
-from configparser import ConfigParser, NoSectionError
+import abc
+import asyncio
+import contextlib
+from configparser import ConfigParser
 from datetime import datetime
+import errno
+import glob
+import json
 import logging
 import os
 import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+from typing import Callable, Iterator
+from .metrics import counter, histogram
+
+if sys.platform.startswith("win32"):
+  import msvcrt
+else:
+  import fcntl
 
 logger: logging.Logger = logging.getLogger(__name__)
 
 config_file: str = os.path.join("instance", "config.ini")
 servers_file: str = os.path.join("instance", "servers.ini")
 users_file: str = os.path.join("instance", "users.ini")
+schedules_file: str = os.path.join("instance", "schedules.ini")
+database_file: str = os.path.join("instance", "ecorcon.sqlite3")
+
+config_loads = counter("ecorcon_config_loads_total",
+  "Configuration files parsed from disk", ("file",))
+config_writes = histogram("ecorcon_config_write_seconds",
+  "Configuration file writes, several edits may share one write",
+  ("file",))
+config_edits = counter("ecorcon_config_edits_total",
+  "Configuration edits requested", ("file",))
+
+class ConfigStore:
+  """Parsed configuration files cached in memory, parsed again only \
+when mtime or size changes on disk"""
+  def __init__(self, *args, **kwargs) -> None:
+    self.cache: dict[str, tuple[
+      tuple[int, int] | None,
+      ConfigParser,
+      dict[str, dict[str, str]],
+    ]] = {}
+
+  def signature(self, path: str) -> tuple[int, int] | None:
+    """File modification time and size, None if missing"""
+    try:
+      stat: os.stat_result = os.stat(path)
+      return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+      return None
+
+  def load(self, path: str) -> tuple[
+    tuple[int, int] | None,
+    ConfigParser,
+    dict[str, dict[str, str]],
+  ]:
+    """Return cache entry for `path`, parsing it if it changed"""
+    signature: tuple[int, int] | None = self.signature(path)
+    cached = self.cache.get(path)
+    if cached is None or cached[0] != signature:
+      config: ConfigParser = ConfigParser()
+      config.read(path)
+      cached = (
+        signature,
+        config,
+        {section: dict(config.items(section)) for section in \
+          config.sections()},
+      )
+      self.cache[path] = cached
+      config_loads.inc(file = os.path.basename(path))
+      logger.debug(f"Loaded {path}")
+    return cached
+
+  def get(self, path: str) -> ConfigParser:
+    """Shared parser for `path`, do not modify it"""
+    return self.load(path)[1]
+
+  def sections(self, path: str) -> dict[str, dict[str, str]]:
+    """Shared snapshot of every section in `path`, do not modify it"""
+    return self.load(path)[2]
+
+  def invalidate(self, path: str | None = None) -> None:
+    """Forget `path`, or everything, so next access parses again"""
+    if path is None:
+      self.cache.clear()
+    else:
+      self.cache.pop(path, None)
+
+store: ConfigStore = ConfigStore()
+
+@contextlib.contextmanager
+def file_lock(path: str) -> Iterator[None]:
+  """Exclusive lock on `path`.lock, held against other processes \
+writing the same file. Blocking"""
+  os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+  with open(f"{path}.lock", "a+") as lock:
+    if sys.platform.startswith("win32"):
+      lock.seek(0)
+      while True:
+        try:
+          msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+          break
+        except OSError as e:
+          ## LK_LOCK gives up after 10 seconds, try again
+          if e.errno not in [errno.EDEADLOCK, errno.EACCES]:
+            raise
+    else:
+      fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      if sys.platform.startswith("win32"):
+        lock.seek(0)
+        msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+      else:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+def rotate_backups(path: str, keep: int) -> None:
+  """Copy `path` to a timestamped backup and delete all but the `keep` \
+newest backups. Does nothing if `keep` is zero"""
+  if keep < 1 or not os.path.exists(path):
+    return
+  shutil.copy2(path, f"{path}.backup.{datetime.utcnow().timestamp()}")
+  backups: list[str] = sorted(glob.glob(f"{glob.escape(path)}.backup.*"),
+    key = os.path.getmtime)
+  for backup in backups[:max(0, len(backups) - keep)]:
+    try:
+      os.remove(backup)
+    except OSError as e:
+      logger.warning(f"Could not remove {backup}: {repr(e)}")
+
+def write_atomic(path: str, config: ConfigParser) -> None:
+  """Write to a temporary file in the same directory, fsync and rename \
+over `path`, so readers see either the old or the new file"""
+  directory: str = os.path.dirname(path) or "."
+  os.makedirs(directory, exist_ok = True)
+  descriptor, temporary = tempfile.mkstemp(dir = directory,
+    prefix = f".{os.path.basename(path)}.", suffix = ".tmp")
+  try:
+    with os.fdopen(descriptor, "w") as handle:
+      config.write(handle)
+      handle.flush()
+      os.fsync(handle.fileno())
+    os.replace(temporary, path)
+  except BaseException:
+    with contextlib.suppress(OSError):
+      os.remove(temporary)
+    raise
+  if not sys.platform.startswith("win32"):
+    ## Persist the rename itself
+    directory_descriptor: int = os.open(directory, os.O_RDONLY)
+    try:
+      os.fsync(directory_descriptor)
+    finally:
+      os.close(directory_descriptor)
+
+class ConfigWriter:
+  """Applies edits to ini files. Edits arriving within `delay` seconds \
+of each other are applied to one fresh read of the file and written \
+once, atomically, under a file lock, with at most `backups` backups \
+kept"""
+  def __init__(self, delay: float = 0.05, backups: int = 10, *args,
+    **kwargs) -> None:
+    self.delay: float = delay
+    self.backups: int = backups
+    self.pending: dict[str, list[tuple[
+      Callable[[ConfigParser], None],
+      asyncio.Future,
+    ]]] = {}
+    self.flushers: dict[str, asyncio.Task] = {}
+
+  async def edit(self, path: str, function: Callable[[ConfigParser], None]
+  ) -> None:
+    """Apply `function` to the parsed file and persist it. Returns \
+when written, raises what `function` or the write raised"""
+    future: asyncio.Future = asyncio.get_running_loop().create_future()
+    self.pending.setdefault(path, []).append((function, future))
+    config_edits.inc(file = os.path.basename(path))
+    if path not in self.flushers or self.flushers[path].done():
+      self.flushers[path] = asyncio.create_task(self.flush(path))
+    await future
+
+  async def flush(self, path: str) -> None:
+    """Write every pending edit of `path`"""
+    await asyncio.sleep(self.delay)
+    edits = self.pending.pop(path, [])
+    if not edits:
+      return
+    try:
+      with config_writes.time(file = os.path.basename(path)):
+        errors: list[Exception | None] = await asyncio.to_thread(
+          self.write, path, [edit[0] for edit in edits])
+      store.invalidate(path)
+      for (function, future), error in zip(edits, errors):
+        if future.done():
+          ## Caller went away, the edit was written anyway
+          continue
+        if error is None:
+          future.set_result(None)
+        else:
+          future.set_exception(error)
+    except Exception as e:
+      logger.exception(e)
+      for function, future in edits:
+        if not future.done():
+          future.set_exception(e)
+    finally:
+      if self.pending.get(path):
+        ## Edits that arrived during the write
+        self.flushers[path] = asyncio.create_task(self.flush(path))
+
+  def write(self, path: str, functions: list[Callable[[ConfigParser],
+    None]]) -> list[Exception | None]:
+    """Blocking read, edit and write. Returns the error of each edit, \
+failed edits are left out"""
+    errors: list[Exception | None] = [None] * len(functions)
+    with file_lock(path):
+      while True:
+        config: ConfigParser = ConfigParser()
+        config.read(path)
+        for index, function in enumerate(functions):
+          if errors[index] is not None:
+            continue
+          try:
+            function(config)
+          except Exception as e:
+            ## Start over without it, it may have changed something
+            errors[index] = e
+            break
+        else:
+          break
+      if any(error is None for error in errors):
+        rotate_backups(path, self.backups)
+        write_atomic(path, config)
+    return errors
+
+def get_writer(*args, **kwargs) -> ConfigWriter:
+  """Writer configured by the [config] section of config.ini"""
+  try:
+    config: ConfigParser = store.get(config_file)
+    return ConfigWriter(
+      delay = config.getfloat("config", "write_delay", fallback = 0.05),
+      backups = config.getint("config", "backups", fallback = 10),
+    )
+  except Exception as e:
+    logger.exception(e)
+  return ConfigWriter()
+
+writer: ConfigWriter = get_writer()
+
+class Record(dict):
+  """Options of one server or user, with the typed getters of a \
+ConfigParser section"""
+  def getint(self, key: str, fallback: int | None = None) -> int | None:
+    """Option as int"""
+    return int(self[key]) if key in self else fallback
+
+  def getfloat(self, key: str, fallback: float | None = None
+  ) -> float | None:
+    """Option as float"""
+    return float(self[key]) if key in self else fallback
+
+  def getboolean(self, key: str, fallback: bool | None = None
+  ) -> bool | None:
+    """Option as bool, same values as ConfigParser"""
+    if key not in self:
+      return fallback
+    return ConfigParser.BOOLEAN_STATES[str(self[key]).lower()]
+
+class Storage(abc.ABC):
+  """Where servers, users and schedules are kept. Records of a `kind` \
+are identified by name and hold string options. Reads are cheap and \
+synchronous, updates are coroutines"""
+  kinds: tuple[str, ...] = ("servers", "users", "schedules")
+
+  @abc.abstractmethod
+  def names(self, kind: str) -> tuple[str, ...]:
+    """Record names in creation order. The same tuple is returned until \
+something changes, callers may cache on its identity"""
+
+  @abc.abstractmethod
+  def get(self, kind: str, name: str) -> Record | None:
+    """One record, a copy"""
+
+  def all(self, kind: str) -> dict[str, Record]:
+    """Every record, copies"""
+    return {name: self.get(kind, name) for name in self.names(kind)}
+
+  @abc.abstractmethod
+  async def update(self, kind: str, name: str,
+    function: Callable[[Record], None]) -> None:
+    """Apply `function` to the record, created empty if missing, and \
+save it. Users get an `id` option when created"""
+
+  @abc.abstractmethod
+  async def delete(self, kind: str, name: str) -> None:
+    """Remove the record if it exists"""
+
+  def close(self) -> None:
+    """Release resources"""
+
+class IniStorage(Storage):
+  """One ini file per kind, sections are records. Reads come from the \
+mtime cached store, updates go through the coalescing writer"""
+  def __init__(self, files: dict[str, str] | None = None, *args,
+    **kwargs) -> None:
+    self.files: dict[str, str] = files or {
+      "servers": servers_file,
+      "users": users_file,
+      "schedules": schedules_file,
+    }
+    self.cached_names: dict[str, tuple[dict, tuple[str, ...]]] = {}
+
+  def names(self, kind: str) -> tuple[str, ...]:
+    sections: dict[str, dict[str, str]] = store.sections(self.files[kind])
+    cached: tuple[dict, tuple[str, ...]] | None = self.cached_names.get(
+      kind)
+    if cached is None or cached[0] is not sections:
+      cached = (sections, tuple(sections))
+      self.cached_names[kind] = cached
+    return cached[1]
+
+  def get(self, kind: str, name: str) -> Record | None:
+    options: dict[str, str] | None = store.sections(
+      self.files[kind]).get(name)
+    return Record(options) if options is not None else None
+
+  async def update(self, kind: str, name: str,
+    function: Callable[[Record], None]) -> None:
+    def apply(config: ConfigParser) -> None:
+      """Edit section through a record"""
+      record: Record = Record(config.items(name, raw = True)) if \
+        config.has_section(name) else Record()
+      if not config.has_section(name) and kind == "users":
+        record["id"] = str(max([config.getint(section, "id",
+          fallback = -1) for section in config.sections()] + [-1]) + 1)
+      function(record)
+      if not config.has_section(name):
+        config.add_section(name)
+      for key in list(config.options(name)):
+        if key not in record:
+          config.remove_option(name, key)
+      for key, value in record.items():
+        config.set(name, key, str(value))
+    await writer.edit(self.files[kind], apply)
+
+  async def delete(self, kind: str, name: str) -> None:
+    await writer.edit(self.files[kind], lambda config: \
+      config.remove_section(name))
+
+class SQLiteStorage(Storage):
+  """One table per kind with a unique index on name, options stored as \
+JSON. Lookups by name use the index and an update rewrites one row in \
+one transaction"""
+  def __init__(self, path: str = database_file, *args, **kwargs) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    self.path: str = path
+    ## Shared by the event loop (reads) and worker threads (writes)
+    self.lock: threading.Lock = threading.Lock()
+    self.connection: sqlite3.Connection = sqlite3.connect(path,
+      check_same_thread = False, isolation_level = None)
+    self.connection.execute("PRAGMA journal_mode = WAL")
+    self.connection.execute("PRAGMA synchronous = NORMAL")
+    for kind in self.kinds:
+      self.connection.execute(f"""CREATE TABLE IF NOT EXISTS {kind} (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name TEXT NOT NULL UNIQUE,
+  options TEXT NOT NULL
+)""")
+    self.cached_names: dict[str, tuple[str, ...]] = {}
+
+  def names(self, kind: str) -> tuple[str, ...]:
+    if kind not in self.kinds:
+      raise KeyError(kind)
+    if kind not in self.cached_names:
+      with self.lock:
+        self.cached_names[kind] = tuple(row[0] for row in \
+          self.connection.execute(f"SELECT name FROM {kind} ORDER BY id"))
+    return self.cached_names[kind]
+
+  def get(self, kind: str, name: str) -> Record | None:
+    if kind not in self.kinds:
+      raise KeyError(kind)
+    with self.lock:
+      row: tuple | None = self.connection.execute(
+        f"SELECT id, options FROM {kind} WHERE name = ?", (name,)
+      ).fetchone()
+    return self.to_record(kind, row) if row is not None else None
+
+  def all(self, kind: str) -> dict[str, Record]:
+    if kind not in self.kinds:
+      raise KeyError(kind)
+    with self.lock:
+      rows: list[tuple] = self.connection.execute(
+        f"SELECT name, id, options FROM {kind} ORDER BY id").fetchall()
+    return {row[0]: self.to_record(kind, row[1:]) for row in rows}
+
+  def to_record(self, kind: str, row: tuple) -> Record:
+    """Record from (id, options) row, users expose the row id"""
+    record: Record = Record(json.loads(row[1]))
+    if kind == "users":
+      record.setdefault("id", str(row[0]))
+    return record
+
+  def write(self, kind: str, name: str,
+    function: Callable[[Record], None]) -> None:
+    """Blocking read, modify and write of one row"""
+    with self.lock:
+      self.connection.execute("BEGIN IMMEDIATE")
+      try:
+        row: tuple | None = self.connection.execute(
+          f"SELECT id, options FROM {kind} WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+          cursor: sqlite3.Cursor = self.connection.execute(
+            f"INSERT INTO {kind} (name, options) VALUES (?, '{{}}')",
+            (name,))
+          row = (cursor.lastrowid, "{}")
+          self.cached_names.pop(kind, None)
+        record: Record = self.to_record(kind, row)
+        function(record)
+        self.connection.execute(
+          f"UPDATE {kind} SET options = ? WHERE id = ?",
+          (json.dumps({key: str(value) for key, value in \
+            record.items()}), row[0]))
+        self.connection.execute("COMMIT")
+      except BaseException:
+        self.connection.execute("ROLLBACK")
+        self.cached_names.pop(kind, None)
+        raise
+
+  async def update(self, kind: str, name: str,
+    function: Callable[[Record], None]) -> None:
+    if kind not in self.kinds:
+      raise KeyError(kind)
+    await asyncio.to_thread(self.write, kind, name, function)
+
+  async def delete(self, kind: str, name: str) -> None:
+    if kind not in self.kinds:
+      raise KeyError(kind)
+    def remove() -> None:
+      """Blocking delete of one row"""
+      with self.lock:
+        self.connection.execute(f"DELETE FROM {kind} WHERE name = ?",
+          (name,))
+        self.cached_names.pop(kind, None)
+    await asyncio.to_thread(remove)
+
+  def import_records(self, kind: str, records: dict[str, dict[str, str]]
+  ) -> int:
+    """Add records missing by name in one transaction, returns how many"""
+    added: int = 0
+    with self.lock:
+      self.connection.execute("BEGIN IMMEDIATE")
+      try:
+        for name, options in records.items():
+          cursor: sqlite3.Cursor = self.connection.execute(
+            f"INSERT OR IGNORE INTO {kind} (name, options) VALUES (?, ?)",
+            (name, json.dumps(dict(options))))
+          added += cursor.rowcount
+        self.connection.execute("COMMIT")
+      except BaseException:
+        self.connection.execute("ROLLBACK")
+        raise
+      finally:
+        self.cached_names.pop(kind, None)
+    return added
+
+  def close(self) -> None:
+    with self.lock:
+      self.connection.close()
+
+def migrate(source: Storage, target: SQLiteStorage) -> dict[str, int]:
+  """Copy records missing in `target` from `source`, returns how many \
+were added per kind"""
+  return {kind: target.import_records(kind, source.all(kind)) for kind \
+    in target.kinds}
+
+def get_storage(*args, **kwargs) -> Storage:
+  """Storage configured by the [storage] section of config.ini. The \
+sqlite backend imports the ini files into a new database"""
+  try:
+    config: ConfigParser = store.get(config_file)
+    backend: str = config.get("storage", "backend", fallback = "ini")
+    if backend == "sqlite":
+      path: str = config.get("storage", "path", fallback = database_file)
+      new: bool = not os.path.exists(path)
+      storage: SQLiteStorage = SQLiteStorage(path)
+      if new:
+        logger.info(f"Migrated ini files to {path}: \
+{migrate(IniStorage(), storage)}")
+      return storage
+    if backend != "ini":
+      logger.warning(f"Unknown storage backend {backend}, using ini")
+  except Exception as e:
+    logger.exception(e)
+  return IniStorage()
+
+storage: Storage = get_storage()
+
+def server_section(name: str) -> Record:
+  """Options of server `name`, raises KeyError if it doesn't exist"""
+  record: Record | None = storage.get("servers", name)
+  if record is None:
+    raise KeyError(name)
+  return record
 
 async def edit_server(
   name: str,
@@ -18,42 +519,31 @@ async def edit_server(
   password: str,
   boot: bool,
   *args,
+  host: str | None = None,
+  port: int | None = None,
   **kwargs,
 ) -> dict[str, bool | str | Exception | None]:
-  """Edit server config on server configuration file"""
+  """Edit server config on server configuration file. Empty password \
+keeps the current one"""
   _return: dict[str, bool | str | Exception | None] = {
     "status": False,
     "message": "Could not edit server configuration!",
     "exception": None,
   }
+  def apply(record: Record) -> None:
+    """Change server options"""
+    record["boot"] = str(int(boot))
+    record["path"] = path
+    if password or "password" not in record:
+      record["password"] = password or ""
+    if host is not None:
+      record["rcon_host"] = host
+    if port is not None:
+      record["rcon_port"] = str(int(port))
   try:
-    config: ConfigParser = ConfigParser()
-    if not os.path.exists(os.path.dirname(servers_file)):
-      os.makedirs(os.path.dirname(servers_file))
-    config.read(servers_file)
-    try:
-      config.set(name, "boot", str(int(boot)))
-      config.set(name, "password", password)
-      config.set(name, "path", path)
-    except NoSectionError as e2:
-      # ~ logger.exception(e2)
-      config.add_section(name)
-      config.set(name, "boot", str(int(boot)))
-      config.set(name, "password", password)
-      config.set(name, "path", path)
-    try:
-      shutil.copy(servers_file,
-        f"{servers_file}.backup.{datetime.utcnow().timestamp()}")
-    except FileNotFoundError:
-      pass
-    try:
-      with open(servers_file, "w+") as srv:
-        config.write(srv)
-      _return["message"] = f"{name} settings updated."
-      _return["status"] = True
-    except Exception as e1:
-      logger.exception(e1)
-      _return["exception"] = e1
+    await storage.update("servers", name, apply)
+    _return["message"] = f"{name} settings updated."
+    _return["status"] = True
   except Exception as e:
     logger.exception(e)
     _return["exception"] = e
@@ -73,50 +563,37 @@ async def edit_user(
     "message": "Could not edit user configuration!",
     "exception": None,
   }
+  def apply(record: Record) -> None:
+    """Change user options, storage assigns the id of new users"""
+    record["password"] = password
+    record["level"] = level
+    record["active"] = str(int(active))
   try:
-    config: ConfigParser = ConfigParser()
-    config.read(users_file)
-    try:
-      config.set(user, "password", password)
-      config.set(user, "level", level)
-      config.set(user, "active", str(int(active)))
-    except NoSectionError as e2:
-      logger.exception(e2)
-      user_id: str = str(len(config.sections()))
-      config.add_section(user)
-      config.set(user, "password", password)
-      config.set(user, "level", level)
-      config.set(user, "active", str(int(active)))
-      config.set(user, "id", user_id)
-    try:
-      shutil.copy(users_file,
-        f"{users_file}.backup.{datetime.utcnow().timestamp()}")
-    except FileNotFoundError:
-      pass
-    try:
-      with open(users_file, "w+") as pwd:
-        config.write(pwd)
-      _return["message"] = f"""{user} credentials updated. Do try to \
+    await storage.update("users", user, apply)
+    _return["message"] = f"""{user} credentials updated. Do try to \
 login."""
-      _return["status"] = True
-    except Exception as e1:
-      logger.exception(e1)
-      _return["exception"] = e1
+    _return["status"] = True
   except Exception as e:
     logger.exception(e)
     _return["exception"] = e
   return _return
 
+async def get_config(*args, **kwargs) -> ConfigParser:
+  """Main configuration, shared, do not modify it"""
+  return store.get(config_file)
+
 async def get_servers(*args, **kwargs) -> dict[str, dict[str, str]]:
   """Get list of servers"""
-  config: ConfigParser = ConfigParser()
-  config.read(servers_file)
-  return {section:dict(config.items(section)) for section in \
-    config.sections()}
+  return storage.all("servers")
+
+async def get_server(name: str, *args, **kwargs) -> dict[str, str] | None:
+  """Get one server"""
+  return storage.get("servers", name)
 
 async def get_users(*args, **kwargs) -> dict[str, dict[str, str]]:
   """Get list of users"""
-  config: ConfigParser = ConfigParser()
-  config.read(users_file)
-  return {section:dict(config.items(section)) for section in \
-    config.sections()}
+  return storage.all("users")
+
+async def get_user(user: str, *args, **kwargs) -> dict[str, str] | None:
+  """Get one user"""
+  return storage.get("users", user)
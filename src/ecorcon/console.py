@@ -0,0 +1,85 @@
+"""Eco server console output"""
+
+import asyncio
+from collections import deque
+from itertools import islice
+import logging
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+## Longest line kept, anything after this is cut
+max_line: int = 64 * 1024
+
+class ConsoleBuffer:
+  """Ring buffer with the last lines of a server output. Every line \
+gets a sequence number so readers can follow from where they stopped \
+and find out how many lines they missed"""
+  def __init__(self, maxlen: int = 5000, *args, **kwargs) -> None:
+    self.lines: deque[str] = deque(maxlen = maxlen)
+    self.sequence: int = 0
+    self.event: asyncio.Event = asyncio.Event()
+
+  def append(self, line: str) -> None:
+    """Add line and wake up readers"""
+    self.lines.append(line)
+    self.sequence += 1
+    event: asyncio.Event = self.event
+    self.event = asyncio.Event()
+    event.set()
+
+  def tail(self, count: int) -> list[str]:
+    """Last `count` lines"""
+    count = max(0, min(count, len(self.lines)))
+    return list(islice(self.lines, len(self.lines) - count, None))
+
+  def since(self, sequence: int) -> tuple[list[str], int, int]:
+    """Lines after `sequence`, returns (lines, new sequence, number of \
+lines dropped because the reader fell behind the buffer)"""
+    first: int = self.sequence - len(self.lines)
+    dropped: int = max(0, first - sequence)
+    start: int = max(sequence, first) - first
+    lines: list[str] = list(islice(self.lines, start, None))
+    return (lines, self.sequence, dropped)
+
+  async def wait(self, sequence: int, timeout: float | None = None
+  ) -> bool:
+    """Wait until there are lines after `sequence`"""
+    if self.sequence > sequence:
+      return True
+    try:
+      await asyncio.wait_for(self.event.wait(), timeout)
+    except TimeoutError:
+      pass
+    return self.sequence > sequence
+
+consoles: dict[str, ConsoleBuffer] = {}
+
+def get_console(server_name: str, maxlen: int = 5000) -> ConsoleBuffer:
+  """Console buffer for server, created on first use and resized to \
+`maxlen` later on. Only for starting servers, readers look up `consoles`"""
+  buffer: ConsoleBuffer | None = consoles.get(server_name)
+  if buffer is None:
+    consoles[server_name] = buffer = ConsoleBuffer(maxlen)
+  elif buffer.lines.maxlen != maxlen:
+    buffer.lines = deque(buffer.lines, maxlen = maxlen)
+  return buffer
+
+async def pump(stream: asyncio.StreamReader, buffer: ConsoleBuffer
+) -> None:
+  """Copy lines from process output to buffer until EOF"""
+  while True:
+    try:
+      line: bytes = await stream.readuntil(b"\n")
+    except asyncio.IncompleteReadError as e:
+      if e.partial:
+        buffer.append(e.partial.decode("utf8", "replace").rstrip())
+      break
+    except asyncio.LimitOverrunError as e:
+      ## Line longer than the stream limit, keep the start of it
+      line = await stream.read(e.consumed)
+      buffer.append(line[:max_line].decode("utf8", "replace").rstrip())
+      continue
+    except Exception as e:
+      logger.exception(e)
+      break
+    buffer.append(line[:max_line].decode("utf8", "replace").rstrip())
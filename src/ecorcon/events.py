@@ -0,0 +1,332 @@
+"""Player, chat and error events parsed from Eco server output
+
+Server console buffers are followed as they grow, lines are matched
+against the patterns of the [events] section of config.ini and the
+matches stored in SQLite with indexes on time and player, along with
+player sessions built from joins and leaves.
+"""
+
+import asyncio
+from configparser import ConfigParser
+from datetime import datetime
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from .config import config_file, storage, store
+from .console import ConsoleBuffer, consoles
+from .metrics import counter
+from .supervisor import Supervisor
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+events_file: str = os.path.join("instance", "events.sqlite3")
+
+events_parsed = counter("ecorcon_events_total",
+  "Events parsed from Eco server output", ("server", "kind"))
+
+## Kind -> pattern, first match wins. Named groups `player` and
+## `message` are stored when present, otherwise the whole line is the
+## message.
+default_patterns: dict[str, str] = {
+  "start": r"^### .+ started with process id \d+$",
+  "stop": r"^### .+ exited with code -?\d+$",
+  "chat": r"\bchat\b\W*(?:\[[^\]]*\]\s*)?(?P<player>[^:\[\]]{1,64}?)\s*:"
+    r"\s*(?P<message>.*)$",
+  "join": r"(?P<player>[^\s:\[\]]{1,64})\s+(?:has\s+)?"
+    r"(?:joined|logged in)\b",
+  "leave": r"(?P<player>[^\s:\[\]]{1,64})\s+(?:has\s+)?"
+    r"(?:left the (?:game|server)|logged (?:out|off)|disconnected)\b",
+  "error": r"\b(?:error|fatal)\b|exception\b",
+}
+
+## (kind, player, message) of one line
+Event = tuple[str, str | None, str]
+
+class EventParser:
+  """Turns output lines into events"""
+  def __init__(self, patterns: dict[str, str] | None = None, *args,
+    **kwargs) -> None:
+    self.patterns: list[tuple[str, re.Pattern]] = [(kind,
+      re.compile(pattern, re.IGNORECASE)) for kind, pattern in \
+      (patterns or default_patterns).items() if pattern]
+
+  def parse(self, line: str) -> Event | None:
+    """Event of the first matching pattern, None for other lines"""
+    for kind, pattern in self.patterns:
+      match: re.Match | None = pattern.search(line)
+      if match is not None:
+        groups: dict[str, str | None] = match.groupdict()
+        player: str | None = groups.get("player")
+        return (
+          kind,
+          player.strip() if player else None,
+          groups.get("message") or line,
+        )
+    return None
+
+class EventStore:
+  """SQLite database of events and player sessions. Safe to use from \
+worker threads, one at a time"""
+  def __init__(self, path: str = events_file, *args, **kwargs) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    self.path: str = path
+    self.lock: threading.Lock = threading.Lock()
+    self.connection: sqlite3.Connection = sqlite3.connect(path,
+      check_same_thread = False, isolation_level = None)
+    self.connection.execute("PRAGMA journal_mode = WAL")
+    self.connection.execute("PRAGMA synchronous = NORMAL")
+    self.connection.executescript("""
+CREATE TABLE IF NOT EXISTS events (
+  id INTEGER PRIMARY KEY,
+  time REAL NOT NULL,
+  server TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  player TEXT,
+  message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_kind ON events (server, kind, time);
+CREATE INDEX IF NOT EXISTS events_player ON events (player, time)
+  WHERE player IS NOT NULL;
+CREATE TABLE IF NOT EXISTS sessions (
+  id INTEGER PRIMARY KEY,
+  server TEXT NOT NULL,
+  player TEXT NOT NULL,
+  joined REAL NOT NULL,
+  left REAL
+);
+CREATE INDEX IF NOT EXISTS sessions_joined ON sessions (server, joined);
+CREATE INDEX IF NOT EXISTS sessions_open ON sessions (server, player)
+  WHERE left IS NULL;
+""")
+
+  def insert(self, server: str, events: list[tuple[float, Event]]
+  ) -> None:
+    """Add events and update sessions, in one transaction"""
+    with self.lock:
+      self.connection.execute("BEGIN IMMEDIATE")
+      try:
+        self.connection.executemany("""INSERT INTO events
+  (time, server, kind, player, message) VALUES (?, ?, ?, ?, ?)""",
+          [(moment, server, kind, player, message) for moment, (kind,
+          player, message) in events])
+        for moment, (kind, player, message) in events:
+          if kind == "join" and player:
+            if self.connection.execute("""SELECT 1 FROM sessions
+  WHERE server = ? AND player = ? AND left IS NULL""", (server, player)
+            ).fetchone() is None:
+              self.connection.execute("""INSERT INTO sessions
+  (server, player, joined) VALUES (?, ?, ?)""", (server, player, moment))
+          elif kind == "leave" and player:
+            self.connection.execute("""UPDATE sessions SET left = ?
+  WHERE server = ? AND player = ? AND left IS NULL""", (moment, server,
+              player))
+          elif kind in ["start", "stop"]:
+            ## Nobody stays online across a server restart
+            self.connection.execute("""UPDATE sessions SET left = ?
+  WHERE server = ? AND left IS NULL""", (moment, server))
+        self.connection.execute("COMMIT")
+      except BaseException:
+        self.connection.execute("ROLLBACK")
+        raise
+
+  def recent(
+    self,
+    server: str | None = None,
+    kind: str | None = None,
+    player: str | None = None,
+    before: float | None = None,
+    limit: int = 100,
+  ) -> list[dict]:
+    """Newest events first, filtered by whatever is given"""
+    where: list[str] = []
+    parameters: list = []
+    for column, value in [("server", server), ("kind", kind),
+      ("player", player)]:
+      if value:
+        where.append(f"{column} = ?")
+        parameters.append(value)
+    if before is not None:
+      where.append("time < ?")
+      parameters.append(before)
+    with self.lock:
+      rows: list[tuple] = self.connection.execute(f"""SELECT time,
+  server, kind, player, message FROM events
+  {"WHERE " + " AND ".join(where) if where else ""}
+  ORDER BY time DESC LIMIT ?""", parameters + [max(1, min(limit, 10000))]
+      ).fetchall()
+    return [dict(zip(["time", "server", "kind", "player", "message"],
+      row)) for row in rows]
+
+  def online(self, server: str, at: float) -> list[dict]:
+    """Players online on `server` at the `at` timestamp"""
+    with self.lock:
+      rows: list[tuple] = self.connection.execute("""SELECT player,
+  joined, left FROM sessions WHERE server = ? AND joined <= ?
+  AND (left IS NULL OR left > ?) ORDER BY joined""", (server, at, at)
+      ).fetchall()
+    return [dict(zip(["player", "joined", "left"], row)) for row in rows]
+
+  def close_sessions(self, server: str) -> None:
+    """Close sessions left open by a previous run at the time of the \
+last event of the server"""
+    with self.lock:
+      self.connection.execute("""UPDATE sessions SET left = (SELECT
+  max(time) FROM events WHERE server = ?) WHERE server = ?
+  AND left IS NULL""", (server, server))
+
+  def prune(self, before: float) -> int:
+    """Forget events and finished sessions older than `before`, returns \
+how many events"""
+    with self.lock:
+      cursor: sqlite3.Cursor = self.connection.execute(
+        "DELETE FROM events WHERE time < ?", (before,))
+      self.connection.execute(
+        "DELETE FROM sessions WHERE left IS NOT NULL AND left < ?",
+        (before,))
+      return cursor.rowcount
+
+  def close(self) -> None:
+    """Close database"""
+    with self.lock:
+      self.connection.close()
+
+class EventLog:
+  """Follows every server console and stores the events found. Lines \
+are picked up every `delay` seconds and written in one transaction"""
+  def __init__(
+    self,
+    path: str = events_file,
+    parser: EventParser | None = None,
+    delay: float = 1.0,
+    keep_days: float = 30.0,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.path: str = path
+    self.parser: EventParser = parser or EventParser()
+    self.delay: float = delay
+    self.keep_days: float = keep_days
+    self.store: EventStore | None = None
+    self.followers: dict[str, asyncio.Task] = {}
+
+  def open(self) -> EventStore:
+    """Database, opened on first use"""
+    if self.store is None:
+      self.store = EventStore(self.path)
+    return self.store
+
+  async def follow(self, server_name: str, buffer: ConsoleBuffer) -> None:
+    """Parse and store lines of one console as they come"""
+    sequence: int = 0
+    await asyncio.to_thread(self.open().close_sessions, server_name)
+    while True:
+      await buffer.wait(sequence)
+      lines, sequence, dropped = buffer.since(sequence)
+      if dropped:
+        logger.warning(f"""Events of {server_name}: {dropped} lines \
+went by unparsed""")
+      now: float = time.time()
+      events: list[tuple[float, Event]] = []
+      for line in lines:
+        event: Event | None = self.parser.parse(line)
+        if event is not None:
+          events.append((now, event))
+          events_parsed.inc(server = server_name, kind = event[0])
+      if events:
+        try:
+          await asyncio.to_thread(self.open().insert, server_name, events)
+        except Exception as e:
+          logger.exception(e)
+      ## Let lines pile up into the next transaction
+      await asyncio.sleep(self.delay)
+
+  async def prune(self) -> None:
+    """Drop events older than `keep_days`"""
+    if self.keep_days > 0:
+      removed: int = await asyncio.to_thread(self.open().prune,
+        time.time() - self.keep_days * 86400)
+      if removed:
+        logger.info(f"Pruned {removed} events")
+
+  async def run(self, supervisor: Supervisor) -> None:
+    """Background task following consoles of configured servers as they \
+start, waking up when the supervisor hears of a change and at least \
+every minute to notice removed servers"""
+    pruned: float = 0.0
+    try:
+      while True:
+        configured: tuple[str, ...] = ()
+        try:
+          configured = storage.names("servers")
+        except Exception as e:
+          logger.exception(e)
+        for server_name in list(self.followers):
+          if server_name not in configured:
+            self.followers.pop(server_name).cancel()
+        for server_name in configured:
+          buffer: ConsoleBuffer | None = consoles.get(server_name)
+          if buffer is not None and server_name not in self.followers:
+            self.followers[server_name] = asyncio.create_task(self.follow(
+              server_name, buffer))
+        if time.monotonic() - pruned > 3600.0:
+          pruned = time.monotonic()
+          try:
+            await self.prune()
+          except Exception as e:
+            logger.exception(e)
+        try:
+          await asyncio.wait_for(supervisor.changed(), 60.0)
+        except TimeoutError:
+          pass
+    finally:
+      for follower in self.followers.values():
+        follower.cancel()
+      self.followers.clear()
+
+  def close(self) -> None:
+    """Close database if open"""
+    if self.store is not None:
+      self.store.close()
+      self.store = None
+
+  async def recent(self, *args, **kwargs) -> list[dict]:
+    """EventStore.recent in a worker thread"""
+    return await asyncio.to_thread(self.open().recent, *args, **kwargs)
+
+  async def online(self, *args, **kwargs) -> list[dict]:
+    """EventStore.online in a worker thread"""
+    return await asyncio.to_thread(self.open().online, *args, **kwargs)
+
+def parse_time(value: str | None) -> float | None:
+  """Timestamp from seconds since the epoch or a local ISO date and \
+time, like the value of a datetime-local input"""
+  if not value:
+    return None
+  try:
+    return float(value)
+  except ValueError:
+    return datetime.fromisoformat(value).timestamp()
+
+def get_event_log(*args, **kwargs) -> EventLog:
+  """Event log configured by the [events] section of config.ini"""
+  try:
+    config: ConfigParser = store.get(config_file)
+    patterns: dict[str, str] = dict(default_patterns)
+    for kind in default_patterns:
+      patterns[kind] = config.get("events", kind, raw = True,
+        fallback = patterns[kind])
+    return EventLog(
+      path = config.get("events", "path", fallback = events_file),
+      parser = EventParser(patterns),
+      delay = config.getfloat("events", "delay", fallback = 1.0),
+      keep_days = config.getfloat("events", "keep_days", fallback = 30.0),
+    )
+  except Exception as e:
+    logger.exception(e)
+  return EventLog()
+
+event_log: EventLog = get_event_log()
@@ -0,0 +1,221 @@
+"""Background jobs for long running operations"""
+
+import asyncio
+from collections import OrderedDict
+from configparser import ConfigParser
+import itertools
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable
+from .config import config_file, store
+from .console import ConsoleBuffer
+from .metrics import counter, gauge, registry
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+job_results = counter("ecorcon_jobs_total", "Finished background jobs",
+  ("job", "state"))
+jobs_waiting = gauge("ecorcon_jobs_waiting",
+  "Background jobs queued or running", ("state",))
+
+class Job:
+  """One submitted operation. State goes queued -> running -> done, \
+failed or cancelled"""
+  def __init__(
+    self,
+    job_id: str,
+    name: str,
+    function: Callable[..., Awaitable],
+    *args,
+    **kwargs,
+  ) -> None:
+    self.id: str = job_id
+    self.name: str = name
+    self.function: Callable[..., Awaitable] = function
+    self.args: tuple = args
+    self.kwargs: dict = kwargs
+    self.state: str = "queued"
+    self.created: float = time.time()
+    self.started: float | None = None
+    self.finished: float | None = None
+    self.result: dict | tuple | None = None
+    self.exception: Exception | None = None
+    self.task: asyncio.Task | None = None
+    self.event: asyncio.Event = asyncio.Event()
+    ## Last lines of streamed output, for functions taking `output`
+    self.output: ConsoleBuffer | None = None
+
+  @property
+  def done(self) -> bool:
+    """Whether the job finished one way or another"""
+    return self.state in ["done", "failed", "cancelled"]
+
+  def finish(self, state: str) -> None:
+    """Set final state and wake up waiters"""
+    self.state = state
+    self.finished = time.time()
+    job_results.inc(job = self.name, state = state)
+    self.event.set()
+
+  async def wait(self, timeout: float | None = None) -> bool:
+    """Wait until the job finishes, returns whether it did"""
+    try:
+      await asyncio.wait_for(self.event.wait(), timeout)
+    except TimeoutError:
+      pass
+    return self.done
+
+  async def follow(self, sequence: int = 0
+  ) -> AsyncIterator[tuple[list[str], int]]:
+    """Yield (new output lines, lines skipped) as they come, until the \
+job finishes. A slow reader skips lines instead of buffering them"""
+    while True:
+      ## Taken first, so the lines written before the job finished are
+      ## read once more after it did
+      done: bool = self.done
+      if self.output is not None:
+        lines, sequence, dropped = self.output.since(sequence)
+        if lines or dropped:
+          yield (lines, dropped)
+      if done:
+        return
+      waiters: list[asyncio.Task] = [asyncio.create_task(
+        self.event.wait())]
+      if self.output is not None:
+        waiters.append(asyncio.create_task(self.output.wait(sequence)))
+      try:
+        await asyncio.wait(waiters, return_when = asyncio.FIRST_COMPLETED)
+      finally:
+        for waiter in waiters:
+          waiter.cancel()
+
+  def to_dict(self) -> dict:
+    """JSON friendly"""
+    _return: dict = {
+      "id": self.id,
+      "name": self.name,
+      "state": self.state,
+      "created": self.created,
+      "started": self.started,
+      "finished": self.finished,
+      "status": False,
+      "message": None,
+      "output": None,
+      "returncode": None,
+      "exception": repr(self.exception) if self.exception is not None \
+        else None,
+    }
+    if self.output is not None:
+      _return["output"] = "\n".join(self.output.lines)
+    if isinstance(self.result, dict):
+      _return["status"] = bool(self.result.get("status"))
+      _return["message"] = self.result.get("message")
+      _return["returncode"] = self.result.get("returncode")
+      if self.output is None:
+        _return["output"] = self.result.get("output")
+      if self.result.get("exception") is not None:
+        _return["exception"] = repr(self.result["exception"])
+    elif isinstance(self.result, tuple):
+      _return["status"], _return["message"] = self.result[:2]
+    return _return
+
+class JobQueue:
+  """Runs jobs in the background, at most `concurrency` at a time, and \
+keeps the last `keep` finished ones around for status requests"""
+  def __init__(self, concurrency: int = 2, keep: int = 100,
+    output_lines: int = 1000, *args, **kwargs) -> None:
+    self.semaphore: asyncio.Semaphore = asyncio.Semaphore(
+      max(1, concurrency))
+    self.keep: int = max(1, keep)
+    self.output_lines: int = max(1, output_lines)
+    self.jobs: OrderedDict[str, Job] = OrderedDict()
+    self.ids: itertools.count = itertools.count(1)
+
+  def submit(
+    self,
+    name: str,
+    function: Callable[..., Awaitable],
+    *args,
+    stream: bool = False,
+    **kwargs,
+  ) -> Job:
+    """Queue `function(*args, **kwargs)`, returns immediately. With \
+`stream` the function also gets `output`, a buffer it writes lines to \
+while it runs"""
+    job: Job = Job(str(next(self.ids)), name, function, *args, **kwargs)
+    if stream:
+      job.output = ConsoleBuffer(self.output_lines)
+      job.kwargs["output"] = job.output
+    self.jobs[job.id] = job
+    job.task = asyncio.create_task(self.run(job))
+    self.prune()
+    return job
+
+  async def run(self, job: Job) -> None:
+    """Run job when a slot is free"""
+    try:
+      async with self.semaphore:
+        job.state = "running"
+        job.started = time.time()
+        job.result = await job.function(*job.args, **job.kwargs)
+      job.finish("done")
+    except asyncio.CancelledError:
+      job.finish("cancelled")
+    except Exception as e:
+      logger.exception(e)
+      job.exception = e
+      job.finish("failed")
+
+  def get(self, job_id: str) -> Job | None:
+    """Job by id"""
+    return self.jobs.get(job_id)
+
+  def cancel(self, job_id: str) -> bool:
+    """Cancel queued or running job, returns whether it was pending"""
+    job: Job | None = self.jobs.get(job_id)
+    if job is None or job.done or job.task is None:
+      return False
+    job.task.cancel()
+    return True
+
+  def prune(self) -> None:
+    """Forget the oldest finished jobs beyond `keep`"""
+    finished: list[str] = [job_id for job_id, job in self.jobs.items() \
+      if job.done]
+    for job_id in finished[:max(0, len(finished) - self.keep)]:
+      del self.jobs[job_id]
+
+  def to_list(self) -> list[dict]:
+    """Every known job, newest first"""
+    return [job.to_dict() for job in reversed(self.jobs.values())]
+
+  async def close(self) -> None:
+    """Cancel everything still pending"""
+    tasks: list[asyncio.Task] = [job.task for job in self.jobs.values() \
+      if job.task is not None and not job.done]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions = True)
+
+def get_queue(*args, **kwargs) -> JobQueue:
+  """Job queue configured by the [jobs] section of config.ini"""
+  try:
+    config: ConfigParser = store.get(config_file)
+    return JobQueue(
+      concurrency = config.getint("jobs", "concurrency", fallback = 2),
+      keep = config.getint("jobs", "keep", fallback = 100),
+      output_lines = config.getint("jobs", "output_lines",
+        fallback = 1000),
+    )
+  except Exception as e:
+    logger.exception(e)
+  return JobQueue()
+
+jobs: JobQueue = get_queue()
+
+@registry.collector
+def collect_jobs() -> None:
+  """Refresh pending job gauges"""
+  for state in ["queued", "running"]:
+    jobs_waiting.set(sum(1 for job in jobs.jobs.values() if \
+      job.state == state), state = state)
@@ -0,0 +1,329 @@
+"""Eco server log files, read through mmap
+
+Log files are found next to the server binary. Each one gets a sparse
+line index saved in the instance directory: for every `block` bytes of
+file, the offset and number of the first line starting after it. Going
+to a line is a binary search plus a short scan, growing files are
+indexed from where the last scan stopped, and files are never read
+into memory as a whole.
+"""
+
+import asyncio
+from array import array
+from bisect import bisect_right
+from configparser import ConfigParser
+import contextlib
+import glob
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import tempfile
+import threading
+from typing import Iterator
+from .config import config_file, server_section, store
+from .console import max_line
+from .metrics import counter
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+index_directory: str = os.path.join("instance", "logs")
+## Bytes hashed to tell a rotated file from a grown one
+head_size: int = 4096
+
+index_scans = counter("ecorcon_log_index_scans_total",
+  "Log file index updates", ("mode",))
+
+@contextlib.contextmanager
+def open_map(path: str) -> Iterator[mmap.mmap | None]:
+  """Read only map of the whole file as it is now, None when empty"""
+  with open(path, "rb") as stream:
+    size: int = os.fstat(stream.fileno()).st_size
+    if size == 0:
+      yield None
+      return
+    mapped: mmap.mmap = mmap.mmap(stream.fileno(), size,
+      access = mmap.ACCESS_READ)
+    try:
+      yield mapped
+    finally:
+      mapped.close()
+
+class LineIndex:
+  """Sparse line index of one file, kept up to date incrementally"""
+  def __init__(self, path: str, directory: str = index_directory,
+    block: int = 65536, *args, **kwargs) -> None:
+    self.path: str = os.path.realpath(path)
+    self.block: int = max(4096, block)
+    self.index_path: str = os.path.join(directory, hashlib.sha1(
+      self.path.encode("utf8")).hexdigest()[:20] + ".idx")
+    self.lock: threading.Lock = threading.Lock()
+    self.reset()
+    self.load()
+
+  def reset(self) -> None:
+    """Forget everything, the next update scans the whole file"""
+    ## First line of the file, then one line after every block boundary
+    self.offsets: array = array("Q", [0])
+    self.numbers: array = array("Q", [0])
+    ## Whole blocks counted so far and newlines before the next one
+    self.blocks: int = 0
+    self.newlines: int = 0
+    self.head: str = ""
+    self.head_length: int = 0
+    ## Size and line count when last updated
+    self.size: int = 0
+    self.lines: int = 0
+
+  def load(self) -> None:
+    """Read saved index, if any"""
+    try:
+      with open(self.index_path, "rb") as stream:
+        header: dict = json.loads(stream.readline())
+        if header.get("path") != self.path or \
+          header.get("block") != self.block:
+          return
+        offsets: array = array("Q")
+        numbers: array = array("Q")
+        offsets.fromfile(stream, header["count"])
+        numbers.fromfile(stream, header["count"])
+      self.offsets, self.numbers = offsets, numbers
+      for key in ["blocks", "newlines", "head", "head_length", "size",
+        "lines"]:
+        setattr(self, key, header[key])
+    except FileNotFoundError:
+      pass
+    except Exception as e:
+      logger.warning(f"Ignoring index of {self.path}: {repr(e)}")
+      self.reset()
+
+  def save(self) -> None:
+    """Write index atomically"""
+    os.makedirs(os.path.dirname(self.index_path), exist_ok = True)
+    header: dict = {"path": self.path, "block": self.block,
+      "count": len(self.offsets), "blocks": self.blocks,
+      "newlines": self.newlines, "head": self.head,
+      "head_length": self.head_length, "size": self.size,
+      "lines": self.lines}
+    descriptor, temporary = tempfile.mkstemp(dir = os.path.dirname(
+      self.index_path), prefix = ".idx-")
+    try:
+      with os.fdopen(descriptor, "wb") as stream:
+        stream.write(json.dumps(header).encode("utf8") + b"\n")
+        self.offsets.tofile(stream)
+        self.numbers.tofile(stream)
+      os.replace(temporary, self.index_path)
+    except BaseException:
+      with contextlib.suppress(OSError):
+        os.remove(temporary)
+      raise
+
+  def update(self, mapped: mmap.mmap | None) -> None:
+    """Index what was appended since last time, or everything again if \
+the file was truncated or replaced"""
+    size: int = len(mapped) if mapped is not None else 0
+    replaced: bool = size < self.size or (self.head_length > 0 and \
+      hashlib.sha1(mapped[:self.head_length]).hexdigest() != self.head)
+    if size == self.size and not replaced:
+      return
+    head_length: int = min(head_size, size)
+    if replaced:
+      self.reset()
+      index_scans.inc(mode = "full")
+    else:
+      index_scans.inc(mode = "incremental")
+    if mapped is None:
+      self.size = 0
+      return
+    while (self.blocks + 1) * self.block <= size:
+      start: int = self.blocks * self.block
+      if self.blocks > 0:
+        newline: int = mapped.find(b"\n", start, size)
+        if newline == -1:
+          break
+        if newline + 1 > self.offsets[-1]:
+          self.offsets.append(newline + 1)
+          self.numbers.append(self.newlines + 1)
+      self.newlines += mapped[start:start + self.block].count(b"\n")
+      self.blocks += 1
+    tail: int = mapped[self.blocks * self.block:size].count(b"\n")
+    self.lines = self.newlines + tail + (0 if mapped[size - 1:size] == \
+      b"\n" else 1)
+    self.head_length = head_length
+    self.head = hashlib.sha1(mapped[:head_length]).hexdigest()
+    self.size = size
+    self.save()
+
+  def offset(self, mapped: mmap.mmap, number: int) -> int:
+    """Byte offset where line `number` (from 0) starts"""
+    position: int = bisect_right(self.numbers, number) - 1
+    offset: int = self.offsets[position]
+    for _ in range(number - self.numbers[position]):
+      newline: int = mapped.find(b"\n", offset)
+      if newline == -1:
+        return len(mapped)
+      offset = newline + 1
+    return offset
+
+  def number(self, mapped: mmap.mmap, offset: int) -> int:
+    """Number of the line containing byte `offset`"""
+    position: int = bisect_right(self.offsets, offset) - 1
+    return self.numbers[position] + mapped[self.offsets[position]:
+      offset].count(b"\n")
+
+def decode(line: bytes) -> str:
+  """Text of one line, cut at `max_line` bytes"""
+  return line[:max_line].rstrip(b"\r\n").decode("utf8", "replace")
+
+class LogFile:
+  """One log file: paging and search"""
+  def __init__(self, path: str, index: LineIndex, *args, **kwargs
+  ) -> None:
+    self.path: str = path
+    self.index: LineIndex = index
+
+  def read(self, start: int | None = None, count: int = 100) -> dict:
+    """`count` lines from line `start`, the last ones when `start` is \
+None or negative (from the end)"""
+    count = max(1, min(count, 5000))
+    with self.index.lock, open_map(self.path) as mapped:
+      self.index.update(mapped)
+      total: int = self.index.lines
+      if start is None:
+        start = total - count
+      elif start < 0:
+        start = total + start
+      start = max(0, min(start, total))
+      lines: list[str] = []
+      if mapped is not None:
+        offset: int = self.index.offset(mapped, start)
+        while len(lines) < count and offset < len(mapped):
+          newline: int = mapped.find(b"\n", offset)
+          end: int = len(mapped) if newline == -1 else newline + 1
+          lines.append(decode(mapped[offset:min(end, offset + max_line)]))
+          offset = end
+    return {"start": start, "total": total, "lines": lines,
+      "size": self.index.size}
+
+  def search(
+    self,
+    query: str,
+    regex: bool = False,
+    start: int = 0,
+    limit: int = 100,
+    ignore_case: bool = False,
+  ) -> dict:
+    """First `limit` lines matching `query` from line `start` on, with \
+the line to continue from. Ignoring case is about ten times slower"""
+    limit = max(1, min(limit, 1000))
+    pattern: re.Pattern = re.compile(query.encode("utf8") if regex else \
+      re.escape(query.encode("utf8")), re.IGNORECASE if ignore_case \
+      else 0)
+    matches: list[dict] = []
+    following: int | None = None
+    with self.index.lock, open_map(self.path) as mapped:
+      self.index.update(mapped)
+      if mapped is not None:
+        position: int = self.index.offset(mapped, max(0, start))
+        ## The regular expression engine reads the map directly
+        for match in pattern.finditer(mapped, position):
+          begin: int = mapped.rfind(b"\n", 0, match.start()) + 1
+          if matches and begin <= matches[-1]["offset"]:
+            ## Another match on the same line
+            continue
+          if len(matches) == limit:
+            following = self.index.number(mapped, begin)
+            break
+          newline: int = mapped.find(b"\n", match.start())
+          end: int = len(mapped) if newline == -1 else newline
+          matches.append({"offset": begin, "number": self.index.number(
+            mapped, begin), "line": decode(mapped[begin:min(end,
+            begin + max_line)])})
+    return {"matches": [{"number": match["number"], "line": \
+      match["line"]} for match in matches], "next": following,
+      "total": self.index.lines}
+
+class LogViewer:
+  """Log files of the managed servers, with their indexes kept in \
+memory once used"""
+  def __init__(
+    self,
+    patterns: tuple[str, ...] = ("Logs/**/*.log", "Logs/**/*.txt",
+      "*.log"),
+    directory: str = index_directory,
+    block: int = 65536,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.patterns: tuple[str, ...] = patterns
+    self.directory: str = directory
+    self.block: int = block
+    self.indexes: dict[str, LineIndex] = {}
+
+  def base(self, server_name: str) -> str:
+    """Directory of the server binary. Raises KeyError for unknown \
+server"""
+    path: str | None = server_section(server_name).get("path")
+    if not path:
+      raise KeyError(server_name)
+    return os.path.dirname(os.path.realpath(path))
+
+  def files(self, server_name: str) -> list[dict]:
+    """Log files of a server, newest first, names relative to the \
+server directory"""
+    base: str = self.base(server_name)
+    paths: set[str] = set()
+    for pattern in self.patterns:
+      paths.update(path for path in glob.glob(os.path.join(base,
+        pattern), recursive = True) if os.path.isfile(path))
+    _return: list[dict] = []
+    for path in paths:
+      stat: os.stat_result = os.stat(path)
+      _return.append({"name": os.path.relpath(path, base).replace(
+        os.sep, "/"), "size": stat.st_size, "modified": stat.st_mtime})
+    return sorted(_return, key = lambda file: file["modified"],
+      reverse = True)
+
+  def open(self, server_name: str, file_name: str) -> LogFile:
+    """One of the files listed for the server. Raises KeyError for \
+anything else"""
+    if file_name not in [file["name"] for file in self.files(
+      server_name)]:
+      raise KeyError(file_name)
+    path: str = os.path.join(self.base(server_name), *file_name.split(
+      "/"))
+    if path not in self.indexes:
+      self.indexes[path] = LineIndex(path, self.directory, self.block)
+    return LogFile(path, self.indexes[path])
+
+  async def read(self, server_name: str, file_name: str, *args,
+    **kwargs) -> dict:
+    """LogFile.read in a worker thread"""
+    return await asyncio.to_thread(lambda: self.open(server_name,
+      file_name).read(*args, **kwargs))
+
+  async def search(self, server_name: str, file_name: str, *args,
+    **kwargs) -> dict:
+    """LogFile.search in a worker thread"""
+    return await asyncio.to_thread(lambda: self.open(server_name,
+      file_name).search(*args, **kwargs))
+
+def get_log_viewer(*args, **kwargs) -> LogViewer:
+  """Log viewer configured by the [logs] section of config.ini"""
+  try:
+    config: ConfigParser = store.get(config_file)
+    return LogViewer(
+      patterns = tuple(pattern.strip() for pattern in config.get("logs",
+        "patterns", fallback = "Logs/**/*.log, Logs/**/*.txt, *.log"
+        ).split(",") if pattern.strip()),
+      directory = config.get("logs", "index_path",
+        fallback = index_directory),
+      block = config.getint("logs", "block", fallback = 65536),
+    )
+  except Exception as e:
+    logger.exception(e)
+  return LogViewer()
+
+log_viewer: LogViewer = get_log_viewer()
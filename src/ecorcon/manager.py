@@ -0,0 +1,139 @@
+"""Eco Server Manager state shared by the web pages and the API"""
+
+import asyncio
+from asyncio.subprocess import Process
+import logging
+from .config import config_file, storage, store
+from .metrics import counter
+from .monitor import Sampler
+from .rcon import responses
+from .server import (
+  server_proper_stop,
+  server_status,
+  server_start,
+  server_stop,
+)
+from .supervisor import Supervisor
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+## Action key: (description, (state while running, function) steps,
+## whether server runs afterwards). Status has no steps.
+server_actions: dict[str, tuple] = {
+  "status": ("Eco Server Status", (), None),
+  "start": ("Start Eco Server", (("starting", server_start),), True),
+  "stop": ("Stop Eco Server", (("stopping", server_proper_stop),),
+    False),
+  "restart": ("Restart Eco Server", (("stopping", server_proper_stop),
+    ("starting", server_start)), True),
+  "kill": ("Advanced - Force Eco Server Stop", (("stopping",
+    server_stop),), False),
+}
+server_states: list[str] = ["stopped", "starting", "running", "stopping"]
+
+action_requests = counter("ecorcon_server_action_requests_total",
+  "Eco server lifecycle action requests", ("action", "result"))
+
+def populate_servers(
+  servers: dict,
+  *args,
+  **kwargs,
+) -> dict:
+  """Adds servers from storage"""
+  try:
+    for server in storage.names("servers"):
+      if server not in servers:
+        servers[server] = None
+  except Exception as e:
+    logger.exception(e)
+  return servers
+
+servers: dict[str, Process | None] = {}
+try:
+  servers = populate_servers(servers)
+except Exception as e:
+  logger.exception(e)
+supervisor: Supervisor = Supervisor(servers)
+sampler: Sampler = Sampler(servers)
+try:
+  sampler = Sampler(
+    servers,
+    interval = store.get(config_file).getfloat("monitor", "interval",
+      fallback = 5.0),
+    size = store.get(config_file).getint("monitor", "history",
+      fallback = 720),
+  )
+except Exception as e:
+  logger.exception(e)
+
+## Server -> state of the step in progress, only during actions
+states: dict[str, str] = {}
+## Server -> (action, task) of the latest requested action
+pending: dict[str, tuple[str, asyncio.Task]] = {}
+
+def is_alive(server_name: str) -> bool:
+  """Whether the server process is running"""
+  process: Process | None = servers.get(server_name)
+  return process is not None and process.returncode is None
+
+def server_state(server_name: str) -> str:
+  """One of `server_states`"""
+  if server_name in states:
+    return states[server_name]
+  if server_name in supervisor.busy:
+    ## Automatic restart after a crash
+    return "starting"
+  return "running" if is_alive(server_name) else "stopped"
+
+async def run_action(
+  server_name: str,
+  action: str,
+  *args,
+  **kwargs,
+) -> dict[str, bool | Process | str | Exception | None]:
+  """Run the steps of `action`, after any other action on the server"""
+  steps, running = server_actions[action][1:]
+  _return: dict = {}
+  ## Tell the supervisor these exits are on purpose
+  async with supervisor.action(server_name, running = running):
+    try:
+      for state, function in steps:
+        states[server_name] = state
+        _return = await function(servers[server_name], server_name)
+        servers[server_name] = _return["process"]
+        if not _return["status"]:
+          break
+    finally:
+      states.pop(server_name, None)
+      ## Answers from before the action describe another process
+      responses.invalidate(server_name)
+  return _return
+
+async def server_action(
+  server_name: str,
+  action: str,
+  *args,
+  **kwargs,
+) -> dict[str, bool | Process | str | Exception | None]:
+  """Run lifecycle action on a managed server. Raises KeyError for \
+unknown server or action. Actions on the same server run one after the \
+other; asking for the action already pending joins it and gets the same \
+result instead of running it twice"""
+  process: Process | None = servers[server_name]
+  steps: tuple = server_actions[action][1]
+  if not steps:
+    return await server_status(process, server_name)
+  action_pending: tuple[str, asyncio.Task] | None = pending.get(
+    server_name)
+  if action_pending is not None and action_pending[0] == action and \
+    not action_pending[1].done():
+    action_requests.inc(action = action, result = "joined")
+    task: asyncio.Task = action_pending[1]
+  else:
+    action_requests.inc(action = action, result = "started")
+    task = asyncio.create_task(run_action(server_name, action))
+    pending[server_name] = (action, task)
+    task.add_done_callback(lambda task: pending.pop(server_name, None) if \
+      pending.get(server_name, (None, None))[1] is task else None)
+  ## The action goes on when the request that asked for it goes away
+  return await asyncio.shield(task)
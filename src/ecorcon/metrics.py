@@ -0,0 +1,202 @@
+"""Prometheus style instrumentation
+
+Plain counters, gauges and histograms kept in dicts and rendered in the
+Prometheus text exposition format, cheap enough to stay enabled.
+"""
+
+from bisect import bisect_left
+import contextlib
+import functools
+import logging
+import math
+import time
+from typing import Callable, Iterator
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+## Seconds, from a cached config lookup to a world save
+default_buckets: tuple[float, ...] = (
+  0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+  30.0, 60.0, 300.0,
+)
+
+def escape(value: str) -> str:
+  """Escape label value"""
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+    '"', '\\"')
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...],
+  extra: str = "") -> str:
+  """Render {name="value",...}"""
+  pairs: list[str] = [f'{name}="{escape(value)}"' for name, value in \
+    zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value: float) -> str:
+  """Render number the way Prometheus expects"""
+  if math.isinf(value):
+    return "+Inf" if value > 0 else "-Inf"
+  if float(value).is_integer():
+    return str(int(value))
+  return repr(float(value))
+
+class Metric:
+  """Base metric, values are keyed by label values"""
+  kind: str = "untyped"
+
+  def __init__(self, name: str, description: str,
+    labels: tuple[str, ...] = (), *args, **kwargs) -> None:
+    self.name: str = name
+    self.description: str = description
+    self.labels: tuple[str, ...] = tuple(labels)
+
+  def key(self, labels: dict[str, str]) -> tuple[str, ...]:
+    """Label values in declared order"""
+    return tuple(str(labels.get(name, "")) for name in self.labels)
+
+  def header(self) -> list[str]:
+    """HELP and TYPE lines"""
+    return [
+      f"# HELP {self.name} {self.description}",
+      f"# TYPE {self.name} {self.kind}",
+    ]
+
+  def render(self) -> list[str]:
+    """Exposition lines"""
+    return self.header()
+
+class Counter(Metric):
+  """Monotonic counter"""
+  kind: str = "counter"
+
+  def __init__(self, *args, **kwargs) -> None:
+    super().__init__(*args, **kwargs)
+    self.values: dict[tuple[str, ...], float] = {}
+
+  def inc(self, amount: float = 1.0, **labels) -> None:
+    """Increase counter"""
+    key: tuple[str, ...] = self.key(labels)
+    self.values[key] = self.values.get(key, 0.0) + amount
+
+  def render(self) -> list[str]:
+    return self.header() + [f"""{self.name}\
+{format_labels(self.labels, key)} {format_value(value)}""" for key, \
+      value in self.values.items()]
+
+class Gauge(Counter):
+  """Value that goes up and down"""
+  kind: str = "gauge"
+
+  def set(self, value: float, **labels) -> None:
+    """Set gauge"""
+    self.values[self.key(labels)] = value
+
+  def dec(self, amount: float = 1.0, **labels) -> None:
+    """Decrease gauge"""
+    self.inc(-amount, **labels)
+
+class Histogram(Metric):
+  """Cumulative histogram with fixed buckets"""
+  kind: str = "histogram"
+
+  def __init__(self, *args, buckets: tuple[float, ...] = default_buckets,
+    **kwargs) -> None:
+    super().__init__(*args, **kwargs)
+    self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+    ## key -> [count per bucket..., count above last bucket, sum]
+    self.values: dict[tuple[str, ...], list[float]] = {}
+
+  def observe(self, value: float, **labels) -> None:
+    """Record one observation"""
+    key: tuple[str, ...] = self.key(labels)
+    counts: list[float] | None = self.values.get(key)
+    if counts is None:
+      counts = [0.0] * (len(self.buckets) + 2)
+      self.values[key] = counts
+    counts[bisect_left(self.buckets, value)] += 1
+    counts[-1] += value
+
+  @contextlib.contextmanager
+  def time(self, **labels) -> Iterator[None]:
+    """Observe how long the block took, exceptions included"""
+    start: float = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, **labels)
+
+  def render(self) -> list[str]:
+    lines: list[str] = self.header()
+    for key, counts in self.values.items():
+      cumulative: float = 0.0
+      for bound, count in zip(self.buckets + (math.inf,), counts[:-1]):
+        cumulative += count
+        lines.append(f"""{self.name}_bucket\
+{format_labels(self.labels, key, f'le="{format_value(bound)}"')} \
+{format_value(cumulative)}""")
+      lines.append(f"""{self.name}_sum{format_labels(self.labels, key)} \
+{format_value(counts[-1])}""")
+      lines.append(f"""{self.name}_count\
+{format_labels(self.labels, key)} {format_value(cumulative)}""")
+    return lines
+
+class Registry:
+  """Every metric of the program. Collectors are callables run at \
+render time to refresh gauges that are cheaper to read than to track"""
+  def __init__(self, *args, **kwargs) -> None:
+    self.metrics: dict[str, Metric] = {}
+    self.collectors: list[Callable[[], None]] = []
+
+  def register(self, metric: Metric) -> Metric:
+    """Add metric, returns the existing one if already registered"""
+    return self.metrics.setdefault(metric.name, metric)
+
+  def collector(self, function: Callable[[], None]) -> Callable[[], None]:
+    """Decorator registering a collector"""
+    self.collectors.append(function)
+    return function
+
+  def render(self) -> str:
+    """Prometheus text exposition format"""
+    for collector in self.collectors:
+      try:
+        collector()
+      except Exception as e:
+        logger.exception(e)
+    lines: list[str] = []
+    for metric in self.metrics.values():
+      lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+registry: Registry = Registry()
+
+def counter(name: str, description: str, labels: tuple[str, ...] = ()
+) -> Counter:
+  """Registered counter"""
+  return registry.register(Counter(name, description, labels))
+
+def gauge(name: str, description: str, labels: tuple[str, ...] = ()
+) -> Gauge:
+  """Registered gauge"""
+  return registry.register(Gauge(name, description, labels))
+
+def histogram(name: str, description: str, labels: tuple[str, ...] = (),
+  buckets: tuple[float, ...] = default_buckets) -> Histogram:
+  """Registered histogram"""
+  return registry.register(Histogram(name, description, labels,
+    buckets = buckets))
+
+def timed(metric: Histogram, **labels) -> Callable:
+  """Decorator observing how long a coroutine function takes"""
+  def decorator(function: Callable) -> Callable:
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+      start: float = time.perf_counter()
+      try:
+        return await function(*args, **kwargs)
+      finally:
+        metric.observe(time.perf_counter() - start, **labels)
+    return wrapper
+  return decorator
@@ -0,0 +1,190 @@
+"""Process and host metrics"""
+
+from array import array
+import asyncio
+from asyncio.subprocess import Process
+import logging
+import psutil
+import sys
+import time
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+process_fields: tuple[str, ...] = (
+  "time",
+  "cpu_percent",
+  "rss",
+  "threads",
+  "handles",
+  "read_bytes",
+  "write_bytes",
+)
+host_fields: tuple[str, ...] = (
+  "time",
+  "cpu_percent",
+  "memory_used",
+  "memory_percent",
+)
+
+class RingBuffer:
+  """Fixed size array of floats, oldest values are overwritten"""
+  def __init__(self, size: int, *args, **kwargs) -> None:
+    self.size: int = max(1, size)
+    self.data: array = array("d", [0.0]) * self.size
+    self.index: int = 0
+    self.count: int = 0
+
+  def append(self, value: float) -> None:
+    """Add value"""
+    self.data[self.index] = value
+    self.index = (self.index + 1) % self.size
+    self.count = min(self.count + 1, self.size)
+
+  def values(self, last: int | None = None) -> list[float]:
+    """Values oldest first, only the `last` ones if given"""
+    count: int = self.count if last is None else \
+      max(0, min(last, self.count))
+    start: int = (self.index - count) % self.size
+    if start + count <= self.size:
+      return self.data[start:start + count].tolist()
+    return self.data[start:].tolist() + \
+      self.data[:start + count - self.size].tolist()
+
+class Series:
+  """One ring buffer per field, appended together"""
+  def __init__(self, fields: tuple[str, ...], size: int, *args,
+    **kwargs) -> None:
+    self.fields: tuple[str, ...] = fields
+    self.buffers: dict[str, RingBuffer] = {field: RingBuffer(size) for \
+      field in fields}
+
+  def append(self, sample: dict[str, float]) -> None:
+    """Add sample, missing fields are stored as zero"""
+    for field, buffer in self.buffers.items():
+      buffer.append(float(sample.get(field, 0.0)))
+
+  def history(self, last: int | None = None) -> dict[str, list[float]]:
+    """Every field, oldest first"""
+    return {field: buffer.values(last) for field, buffer in \
+      self.buffers.items()}
+
+  def latest(self) -> dict[str, float] | None:
+    """Last sample"""
+    if self.buffers[self.fields[0]].count < 1:
+      return None
+    return {field: buffer.values(1)[0] for field, buffer in \
+      self.buffers.items()}
+
+class Sampler:
+  """Periodically samples managed Eco server processes and the host"""
+  def __init__(
+    self,
+    servers: dict[str, Process | None],
+    interval: float = 5.0,
+    size: int = 720,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.servers: dict[str, Process | None] = servers
+    self.interval: float = interval
+    self.size: int = size
+    self.host: Series = Series(host_fields, size)
+    self.series: dict[str, Series] = {}
+    ## cpu_percent compares with the previous call on the same object
+    self.handles: dict[int, psutil.Process] = {}
+
+  def get_handle(self, pid: int) -> psutil.Process:
+    """Cached psutil handle for pid"""
+    if pid not in self.handles:
+      self.handles[pid] = psutil.Process(pid)
+    return self.handles[pid]
+
+  def sample_process(self, pid: int, now: float) -> dict[str, float]:
+    """Sum of metrics for process and its children"""
+    sample: dict[str, float] = {field: 0.0 for field in process_fields}
+    sample["time"] = now
+    root: psutil.Process = self.get_handle(pid)
+    for handle in [root] + [self.get_handle(child.pid) for child in \
+      root.children(recursive = True)]:
+      try:
+        with handle.oneshot():
+          sample["cpu_percent"] += handle.cpu_percent(None)
+          sample["rss"] += handle.memory_info().rss
+          sample["threads"] += handle.num_threads()
+          if sys.platform.startswith("win32"):
+            sample["handles"] += handle.num_handles()
+          else:
+            sample["handles"] += handle.num_fds()
+          try:
+            io = handle.io_counters()
+            sample["read_bytes"] += io.read_bytes
+            sample["write_bytes"] += io.write_bytes
+          except (AttributeError, psutil.AccessDenied):
+            pass
+      except (psutil.NoSuchProcess, psutil.ZombieProcess):
+        self.handles.pop(handle.pid, None)
+    return sample
+
+  def collect(self, pids: dict[str, int]) -> tuple[
+    dict[str, float],
+    dict[str, dict[str, float]],
+  ]:
+    """Sample host and every running server, blocking. Returns \
+(host sample, server samples)"""
+    now: float = time.time()
+    memory = psutil.virtual_memory()
+    host: dict[str, float] = {
+      "time": now,
+      "cpu_percent": psutil.cpu_percent(None),
+      "memory_used": memory.used,
+      "memory_percent": memory.percent,
+    }
+    samples: dict[str, dict[str, float]] = {}
+    for server_name, pid in pids.items():
+      try:
+        samples[server_name] = self.sample_process(pid, now)
+      except psutil.NoSuchProcess:
+        self.handles.pop(pid, None)
+      except Exception as e:
+        logger.exception(e)
+    alive: set[int] = set(pids.values())
+    for pid in list(self.handles):
+      if pid not in alive and not self.handles[pid].is_running():
+        del self.handles[pid]
+    return (host, samples)
+
+  async def sample(self) -> None:
+    """Take one sample without blocking the event loop"""
+    pids: dict[str, int] = {server_name: process.pid for server_name, \
+      process in self.servers.items() if process is not None and \
+      process.returncode is None}
+    host, samples = await asyncio.to_thread(self.collect, pids)
+    ## Buffers are only touched from the event loop
+    self.host.append(host)
+    for server_name, sample in samples.items():
+      if server_name not in self.series:
+        self.series[server_name] = Series(process_fields, self.size)
+      self.series[server_name].append(sample)
+
+  async def run(self) -> None:
+    """Background task"""
+    while True:
+      try:
+        await self.sample()
+      except Exception as e:
+        logger.exception(e)
+      await asyncio.sleep(self.interval)
+
+  def to_dict(self, last: int | None = None) -> dict:
+    """History of everything, JSON friendly"""
+    return {
+      "interval": self.interval,
+      "host": self.host.history(last),
+      "servers": {server_name: series.history(last) for \
+        server_name, series in self.series.items()},
+    }
+
+  def latest(self) -> dict[str, dict[str, float] | None]:
+    """Last sample of every server"""
+    return {server_name: series.latest() for server_name, series in \
+      self.series.items()}
@@ -0,0 +1,168 @@
+"""Pool of authenticated RCON connections"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from typing import AsyncIterator
+from .client import RCONClient
+from .metrics import counter
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+PoolKey = tuple[str, int, str]
+
+connections_opened = counter("ecorcon_rcon_connections_total",
+  "RCON connections opened and authenticated", ("server",))
+
+class RCONPool:
+  """Keeps authenticated RCON sessions warm, keyed by server"""
+  def __init__(
+    self,
+    max_idle: int = 4,
+    idle_timeout: float = 300.0,
+    health_interval: float = 30.0,
+    health_command: str | None = None,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.max_idle: int = max_idle
+    self.idle_timeout: float = idle_timeout
+    self.health_interval: float = health_interval
+    self.health_command: str | None = health_command
+    self.idle: dict[PoolKey, list[tuple[RCONClient, float]]] = {}
+
+  async def checkout(
+    self,
+    key: PoolKey,
+    timeout: float | None = None,
+  ) -> tuple[RCONClient, bool]:
+    """Returns a connected client and whether it was reused"""
+    now: float = time.monotonic()
+    idle: list[tuple[RCONClient, float]] = self.idle.get(key, [])
+    while idle:
+      client, since = idle.pop()
+      if now - since > self.idle_timeout or not client.connected:
+        await client.disconnect()
+        continue
+      if self.health_command is not None and \
+        now - since > self.health_interval:
+        try:
+          await client.command(self.health_command, timeout)
+        except Exception as e:
+          logger.debug(f"Health check failed for {client}: {repr(e)}")
+          await client.disconnect()
+          continue
+      return (client, True)
+    host, port, password = key
+    client = RCONClient(host, password, port = port)
+    await client.connect(timeout)
+    connections_opened.inc(server = f"{host}:{port}")
+    return (client, False)
+
+  async def checkin(self, key: PoolKey, client: RCONClient) -> None:
+    """Return a client to the pool, or close it if the pool is full"""
+    idle: list[tuple[RCONClient, float]] = self.idle.setdefault(key, [])
+    if client.connected and len(idle) < self.max_idle:
+      idle.append((client, time.monotonic()))
+    else:
+      await client.disconnect()
+
+  @contextlib.asynccontextmanager
+  async def acquire(
+    self,
+    host: str,
+    port: int,
+    password: str,
+    timeout: float | None = None,
+  ) -> AsyncIterator[RCONClient]:
+    """Borrow a connected client for exclusive use"""
+    key: PoolKey = (host, port, password)
+    client, _ = await self.checkout(key, timeout)
+    try:
+      yield client
+    except BaseException:
+      await client.disconnect()
+      raise
+    await self.checkin(key, client)
+
+  async def command(
+    self,
+    host: str,
+    port: int,
+    password: str,
+    command: str | list[str],
+    timeout: float | None = None,
+  ) -> str | list[str]:
+    """Send a command, or a list of commands pipelined in one session, \
+through a pooled connection, reconnecting once if a reused connection \
+turned out to be dead"""
+    key: PoolKey = (host, port, password)
+    client, reused = await self.checkout(key, timeout)
+    try:
+      response: str | list[str] = await self.send(client, command,
+        timeout)
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+      await client.disconnect()
+      if not reused:
+        raise
+      logger.info(f"Reconnecting to {client} after {repr(e)}")
+      client, _ = await self.checkout(key, timeout)
+      try:
+        response = await self.send(client, command, timeout)
+      except BaseException:
+        await client.disconnect()
+        raise
+    except BaseException:
+      await client.disconnect()
+      raise
+    await self.checkin(key, client)
+    return response
+
+  async def send(
+    self,
+    client: RCONClient,
+    command: str | list[str],
+    timeout: float | None = None,
+  ) -> str | list[str]:
+    """Dispatch single or batch command to client"""
+    if isinstance(command, str):
+      return await client.command(command, timeout)
+    return await client.commands(command, timeout)
+
+  async def prune(self) -> int:
+    """Close connections idle for too long, returns how many"""
+    now: float = time.monotonic()
+    closed: int = 0
+    for key, idle in list(self.idle.items()):
+      keep: list[tuple[RCONClient, float]] = []
+      for client, since in idle:
+        if now - since > self.idle_timeout or not client.connected:
+          await client.disconnect()
+          closed += 1
+        else:
+          keep.append((client, since))
+      if keep:
+        self.idle[key] = keep
+      else:
+        del self.idle[key]
+    return closed
+
+  async def reaper(self, interval: float = 60.0) -> None:
+    """Background task evicting idle connections"""
+    while True:
+      await asyncio.sleep(interval)
+      try:
+        closed: int = await self.prune()
+        if closed:
+          logger.debug(f"Closed {closed} idle RCON connections")
+      except Exception as e:
+        logger.exception(e)
+
+  async def close(self) -> None:
+    """Close every idle connection"""
+    idle: dict[PoolKey, list[tuple[RCONClient, float]]] = self.idle
+    self.idle = {}
+    for clients in idle.values():
+      for client, _ in clients:
+        await client.disconnect()
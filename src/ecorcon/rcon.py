@@ -1,77 +1,311 @@
 """Remote Console for Eco https://wiki.play.eco/en/RCON"""
 
-## TODO: Add "password" to the config.py module and use the same server 
-## list for RCON.
-
+import asyncio
+from collections import OrderedDict
 from configparser import ConfigParser
 import logging
-from mcrcon import MCRcon
-from .config import config_file
+import time
+from typing import Awaitable, Callable
+from .client import RCONClient
+from .config import config_file, get_servers, server_section, store
+from .metrics import counter, gauge, histogram, registry
+from .pool import RCONPool
 
 logger: logging.Logger = logging.getLogger(__name__)
 
-async def get_mcr(*args, **kwargs) -> MCRcon | None:
-  """Connects to remote console Eco server"""
-  server: str = "127.0.0.1"
-  port: int = 3002
-  password: str = "ididntchangethepassword"
+pool: RCONPool = RCONPool()
+try:
+  _config: ConfigParser = store.get(config_file)
+  pool = RCONPool(
+    max_idle = _config.getint("rcon", "pool_size", fallback = 4),
+    idle_timeout = _config.getfloat("rcon", "idle_timeout",
+      fallback = 300.0),
+    health_interval = _config.getfloat("rcon", "health_interval",
+      fallback = 30.0),
+    health_command = _config.get("rcon", "health_command",
+      fallback = None),
+  )
+except Exception as e:
+  logger.exception(e)
+
+rcon_seconds = histogram("ecorcon_rcon_seconds",
+  "RCON command round-trip time", ("server", "mode"))
+rcon_errors = counter("ecorcon_rcon_errors_total",
+  "Failed RCON commands", ("server",))
+idle_connections = gauge("ecorcon_rcon_idle_connections",
+  "Authenticated RCON connections waiting in the pool", ("server",))
+cache_lookups = counter("ecorcon_rcon_cache_total",
+  "RCON response cache lookups", ("result",))
+cache_entries = gauge("ecorcon_rcon_cache_entries",
+  "RCON responses held by the cache")
+
+def normalize(command: str) -> str:
+  """Single spaces, command in lower case. Arguments keep their case, \
+player names may depend on it"""
+  words: list[str] = command.split()
+  if words:
+    words[0] = words[0].lower()
+  return " ".join(words)
+
+class ResponseCache:
+  """Answers read only commands from memory for a few seconds. Only \
+commands with a ttl are cached, the longest matching command prefix \
+wins, so "/sim" covers "/sim status". Concurrent misses for the same \
+command share one round trip, bounded by the timeout of the first \
+caller. Least recently used entries go first beyond `size`"""
+  def __init__(
+    self,
+    ttls: dict[str, float] | None = None,
+    size: int = 256,
+    enabled: bool = False,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.ttls: dict[str, float] = {normalize(command).lower(): ttl for \
+      command, ttl in (ttls or {}).items() if ttl > 0}
+    self.size: int = max(1, size)
+    self.enabled: bool = enabled
+    ## (server, command) -> (monotonic expiry, response)
+    self.entries: OrderedDict[tuple[str, str], tuple[float, str]] = \
+      OrderedDict()
+    self.pending: dict[tuple[str, str], asyncio.Task] = {}
+
+  def ttl(self, command: str) -> float | None:
+    """Seconds to keep the response, None for commands never cached"""
+    words: list[str] = command.lower().split()
+    for length in range(len(words), 0, -1):
+      ttl: float | None = self.ttls.get(" ".join(words[:length]))
+      if ttl is not None:
+        return ttl
+    return None
+
+  async def get(
+    self,
+    server: str,
+    command: str,
+    fetch: Callable[[], Awaitable[tuple[bool, str]]],
+  ) -> tuple[bool, str]:
+    """Cached response, or the result of `fetch` which is stored when \
+it succeeds"""
+    key: tuple[str, str] = (server, normalize(command))
+    ttl: float | None = self.ttl(key[1])
+    if not self.enabled or ttl is None:
+      return await fetch()
+    entry: tuple[float, str] | None = self.entries.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+      self.entries.move_to_end(key)
+      cache_lookups.inc(result = "hit")
+      return (True, entry[1])
+    task: asyncio.Task | None = self.pending.get(key)
+    if task is None:
+      cache_lookups.inc(result = "miss")
+      task = asyncio.create_task(self.fill(key, ttl, fetch))
+      self.pending[key] = task
+    else:
+      cache_lookups.inc(result = "coalesced")
+    ## A cancelled caller must not cancel the others
+    return await asyncio.shield(task)
+
+  async def fill(
+    self,
+    key: tuple[str, str],
+    ttl: float,
+    fetch: Callable[[], Awaitable[tuple[bool, str]]],
+  ) -> tuple[bool, str]:
+    """One round trip for every waiter, errors are not cached"""
+    try:
+      result: tuple[bool, str] = await fetch()
+      if result[0]:
+        self.entries[key] = (time.monotonic() + ttl, result[1])
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+          self.entries.popitem(last = False)
+      return result
+    finally:
+      self.pending.pop(key, None)
+
+  def invalidate(self, server: str | None = None) -> None:
+    """Forget responses of one server, or of every server"""
+    for key in list(self.entries):
+      if server is None or key[0] == server:
+        del self.entries[key]
+
+def get_response_cache(*args, **kwargs) -> ResponseCache:
+  """Response cache configured by the [rcon] cache options and the \
+command = seconds pairs of the [rcon_cache] section of config.ini"""
   try:
-    config: ConfigParser = ConfigParser()
-    config.read(config_file)
-    server = config.get("rcon")["server"]
-    password = config.get("rcon")["password"]
-    port: int(config.get("rcon")["port"])
-    mcr: MCRcon = MCRcon(server, password, port = port)
+    config: ConfigParser = store.get(config_file)
+    ttls: dict[str, float] = {"/help": 600.0, "/helpful": 600.0}
+    if config.has_section("rcon_cache"):
+      ttls = {command: float(ttl) for command, ttl in \
+        config.items("rcon_cache")}
+    return ResponseCache(
+      ttls = ttls,
+      size = config.getint("rcon", "cache_size", fallback = 256),
+      enabled = config.getboolean("rcon", "cache", fallback = False),
+    )
+  except Exception as e:
+    logger.exception(e)
+  return ResponseCache()
+
+responses: ResponseCache = get_response_cache()
+
+@registry.collector
+def collect_pool() -> None:
+  """Refresh idle connection gauge"""
+  idle_connections.values.clear()
+  for (host, port, _), idle in pool.idle.items():
+    idle_connections.inc(len(idle), server = f"{host}:{port}")
+  cache_entries.set(len(responses.entries))
+
+async def get_settings(
+  *args,
+  server_name: str | None = None,
+  **kwargs,
+) -> dict[str, str | int | float]:
+  """RCON connection settings for `server_name` from the servers \
+configuration file, or from the [rcon] section of the main \
+configuration file when no server is given"""
+  settings: dict[str, str | int | float] = {
+    "server": "127.0.0.1",
+    "port": 3002,
+    "password": "ididntchangethepassword",
+    "timeout": 10.0,
+  }
+  config: ConfigParser = store.get(config_file)
+  settings["server"] = config.get("rcon", "server",
+    fallback = settings["server"])
+  settings["password"] = config.get("rcon", "password",
+    fallback = settings["password"])
+  settings["port"] = config.getint("rcon", "port",
+    fallback = settings["port"])
+  settings["timeout"] = config.getfloat("rcon", "timeout",
+    fallback = settings["timeout"])
+  if server_name is not None:
+    section = server_section(server_name)
+    settings["server"] = section.get("rcon_host", settings["server"])
+    settings["password"] = section.get("password",
+      settings["password"])
+    settings["port"] = section.getint("rcon_port", settings["port"])
+    settings["timeout"] = section.getfloat("rcon_timeout",
+      settings["timeout"])
+  return settings
+
+async def get_mcr(*args, **kwargs) -> RCONClient | None:
+  """Dedicated (not pooled) connection to remote console Eco server"""
+  try:
+    settings: dict[str, str | int | float] = await get_settings(*args,
+      **kwargs)
+    mcr: RCONClient = RCONClient(
+      settings["server"],
+      settings["password"],
+      port = settings["port"],
+      timeout = settings["timeout"],
+    )
     return mcr
   except Exception as e:
     logger.exception(e)
   return None
 
-async def rcon_send(command: str, *args, **kwargs) -> tuple[bool, str]:
-  """Send raw RCON command"""
-  exception: str | None = None
+async def rcon_send(
+  command: str | list[str],
+  *args,
+  cache: bool = True,
+  **kwargs,
+) -> tuple[bool, str | list[str]]:
+  """Send raw RCON command through a pooled connection. A list of \
+commands is pipelined in one session and a list of responses returned. \
+Single read only commands may be answered by the response cache, \
+`cache = False` always asks the server"""
+  if cache and isinstance(command, str):
+    return await responses.get(kwargs.get("server_name") or "default",
+      command, lambda: rcon_request(command, *args, **kwargs))
+  return await rcon_request(command, *args, **kwargs)
+
+async def rcon_request(
+  command: str | list[str],
+  *args,
+  timeout: float | None = None,
+  **kwargs,
+) -> tuple[bool, str | list[str]]:
+  """Send raw RCON command to the server, no cache"""
+  exception: Exception | None = None
+  server: str = kwargs.get("server_name") or "default"
   try:
-    mcr: MCRcon = await get_mcr()
-    try:
-      mcr.connect()
-      response: str = mcr.command(command)
-      return (True, response)
-    except Exception as e:
-      logger.exception(e)
-      exception = e
-    finally:
-      mcr.disconnect()
+    settings: dict[str, str | int | float] = await get_settings(*args,
+      **kwargs)
+    with rcon_seconds.time(server = server, mode = "single" if \
+      isinstance(command, str) else "batch"):
+      response: str | list[str] = await pool.command(
+        settings["server"],
+        settings["port"],
+        settings["password"],
+        command,
+        timeout or settings["timeout"],
+      )
+    return (True, response)
   except Exception as e:
     logger.exception(e)
     exception = e
+    rcon_errors.inc(server = server)
   return (
     False,
     f"Failed to connect to remote Eco server: {repr(exception)}",
   )
 
-async def get_rcon_commands(*args, **kwargs
-) -> tuple[bool, list[tuple]]:
-  """Get RCON Commands"""
-  return (True, [
-    ("", """<EMPTY COMMAND> (send a RAW Commmand in the arguments \
+async def rcon_broadcast(
+  command: str | list[str],
+  server_names: list[str] | None = None,
+  *args,
+  concurrency: int = 8,
+  timeout: float | None = None,
+  **kwargs,
+) -> dict[str, tuple[bool, str | list[str]]]:
+  """Send the same command to many servers concurrently. Defaults to \
+every configured server, at most `concurrency` at a time, each one \
+bounded by `timeout` seconds"""
+  if server_names is None:
+    server_names = list((await get_servers()).keys())
+  semaphore: asyncio.Semaphore = asyncio.Semaphore(max(1, concurrency))
+  async def send(server_name: str) -> tuple[bool, str | list[str]]:
+    """Send to one server"""
+    async with semaphore:
+      try:
+        settings: dict[str, str | int | float] = await get_settings(
+          server_name = server_name)
+        _timeout: float = timeout or settings["timeout"]
+        async with asyncio.timeout(_timeout):
+          return await rcon_send(command, *args,
+            server_name = server_name, timeout = _timeout, **kwargs)
+      except Exception as e:
+        logger.exception(e)
+        return (False, f"""Failed to send command to {server_name}: \
+{repr(e)}""")
+  results: list[tuple[bool, str | list[str]]] = await asyncio.gather(
+    *[send(server_name) for server_name in server_names])
+  return dict(zip(server_names, results))
+
+## Built in commands, until the catalog hears from the server
+rcon_commands: list[tuple[str, str]] = [
+  ("", """<EMPTY COMMAND> (send a RAW Commmand in the arguments \
 textbox below"""),
-    ("/help", """/help (/?) -- Displays all the commands available \
+  ("/help", """/help (/?) -- Displays all the commands available \
 with hidden subcommands. Accepts a string to filter commands to a \
 search string."""),
-    # ~ ("/helpful",
-      # ~ "/helpful -- Shows all help, including sub commands."),
-    # ~ ("/chat", "/chat -- Shows Commands related to chat."),
-    # ~ ("/districts", """/districts -- Shows commands related to \
+  # ~ ("/helpful",
+    # ~ "/helpful -- Shows all help, including sub commands."),
+  # ~ ("/chat", "/chat -- Shows Commands related to chat."),
+  # ~ ("/districts", """/districts -- Shows commands related to \
 # ~ user-defined districts."""),
-    ("/performance", """/performance -- Runs server performance \
+  ("/performance", """/performance -- Runs server performance \
 reports and dump to files. Optionally pass duration in seconds, \
 defaults to 60 seconds."""),
-    ("/profiler", """/profiler -- Shows commands to profile the server \
+  ("/profiler", """/profiler -- Shows commands to profile the server \
 and generate diagnostic data."""),
-    ("/teleport", """/teleport -- List of different teleportation \
+  ("/teleport", """/teleport -- List of different teleportation \
 commands"""),
-    ("/teleport atob", """/teleport atob -- Teleports player A to \
+  ("/teleport atob", """/teleport atob -- Teleports player A to \
 player B"""),
-    ("/teleport targetto", """/teleport targetto -- Teleports \
+  ("/teleport targetto", """/teleport targetto -- Teleports \
 otherPlayer to an xyz coordinate"""),
-  ])
+]
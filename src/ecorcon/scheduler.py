@@ -0,0 +1,465 @@
+"""Scheduled RCON commands and server actions
+
+Schedules are records of the `schedules` storage kind (schedules.ini in
+the instance directory, or the sqlite database). Options:
+
+  action = rcon, or a server action: start, stop, restart, kill
+  server = server name, empty for the [rcon] section with rcon
+  command = RCON command, for rcon
+  cron = minute hour day month weekday, or @hourly @daily...
+  interval = seconds, instead of cron
+  warnings = seconds before each run to announce it, comma separated
+  warning = RCON command announcing it, with {name} {action}
+    {remaining} and {seconds}
+  catch_up = yes to run once after downtime made it miss runs
+  grace = seconds a missed run may be late and still run
+  enabled = no to keep it without running it
+"""
+
+import asyncio
+from collections import deque
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import logging
+import time
+from .config import config_file, Record, storage, store
+from .jobs import Job, jobs
+from .manager import server_action, server_actions
+from .metrics import counter
+from .rcon import rcon_send
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+scheduled_runs = counter("ecorcon_scheduled_runs_total",
+  "Scheduled runs", ("schedule", "result"))
+
+cron_aliases: dict[str, str] = {
+  "@yearly": "0 0 1 1 *",
+  "@annually": "0 0 1 1 *",
+  "@monthly": "0 0 1 * *",
+  "@weekly": "0 0 * * 0",
+  "@daily": "0 0 * * *",
+  "@midnight": "0 0 * * *",
+  "@hourly": "0 * * * *",
+}
+## (minimum, maximum) of minute, hour, day of month, month, weekday
+cron_ranges: list[tuple[int, int]] = [(0, 59), (0, 23), (1, 31), (1, 12),
+  (0, 7)]
+
+def parse_field(field: str, minimum: int, maximum: int) -> set[int]:
+  """Values of one cron field: * a a-b */n a-b/n, comma separated"""
+  values: set[int] = set()
+  for part in field.split(","):
+    expression, _, step = part.partition("/")
+    if expression == "*":
+      start, end = minimum, maximum
+    elif "-" in expression:
+      start, end = [int(value) for value in expression.split("-", 1)]
+    else:
+      start = int(expression)
+      end = maximum if step else start
+    if not minimum <= start <= end <= maximum:
+      raise ValueError(f"{part} is out of range {minimum}-{maximum}")
+    values.update(range(start, end + 1, int(step) if step else 1))
+  return values
+
+class CronExpression:
+  """Five field cron expression in local time. When both day of month \
+and weekday are restricted either one matches, like cron does"""
+  def __init__(self, expression: str, *args, **kwargs) -> None:
+    self.expression: str = expression.strip()
+    fields: list[str] = cron_aliases.get(self.expression,
+      self.expression).split()
+    if len(fields) != 5:
+      raise ValueError(f"""Cron expression needs 5 fields, got \
+{self.expression!r}""")
+    self.minutes, self.hours, self.days, self.months, self.weekdays = [
+      parse_field(field, *limits) for field, limits in zip(fields,
+      cron_ranges)]
+    ## 7 is also sunday
+    if 7 in self.weekdays:
+      self.weekdays = (self.weekdays - {7}) | {0}
+    self.any_day: bool = fields[2] == "*"
+    self.any_weekday: bool = fields[4] == "*"
+
+  def day_matches(self, moment: datetime) -> bool:
+    """Day of month and weekday rules"""
+    day: bool = moment.day in self.days
+    weekday: bool = (moment.weekday() + 1) % 7 in self.weekdays
+    if self.any_day or self.any_weekday:
+      return day and weekday
+    return day or weekday
+
+  def next_after(self, after: float) -> float | None:
+    """First matching minute after the `after` timestamp, skipping \
+whole months, days and hours that can't match"""
+    moment: datetime = datetime.fromtimestamp(after).replace(second = 0,
+      microsecond = 0) + timedelta(minutes = 1)
+    limit: datetime = moment + timedelta(days = 366 * 5)
+    while moment < limit:
+      if moment.month not in self.months:
+        moment = (moment.replace(day = 1, hour = 0, minute = 0) + \
+          timedelta(days = 32)).replace(day = 1)
+      elif not self.day_matches(moment):
+        moment = moment.replace(hour = 0, minute = 0) + timedelta(days = 1)
+      elif moment.hour not in self.hours:
+        moment = moment.replace(minute = 0) + timedelta(hours = 1)
+      elif moment.minute not in self.minutes:
+        moment += timedelta(minutes = 1)
+      else:
+        return moment.timestamp()
+    ## Like February 30th
+    return None
+
+def format_remaining(seconds: float) -> str:
+  """Human readable countdown"""
+  seconds = int(round(seconds))
+  if seconds >= 3600 and seconds % 3600 == 0:
+    return f"{seconds // 3600} hour{'s' if seconds != 3600 else ''}"
+  if seconds >= 60 and seconds % 60 == 0:
+    return f"{seconds // 60} minute{'s' if seconds != 60 else ''}"
+  return f"{seconds} second{'s' if seconds != 1 else ''}"
+
+class Schedule:
+  """One schedule, parsed from its record. Raises ValueError when the \
+record doesn't make sense"""
+  def __init__(
+    self,
+    name: str,
+    record: Record,
+    warning: str = "",
+    grace: float = 3600.0,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.name: str = name
+    self.action: str = record.get("action", "rcon")
+    self.server: str | None = record.get("server") or None
+    self.command: str = record.get("command", "")
+    self.cron: CronExpression | None = None
+    self.interval: float | None = None
+    if record.get("cron") and record.get("interval"):
+      raise ValueError(f"{name}: use either cron or interval, not both")
+    if record.get("cron"):
+      self.cron = CronExpression(record["cron"])
+    elif record.get("interval"):
+      self.interval = float(record["interval"])
+      if self.interval <= 0:
+        raise ValueError(f"{name}: interval must be positive")
+    else:
+      raise ValueError(f"{name}: needs cron or interval")
+    if self.action == "rcon":
+      if not self.command:
+        raise ValueError(f"{name}: rcon needs a command")
+    elif self.action not in server_actions or \
+      not server_actions[self.action][1]:
+      actions: str = ", ".join(action for action, value in \
+        server_actions.items() if value[1])
+      raise ValueError(f"""{name}: unknown action {self.action}, use \
+rcon or one of {actions}""")
+    elif self.server is None:
+      raise ValueError(f"{name}: {self.action} needs a server")
+    self.warnings: list[float] = sorted({float(warning) for warning in \
+      record.get("warnings", "").split(",") if warning.strip()},
+      reverse = True)
+    self.warning: str = record.get("warning", warning)
+    self.catch_up: bool = record.getboolean("catch_up", False)
+    self.grace: float = record.getfloat("grace", grace)
+    self.enabled: bool = record.getboolean("enabled", True)
+    self.created: float = record.getfloat("created", time.time())
+    self.last_run: float | None = record.getfloat("last_run")
+
+  @property
+  def when(self) -> str:
+    """Cron expression or interval, for humans"""
+    if self.cron is not None:
+      return self.cron.expression
+    return f"every {format_remaining(self.interval)}"
+
+  def next_after(self, after: float) -> float | None:
+    """Next run time after the `after` timestamp. Intervals count from \
+the creation time, so restarts don't shift them"""
+    if self.cron is not None:
+      return self.cron.next_after(after)
+    return self.created + ((after - self.created) // self.interval + 1) \
+      * self.interval
+
+  def warning_text(self, seconds: float) -> str:
+    """Announcement `seconds` before a run"""
+    return self.warning.format(
+      name = self.name,
+      action = self.action if self.action != "rcon" else self.command,
+      remaining = format_remaining(seconds),
+      seconds = int(round(seconds)),
+    )
+
+  async def execute(self, *args, **kwargs) -> dict | tuple:
+    """Run it now"""
+    if self.action == "rcon":
+      return await rcon_send(self.command, cache = False,
+        server_name = self.server)
+    return await server_action(self.server, self.action)
+
+class Scheduler:
+  """Keeps one timer heap of upcoming runs and warnings and sleeps until \
+the first one is due. Runs are submitted to the job queue"""
+  def __init__(
+    self,
+    warning: str = "/announce Scheduled {action} in {remaining}",
+    grace: float = 3600.0,
+    history_size: int = 100,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.warning: str = warning
+    self.grace: float = grace
+    self.schedules: dict[str, Schedule] = {}
+    self.errors: dict[str, str] = {}
+    ## (due, sequence, schedule, generation, seconds before a run or None)
+    self.heap: list[tuple[float, int, str, int, float | None]] = []
+    self.sequence: itertools.count = itertools.count()
+    ## Replanning a schedule bumps its generation, older timers are
+    ## skipped when they come up
+    self.generations: dict[str, int] = {}
+    self.next_runs: dict[str, float] = {}
+    self.history: deque[dict] = deque(maxlen = history_size)
+    self.changed: asyncio.Event = asyncio.Event()
+    self.started: bool = False
+    self.tasks: set[asyncio.Task] = set()
+
+  def record(self, schedule: str, **event) -> None:
+    """Add event to history"""
+    event["time"] = time.time()
+    event["schedule"] = schedule
+    self.history.append(event)
+    logger.info(f"Schedule {schedule}: {event}")
+
+  def push(self, due: float, name: str, warning: float | None = None
+  ) -> None:
+    """Add timer"""
+    heapq.heappush(self.heap, (due, next(self.sequence), name,
+      self.generations[name], warning))
+
+  def plan(self, schedule: Schedule, due: float | None) -> None:
+    """Set timers of the run at `due` and its warnings, replacing older \
+ones"""
+    self.drop(schedule.name)
+    if due is None or not schedule.enabled:
+      return
+    self.next_runs[schedule.name] = due
+    self.push(due, schedule.name)
+    now: float = time.time()
+    for warning in schedule.warnings:
+      if due - warning >= now:
+        self.push(due - warning, schedule.name, warning)
+
+  def load(self, name: str) -> None:
+    """(Re)read one schedule from storage and plan its next run. Runs \
+missed since the last one are run once, after the warnings, when \
+`catch_up` is set and they are not older than `grace` seconds"""
+    self.errors.pop(name, None)
+    record: Record | None = storage.get("schedules", name)
+    if record is None:
+      self.schedules.pop(name, None)
+      self.drop(name)
+      return
+    try:
+      schedule: Schedule = Schedule(name, record, self.warning,
+        self.grace)
+    except Exception as e:
+      logger.warning(f"Schedule {name} ignored: {repr(e)}")
+      self.errors[name] = repr(e)
+      self.schedules.pop(name, None)
+      self.drop(name)
+      return
+    self.schedules[name] = schedule
+    now: float = time.time()
+    due: float | None = schedule.next_after(schedule.last_run or \
+      schedule.created)
+    if due is not None and due <= now and schedule.enabled:
+      if schedule.catch_up and now - due <= schedule.grace:
+        self.record(name, event = "catching up", missed = due)
+        due = now + (schedule.warnings[0] if schedule.warnings else 0.0)
+        self.plan(schedule, due)
+        return
+      self.record(name, event = "missed", missed = due)
+      scheduled_runs.inc(schedule = name, result = "missed")
+      due = schedule.next_after(now)
+    self.plan(schedule, due)
+
+  def drop(self, name: str) -> None:
+    """Forget timers of a schedule that is gone"""
+    self.generations[name] = self.generations.get(name, 0) + 1
+    self.next_runs.pop(name, None)
+
+  def reload(self, name: str | None = None) -> None:
+    """Read schedules again after they changed, one or all"""
+    names: list[str] = [name] if name is not None else list(
+      set(storage.names("schedules")) | set(self.schedules))
+    for _name in names:
+      self.load(_name)
+    self.changed.set()
+
+  def fire(self, name: str, due: float, warning: float | None) -> None:
+    """A timer is due"""
+    schedule: Schedule | None = self.schedules.get(name)
+    if schedule is None:
+      return
+    if warning is not None:
+      self.spawn(rcon_send(schedule.warning_text(warning), cache = False,
+        server_name = schedule.server))
+      return
+    now: float = time.time()
+    if now - due > schedule.grace:
+      ## The machine slept or the loop was stuck
+      self.record(name, event = "missed", missed = due)
+      scheduled_runs.inc(schedule = name, result = "missed")
+    else:
+      self.run_now(name)
+    schedule.last_run = due
+    self.spawn(self.save_last_run(name, due))
+    self.plan(schedule, schedule.next_after(max(now, due)))
+
+  def run_now(self, name: str) -> Job:
+    """Submit schedule to the job queue. Raises KeyError for unknown \
+schedule"""
+    schedule: Schedule = self.schedules[name]
+    job: Job = jobs.submit(f"schedule {name}", schedule.execute)
+    self.record(name, event = "started", job = job.id)
+    scheduled_runs.inc(schedule = name, result = "started")
+    return job
+
+  def spawn(self, coroutine) -> None:
+    """Run in the background, keeping a reference until it is done"""
+    task: asyncio.Task = asyncio.create_task(coroutine)
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+  async def save_last_run(self, name: str, due: float) -> None:
+    """Persist last run time, for missed run detection"""
+    def apply(record: Record) -> None:
+      """Set last_run"""
+      record["last_run"] = repr(due)
+    try:
+      if storage.get("schedules", name) is not None:
+        await storage.update("schedules", name, apply)
+    except Exception as e:
+      logger.exception(e)
+
+  async def run(self) -> None:
+    """Background task firing timers as they come due"""
+    self.reload()
+    self.started = True
+    while True:
+      now: float = time.time()
+      while self.heap and self.heap[0][0] <= now:
+        due, _, name, generation, warning = heapq.heappop(self.heap)
+        if self.generations.get(name) == generation:
+          try:
+            self.fire(name, due, warning)
+          except Exception as e:
+            logger.exception(e)
+      ## Timers are wall clock times and the monotonic clock may stop
+      ## while the machine sleeps, so wake up at least every minute
+      timeout: float = 60.0
+      if self.heap:
+        timeout = min(timeout, max(0.0, self.heap[0][0] - time.time()))
+      try:
+        await asyncio.wait_for(self.changed.wait(), timeout)
+      except TimeoutError:
+        pass
+      self.changed.clear()
+
+  def to_list(self) -> list[dict]:
+    """Every schedule, JSON friendly"""
+    _return: list[dict] = []
+    for name in storage.names("schedules"):
+      schedule: Schedule | None = self.schedules.get(name)
+      record: Record = storage.get("schedules", name) or Record()
+      _return.append({
+        "name": name,
+        "options": dict(record),
+        "when": schedule.when if schedule is not None else None,
+        "enabled": schedule.enabled if schedule is not None else False,
+        "next_run": self.next_runs.get(name),
+        "last_run": schedule.last_run if schedule is not None else None,
+        "error": self.errors.get(name),
+      })
+    return _return
+
+def get_scheduler(*args, **kwargs) -> Scheduler:
+  """Scheduler configured by the [scheduler] section of config.ini"""
+  try:
+    config: ConfigParser = store.get(config_file)
+    return Scheduler(
+      warning = config.get("scheduler", "warning", raw = True,
+        fallback = "/announce Scheduled {action} in {remaining}"),
+      grace = config.getfloat("scheduler", "grace", fallback = 3600.0),
+    )
+  except Exception as e:
+    logger.exception(e)
+  return Scheduler()
+
+scheduler: Scheduler = get_scheduler()
+
+async def edit_schedule(
+  name: str,
+  options: dict[str, str],
+  *args,
+  **kwargs,
+) -> dict[str, bool | str | Exception | None]:
+  """Create or replace a schedule. Empty options are left out, the \
+creation and last run times are kept"""
+  _return: dict[str, bool | str | Exception | None] = {
+    "status": False,
+    "message": "Could not edit schedule!",
+    "exception": None,
+  }
+  try:
+    options = {key: str(value).strip() for key, value in \
+      options.items() if value is not None and str(value).strip()}
+    if not name or any(character in name for character in "[]\n"):
+      raise ValueError(f"Invalid schedule name {name!r}")
+    ## Raises ValueError with the reason
+    Schedule(name, Record(options))
+    def apply(record: Record) -> None:
+      """Replace options"""
+      kept: dict[str, str] = {key: record[key] for key in \
+        ["created", "last_run"] if key in record}
+      record.clear()
+      record.update(options)
+      record.setdefault("created", repr(time.time()))
+      record.update(kept)
+    await storage.update("schedules", name, apply)
+    if scheduler.started:
+      scheduler.reload(name)
+    _return["message"] = f"Schedule {name} saved."
+    _return["status"] = True
+  except Exception as e:
+    logger.exception(e)
+    _return["exception"] = e
+  return _return
+
+async def delete_schedule(
+  name: str,
+  *args,
+  **kwargs,
+) -> dict[str, bool | str | Exception | None]:
+  """Remove a schedule and its timers"""
+  _return: dict[str, bool | str | Exception | None] = {
+    "status": False,
+    "message": "Could not delete schedule!",
+    "exception": None,
+  }
+  try:
+    await storage.delete("schedules", name)
+    if scheduler.started:
+      scheduler.reload(name)
+    _return["message"] = f"Schedule {name} deleted."
+    _return["status"] = True
+  except Exception as e:
+    logger.exception(e)
+    _return["exception"] = e
+  return _return
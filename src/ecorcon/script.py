@@ -1,32 +1,84 @@
 """Script Manager"""
 
+import asyncio
 from configparser import ConfigParser
 import logging
 import os
-import subprocess
+import psutil
 import sys
 from . import name
+from .console import ConsoleBuffer, pump
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+def kill_tree(pid: int) -> None:
+  """Kill process and everything it started, children keep the output \
+pipe open otherwise"""
+  try:
+    parent: psutil.Process = psutil.Process(pid)
+    for process in parent.children(recursive = True) + [parent]:
+      try:
+        process.kill()
+      except psutil.NoSuchProcess:
+        pass
+  except psutil.NoSuchProcess:
+    pass
+
+async def communicate(
+  process: asyncio.subprocess.Process,
+  output: ConsoleBuffer | None = None,
+) -> str | None:
+  """Wait for process to exit. Output is streamed line by line to \
+`output` when given, only the last lines it holds are kept. Otherwise \
+the whole output is returned. The process tree is killed if the caller \
+is cancelled"""
+  try:
+    if output is None:
+      return (await process.communicate())[0].decode("utf8", "replace")
+    await pump(process.stdout, output)
+    await process.wait()
+    output.append(f"### exit code {process.returncode}")
+    return None
+  except asyncio.CancelledError:
+    if process.returncode is None:
+      kill_tree(process.pid)
+      await process.wait()
+    if output is not None:
+      output.append("### cancelled")
+    raise
+
 async def run_subprocess(
   script: list[str],
   message_sucess: str,
   message_failure: str,
   *args,
+  output: ConsoleBuffer | None = None,
   **kwargs,
-) -> dict[str, bool | str | Exception | None]:
-  """Run subprocess"""
-  _return: dict[str, bool | str | Exception | None] = {
+) -> dict[str, bool | int | str | Exception | None]:
+  """Run script without blocking the event loop. Output goes line by \
+line to `output` if given, otherwise it is returned at the end"""
+  _return: dict[str, bool | int | str | Exception | None] = {
     "status": False,
     "message": message_failure,
+    "output": None,
+    "returncode": None,
     "exception": None,
   }
   try:
-    process_result: str = subprocess.run(os.path.join("scripts", 
-      *script))
-    _return["message"] = f"{message_sucess}: {process_result}"
-    _return["status"] = True
+    process: asyncio.subprocess.Process = \
+      await asyncio.create_subprocess_exec(
+        os.path.join("scripts", *script),
+        stdout = asyncio.subprocess.PIPE,
+        stderr = asyncio.subprocess.STDOUT,
+      )
+    _return["output"] = await communicate(process, output)
+    _return["returncode"] = process.returncode
+    if process.returncode == 0:
+      _return["message"] = f"{message_sucess} (exit code 0)"
+      _return["status"] = True
+    else:
+      _return["message"] = f"""{message_failure} (exit code \
+{process.returncode})"""
   except Exception as e:
     logger.exception(e)
     _return["exception"] = e
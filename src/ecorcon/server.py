@@ -1,34 +1,91 @@
 """Server Manager for Eco https://wiki.play.eco/en/Server"""
 
-from configparser import ConfigParser
+import asyncio
+from asyncio.subprocess import Process
 import logging
 import os
 import signal
 import subprocess
-from subprocess import Popen
 import sys
-from .config import servers_file
+from .config import server_section
+from .console import ConsoleBuffer, get_console, pump
+from .metrics import histogram, timed
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+## Seconds to wait for a graceful stop before terminating, and then for
+## terminate before killing. Eco can take minutes saving the world.
+stop_timeout: float = 300.0
+kill_timeout: float = 30.0
+## Tasks copying each server output to its console buffer
+readers: dict[str, asyncio.Task] = {}
+
+action_seconds = histogram("ecorcon_server_action_seconds",
+  "Eco server lifecycle action time", ("action",))
+
 async def get_path(server_name: str, *args, **kwargs) -> str | None:
   """Configuration for server manager"""
   try:
-    config: ConfigParser = ConfigParser()
-    config.read(servers_file)
-    return config[server_name].get("path")
+    return server_section(server_name).get("path")
   except Exception as e:
     logger.exception(e)
   return None
 
+async def get_timeouts(server_name: str | None, *args, **kwargs
+) -> tuple[float, float]:
+  """Graceful stop and terminate timeouts for server"""
+  try:
+    if server_name is not None:
+      section = server_section(server_name)
+      return (
+        section.getfloat("stop_timeout", stop_timeout),
+        section.getfloat("kill_timeout", kill_timeout),
+      )
+  except Exception as e:
+    logger.exception(e)
+  return (stop_timeout, kill_timeout)
+
+async def wait_process(process: Process, timeout: float) -> bool:
+  """Wait for process to exit, False on timeout"""
+  try:
+    await asyncio.wait_for(process.wait(), timeout)
+    return True
+  except TimeoutError:
+    return False
+
+async def capture_output(process: Process, server_name: str) -> None:
+  """Copy process output to the server console buffer"""
+  maxlen: int = 5000
+  try:
+    maxlen = server_section(server_name).getint(
+      "console_lines", maxlen)
+  except Exception as e:
+    logger.exception(e)
+  buffer: ConsoleBuffer = get_console(server_name, maxlen)
+  buffer.append(f"""### {server_name} started with process id \
+{process.pid}""")
+  readers[server_name] = asyncio.create_task(follow_output(process,
+    server_name, buffer))
+
+async def follow_output(
+  process: Process,
+  server_name: str,
+  buffer: ConsoleBuffer,
+) -> None:
+  """Pump output until the process closes it, then log exit code"""
+  await pump(process.stdout, buffer)
+  await process.wait()
+  buffer.append(f"""### {server_name} exited with code \
+{process.returncode}""")
+
 async def send_signal(
-  process: Popen,
+  process: Process,
   _signal: int,
   *args,
   **kwargs,
-) -> dict[str, bool | Popen | str | Exception | None]:
+) -> dict[str, bool | Process | str | Exception | None]:
   """Send signal to subprocess"""
-  _return: dict[str, bool | Popen | str | Exception | None] = {
+  _return: dict[str, bool | Process | str | Exception | None] = {
     "status": False,
     "process": process,
     "message": "Failed to send signal to server!",
@@ -44,19 +101,19 @@ async def send_signal(
   return _return
 
 async def server_status(
-  process: Popen,
+  process: Process,
   *args,
   **kwargs,
-) -> dict[str, bool | Popen | str | Exception | None]:
+) -> dict[str, bool | Process | str | Exception | None]:
   """Returns server status"""
-  _return: dict[str, bool | Popen | str | Exception | None] = {
+  _return: dict[str, bool | Process | str | Exception | None] = {
     "status": False,
     "process": process,
     "message": "Failed to get server status!",
     "exception": None,
   }
   try:
-    if _return["process"].poll() is None:
+    if _return["process"].returncode is None:
       _return["message"] = "Server seems to be runing AFAIK"
       _return["status"] = True
     else:
@@ -68,14 +125,15 @@ async def server_status(
     _return["exception"] = e
   return _return
 
+@timed(action_seconds, action = "start")
 async def server_start(
-  process: Popen,
+  process: Process,
   server_name: str,
   *args,
   **kwargs,
-) -> dict[str, bool | Popen | str | Exception | None]:
+) -> dict[str, bool | Process | str | Exception | None]:
   """Starts server if not started"""
-  _return: dict[str, bool | Popen | str | Exception | None] = {
+  _return: dict[str, bool | Process | str | Exception | None] = {
     "status": False,
     "process": process,
     "message": "Could not start server!",
@@ -86,13 +144,20 @@ async def server_start(
     if not _return["status"]:
       path: str = await get_path(server_name, *args, **kwargs)
       if sys.platform.startswith('win32'):
-        _return["process"] = Popen(
-          [path],
+        _return["process"] = await asyncio.create_subprocess_exec(
+          path,
           cwd = os.path.dirname(os.path.realpath(path)),
           creationflags = subprocess.CREATE_NEW_PROCESS_GROUP,
+          stdout = asyncio.subprocess.PIPE,
+          stderr = asyncio.subprocess.STDOUT,
         )
       else:
-        _return["process"] = Popen([path])
+        _return["process"] = await asyncio.create_subprocess_exec(
+          path,
+          stdout = asyncio.subprocess.PIPE,
+          stderr = asyncio.subprocess.STDOUT,
+        )
+      await capture_output(_return["process"], server_name)
       _return["status"] = True
       _return["message"] = "Server started!"
     else:
@@ -103,24 +168,43 @@ already running!"""
     _return["exception"] = e
   return _return
 
+@timed(action_seconds, action = "proper_stop")
 async def server_proper_stop(
-  process: Popen,
+  process: Process,
+  server_name: str | None = None,
   *args,
   **kwargs,
-) -> dict[str, bool | Popen | str | Exception | None]:
-  """Stops server the proper way (tm)"""
-  _return: dict[str, bool | Popen | str | Exception | None] = {
+) -> dict[str, bool | Process | str | Exception | None]:
+  """Stops server the proper way (tm), escalating to terminate and \
+then kill when it takes longer than the configured timeouts"""
+  _return: dict[str, bool | Process | str | Exception | None] = {
     "status": False,
     "process": process,
     "message": "Failed to stop server!",
     "exception": None,
   }
   try:
-    _return = await send_break(_return["process"], *args, **kwargs)
-    _return["message"] = f"""Server stopped: \
-{_return["process"].communicate()}"""
+    if process is None or process.returncode is not None:
+      raise AttributeError("Server process is not running")
+    _stop_timeout, _kill_timeout = await get_timeouts(server_name)
+    _return = await send_break(process, *args, **kwargs)
+    if await wait_process(process, _stop_timeout):
+      _return["message"] = f"""Server stopped with exit code \
+{process.returncode}"""
+    else:
+      logger.warning(f"""{server_name} did not stop after \
+{_stop_timeout} seconds, terminating""")
+      process.terminate()
+      if not await wait_process(process, _kill_timeout):
+        logger.warning(f"""{server_name} did not terminate after \
+{_kill_timeout} seconds, killing""")
+        process.kill()
+        await process.wait()
+      _return["message"] = f"""Server did not stop in time and was \
+forcefully stopped with exit code {process.returncode}"""
+    _return["process"] = process
     _return["status"] = True
-  except AttributeError as e:
+  except (AttributeError, ProcessLookupError) as e:
     logger.exception(e)
     _return["message"] = """Couldn't stop the server because the \
 server was likely not started to begin with."""
@@ -131,56 +215,66 @@ server was likely not started to begin with."""
     _return["exception"] = e
   return _return
 
+@timed(action_seconds, action = "stop")
 async def server_stop(
-  process: Popen,
+  process: Process,
+  server_name: str | None = None,
   *args,
   **kwargs,
-) -> dict[str, bool | Popen | str | Exception | None]:
+) -> dict[str, bool | Process | str | Exception | None]:
   """Stops server if started"""
-  _return: dict[str, bool | Popen | str | Exception | None] = {
+  _return: dict[str, bool | Process | str | Exception | None] = {
     "status": False,
     "process": process,
     "message": "Failed to Terminate server!",
     "exception": None,
   }
   try:
-    _return["message"] = f"""Server Terminated: \
-{_return["process"].terminate()}"""
+    _, _kill_timeout = await get_timeouts(server_name)
+    _return["process"].terminate()
+    if not await wait_process(_return["process"], _kill_timeout):
+      _return["process"].kill()
+      await _return["process"].wait()
+    _return["message"] = f"""Server Terminated with exit code \
+{_return["process"].returncode}"""
     _return["status"] = True
   except Exception as e:
     logger.exception(e)
     _return["exception"] = e
   return _return
 
+@timed(action_seconds, action = "restart")
 async def server_restart(
-  process: Popen,
+  process: Process,
+  server_name: str | None = None,
   *args,
   **kwargs,
-) -> dict[str, bool | Popen | str | Exception | None]:
+) -> dict[str, bool | Process | str | Exception | None]:
   """Performs a stop then a start"""
-  _return: dict[str, bool | Popen | str | Exception | None] = {
+  _return: dict[str, bool | Process | str | Exception | None] = {
     "status": False,
     "process": process,
     "message": "Failed to restart server!",
     "exception": None,
   }
   try:
-    _return = await server_proper_stop(_return["process"], *args,
-      **kwargs)
+    _return = await server_proper_stop(_return["process"], server_name,
+      *args, **kwargs)
     if _return["status"]:
-      return await server_start(_return["process"], *args, **kwargs)
+      return await server_start(_return["process"], server_name, *args,
+        **kwargs)
   except Exception as e:
     logger.exception(e)
     _return["exception"] = e
   return _return
 
 async def send_ctrlc(
-  process: Popen,
+  process: Process,
   *args,
   **kwargs,
-) -> dict[str, bool | Popen | str | Exception | None]:
+) -> dict[str, bool | Process | str | Exception | None]:
   """Send CTRL+C to subprocess"""
-  _return: dict[str, bool | Popen | str | Exception | None] = {
+  _return: dict[str, bool | Process | str | Exception | None] = {
     "status": False,
     "process": process,
     "message": "Failed to send signal to server!",
@@ -200,12 +294,12 @@ async def send_ctrlc(
   return _return
 
 async def send_break(
-  process: Popen,
+  process: Process,
   *args,
   **kwargs,
-) -> dict[str, bool | Popen | str | Exception | None]:
+) -> dict[str, bool | Process | str | Exception | None]:
   """Send CTRL+BREAK to subprocess"""
-  _return: dict[str, bool | Popen | str | Exception | None] = {
+  _return: dict[str, bool | Process | str | Exception | None] = {
     "status": False,
     "process": process,
     "message": "Failed to send signal to server!",
@@ -216,7 +310,8 @@ async def send_break(
     if sys.platform.startswith("win32"):
       _signal = signal.CTRL_BREAK_EVENT
     else:
-      _signal = signal.SIGBREAK
+      ## There is no SIGBREAK outside Windows, Eco saves on SIGINT
+      _signal = signal.SIGINT
     return await send_signal(_return["process"], _signal, *args,
       **kwargs)
   except Exception as e:
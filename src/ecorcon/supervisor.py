@@ -0,0 +1,228 @@
+"""Eco server crash detection and automatic restart"""
+
+import asyncio
+from asyncio.subprocess import Process
+from collections import deque
+from configparser import ConfigParser
+import contextlib
+import logging
+import time
+from typing import AsyncIterator
+from .config import server_section
+from .metrics import counter
+from .rcon import responses
+from .server import server_start
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+crashes = counter("ecorcon_server_crashes_total",
+  "Unexpected Eco server exits", ("server",))
+restarts = counter("ecorcon_server_restarts_total",
+  "Automatic Eco server restarts", ("server", "result"))
+
+class Policy:
+  """Restart policy of one server, from its servers.ini section. \
+Restarts by default when the server starts on boot"""
+  def __init__(self, server_name: str, *args, **kwargs) -> None:
+    self.section: dict = {}
+    try:
+      self.section = server_section(server_name)
+    except KeyError:
+      pass
+    self.restart: bool = self.get("restart", self.get("boot", False))
+    self.max_restarts: int = self.get("max_restarts", 5)
+    self.window: float = self.get("restart_window", 3600.0)
+    self.backoff_initial: float = self.get("backoff_initial", 5.0)
+    self.backoff_max: float = self.get("backoff_max", 300.0)
+    ## Uptime after which a crash is not counted as a crash loop
+    self.stable_after: float = self.get("stable_after", 600.0)
+
+  def get(self, key: str, fallback: bool | int | float
+  ) -> bool | int | float:
+    """Option converted to the type of `fallback`, booleans like \
+ConfigParser. Invalid values are logged and give `fallback`"""
+    value: str | bool | int | float = self.section.get(key, fallback)
+    try:
+      if isinstance(fallback, bool):
+        return value if isinstance(value, bool) else \
+          ConfigParser.BOOLEAN_STATES[str(value).strip().lower()]
+      return type(fallback)(value)
+    except (KeyError, ValueError):
+      logger.warning(f"Invalid {key} = {value!r}, using {fallback!r}")
+      return fallback
+
+  def backoff(self, attempt: int) -> float:
+    """Exponential delay before restart number `attempt`"""
+    return min(self.backoff_max,
+      self.backoff_initial * 2 ** max(0, attempt - 1))
+
+class Supervisor:
+  """Awaits every managed server process and restarts the ones that \
+exit while they are supposed to be running"""
+  def __init__(
+    self,
+    servers: dict[str, Process | None],
+    history_size: int = 50,
+    *args,
+    **kwargs,
+  ) -> None:
+    self.servers: dict[str, Process | None] = servers
+    self.desired: dict[str, bool] = {}
+    self.busy: set[str] = set()
+    ## One lifecycle change at a time per server
+    self.locks: dict[str, asyncio.Lock] = {}
+    self.history: dict[str, deque[dict]] = {}
+    self.history_size: int = history_size
+    self.attempts: dict[str, int] = {}
+    self.restart_times: dict[str, deque[float]] = {}
+    self.seen: dict[str, tuple[Process, float]] = {}
+    self.watchers: dict[str, asyncio.Task] = {}
+    self.event: asyncio.Event = asyncio.Event()
+
+  def notify(self) -> None:
+    """Wake up watchers after servers or desired state changed"""
+    event: asyncio.Event = self.event
+    self.event = asyncio.Event()
+    event.set()
+
+  async def changed(self) -> None:
+    """Wait for next notify"""
+    await self.event.wait()
+
+  def lock(self, server_name: str) -> asyncio.Lock:
+    """Held while the server is being started or stopped"""
+    if server_name not in self.locks:
+      self.locks[server_name] = asyncio.Lock()
+    return self.locks[server_name]
+
+  @contextlib.asynccontextmanager
+  async def action(self, server_name: str, running: bool
+  ) -> AsyncIterator[None]:
+    """Manual start / stop / restart in progress, exits during it are \
+expected. Afterwards the server is supposed to be `running` or not. \
+Waits for any other action on the same server to finish first"""
+    async with self.lock(server_name):
+      self.busy.add(server_name)
+      try:
+        yield
+      finally:
+        self.busy.discard(server_name)
+        self.desired[server_name] = running
+        if running:
+          ## Admin intervention resets crash loop protection
+          self.attempts[server_name] = 0
+          self.restart_times.pop(server_name, None)
+        self.notify()
+
+  def record(self, server_name: str, **event) -> None:
+    """Add event to restart history"""
+    if server_name not in self.history:
+      self.history[server_name] = deque(maxlen = self.history_size)
+    event["time"] = time.time()
+    self.history[server_name].append(event)
+    logger.info(f"{server_name}: {event}")
+
+  def uptime(self, server_name: str, process: Process) -> float:
+    """Seconds since the process was first seen"""
+    seen: tuple[Process, float] | None = self.seen.get(server_name)
+    if seen is None or seen[0] is not process:
+      return 0.0
+    return time.monotonic() - seen[1]
+
+  async def watch(self, server_name: str) -> None:
+    """Supervise one server forever"""
+    while True:
+      process: Process | None = self.servers.get(server_name)
+      if process is None or process.returncode is not None or \
+        server_name in self.busy:
+        await self.changed()
+        continue
+      if self.seen.get(server_name, (None,))[0] is not process:
+        self.seen[server_name] = (process, time.monotonic())
+      waiter: asyncio.Task = asyncio.create_task(process.wait())
+      change: asyncio.Task = asyncio.create_task(self.changed())
+      try:
+        await asyncio.wait([waiter, change],
+          return_when = asyncio.FIRST_COMPLETED)
+      finally:
+        waiter.cancel()
+        change.cancel()
+      if process.returncode is None:
+        ## Something else changed, look again
+        continue
+      if server_name in self.busy or \
+        self.servers.get(server_name) is not process or \
+        not self.desired.get(server_name, False):
+        continue
+      await self.crashed(server_name, process)
+
+  async def crashed(self, server_name: str, process: Process) -> None:
+    """Handle unexpected exit, restarting according to policy"""
+    policy: Policy = Policy(server_name)
+    uptime: float = self.uptime(server_name, process)
+    crashes.inc(server = server_name)
+    if not policy.restart:
+      self.record(server_name, event = "crashed",
+        exit_code = process.returncode, uptime = uptime)
+      self.desired[server_name] = False
+      return
+    if uptime >= policy.stable_after:
+      self.attempts[server_name] = 0
+    self.record(server_name, event = "crashed",
+      exit_code = process.returncode, uptime = uptime)
+    times: deque[float] = self.restart_times.setdefault(server_name,
+      deque())
+    while True:
+      now: float = time.monotonic()
+      while times and now - times[0] > policy.window:
+        times.popleft()
+      if len(times) >= policy.max_restarts:
+        self.record(server_name, event = "gave up",
+          reason = f"""{len(times)} restarts in the last \
+{policy.window:.0f} seconds""")
+        restarts.inc(server = server_name, result = "gave up")
+        self.desired[server_name] = False
+        return
+      self.attempts[server_name] = self.attempts.get(server_name, 0) + 1
+      delay: float = policy.backoff(self.attempts[server_name])
+      self.record(server_name, event = "restarting", restart_in = delay,
+        attempt = self.attempts[server_name])
+      await asyncio.sleep(delay)
+      async with self.lock(server_name):
+        if self.servers.get(server_name) is not process or \
+          not self.desired.get(server_name, False):
+          ## Somebody took over while we waited
+          return
+        times.append(time.monotonic())
+        self.busy.add(server_name)
+        try:
+          _return: dict = await server_start(None, server_name)
+          if _return["status"]:
+            self.servers[server_name] = _return["process"]
+        finally:
+          self.busy.discard(server_name)
+          responses.invalidate(server_name)
+      if _return["status"]:
+        self.record(server_name, event = "restarted",
+          attempt = self.attempts[server_name])
+        restarts.inc(server = server_name, result = "restarted")
+        self.notify()
+        return
+      self.record(server_name, event = "restart failed",
+        reason = repr(_return["exception"]))
+      restarts.inc(server = server_name, result = "failed")
+
+  async def run(self) -> None:
+    """Background task keeping one watcher per managed server"""
+    try:
+      while True:
+        for server_name in list(self.servers):
+          if server_name not in self.watchers or \
+            self.watchers[server_name].done():
+            self.watchers[server_name] = asyncio.create_task(
+              self.watch(server_name))
+        await self.changed()
+    finally:
+      for watcher in self.watchers.values():
+        watcher.cancel()
+      self.watchers.clear()
@@ -1,5 +1,6 @@
 """Windows Manager"""
 
+import asyncio
 from configparser import ConfigParser
 import logging
 import os
@@ -7,6 +8,8 @@ import psutil
 import signal
 import subprocess
 import sys
+from .console import ConsoleBuffer
+from .script import communicate
 
 logger: logging.Logger = logging.getLogger(__name__)
 
@@ -20,12 +23,22 @@ async def run_subprocess(command: list[str], *args, **kwargs) -> str:
 async def send_system(
   command: str,
   *args,
+  output: ConsoleBuffer | None = None,
   **kwargs,
 ) -> tuple[bool, str]:
-  """Send command to Operational System"""
+  """Send command to Operational System without blocking the event \
+loop, output streamed to `output` if given"""
   exception: Exception | None = None
   try:
-    return (True, f"Command sent\n{os.system(command)}")
+    process: asyncio.subprocess.Process = \
+      await asyncio.create_subprocess_shell(
+        command,
+        stdout = asyncio.subprocess.PIPE,
+        stderr = asyncio.subprocess.STDOUT,
+      )
+    text: str | None = await communicate(process, output)
+    return (process.returncode == 0, f"""Command sent, exit code \
+{process.returncode}\n{text or ''}""")
   except Exception as e:
     logger.exception(e)
     exception = e
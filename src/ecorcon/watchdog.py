@@ -0,0 +1,132 @@
+"""Watchdog keeping ecorcon itself running"""
+
+from collections import deque
+from configparser import ConfigParser
+import logging
+import os
+import random
+import signal
+import subprocess
+from subprocess import Popen
+import sys
+import time
+from .config import config_file, store
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+class Watchdog:
+  """Runs ecorcon as a child process and starts it again when it exits. \
+Waits on the child instead of polling, sleeps an exponential backoff \
+with jitter between restarts and never restarts more than \
+`max_restarts` times in `restart_window` seconds"""
+  def __init__(self, path: str = config_file, *args, **kwargs) -> None:
+    self.path: str = path
+    self.process: Popen | None = None
+    self.attempt: int = 0
+    self.restart_times: deque[float] = deque()
+
+  @property
+  def config(self) -> ConfigParser:
+    """Configuration, parsed again only when the file changes"""
+    return store.get(self.path)
+
+  def get(self, key: str, fallback: float) -> float:
+    """Number from the watchdog section"""
+    try:
+      return self.config.getfloat("watchdog", key, fallback = fallback)
+    except ValueError as e:
+      logger.warning(f"Invalid watchdog {key}: {repr(e)}")
+      return fallback
+
+  def get_command(self) -> list[str]:
+    """Command starting ecorcon. The [watchdog] command option wins, \
+then the start script for the [script] method on Windows, then the \
+current python interpreter"""
+    command: str | None = self.config.get("watchdog", "command",
+      fallback = None)
+    if command:
+      return command.split()
+    method: str = self.config.get("script", "method", fallback = "venv")
+    script: str = os.path.join(os.getcwd(), "scripts",
+      f"start-{method}.bat")
+    if sys.platform.startswith("win32") and os.path.exists(script):
+      return [script]
+    return [sys.executable, "-m", "ecorcon"]
+
+  def spawn(self) -> Popen:
+    """Start child"""
+    kwargs: dict = {}
+    if sys.platform.startswith("win32"):
+      kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    command: list[str] = self.get_command()
+    logger.info(f"Starting {' '.join(command)}")
+    return Popen(command, cwd = os.getcwd(), **kwargs)
+
+  def backoff(self) -> float:
+    """Delay before the next restart, exponential with jitter so a \
+broken install doesn't turn into a restart storm"""
+    initial: float = self.get("backoff_initial", 1.0)
+    maximum: float = self.get("backoff_max", 60.0)
+    delay: float = min(maximum, initial * 2 ** max(0, self.attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+  def rate_limit(self) -> float:
+    """Seconds to wait so the restart rate stays under the cap"""
+    window: float = self.get("restart_window", 600.0)
+    max_restarts: int = max(1, int(self.get("max_restarts", 10)))
+    now: float = time.monotonic()
+    while self.restart_times and now - self.restart_times[0] > window:
+      self.restart_times.popleft()
+    if len(self.restart_times) < max_restarts:
+      return 0.0
+    return self.restart_times[0] + window - now
+
+  def stop(self) -> None:
+    """Stop child, forcefully if it doesn't exit in time"""
+    if self.process is None or self.process.poll() is not None:
+      return
+    logger.info("Stopping child...")
+    self.process.terminate()
+    try:
+      self.process.wait(self.get("kill_timeout", 30.0))
+    except subprocess.TimeoutExpired:
+      logger.warning("Child didn't stop, killing it")
+      self.process.kill()
+      self.process.wait()
+
+  def run(self) -> None:
+    """Watch forever"""
+    while True:
+      try:
+        self.process = self.spawn()
+      except Exception as e:
+        logger.exception(e)
+        self.process = None
+      started: float = time.monotonic()
+      returncode: int | None = self.process.wait() if \
+        self.process is not None else None
+      uptime: float = time.monotonic() - started
+      if uptime >= self.get("stable_after", 60.0):
+        self.attempt = 0
+      self.attempt += 1
+      delay: float = max(self.backoff(), self.rate_limit())
+      logger.warning(f"""ecorcon exited with code {returncode} after \
+{uptime:.1f} seconds, restart #{self.attempt} in {delay:.1f} seconds""")
+      time.sleep(delay)
+      self.restart_times.append(time.monotonic())
+
+def terminate(signum: int, frame) -> None:
+  """SIGTERM handler"""
+  raise SystemExit(128 + signum)
+
+def main(*args, **kwargs) -> None:
+  """Run watchdog until interrupted"""
+  if not sys.platform.startswith("win32"):
+    signal.signal(signal.SIGTERM, terminate)
+  watchdog: Watchdog = Watchdog()
+  try:
+    watchdog.run()
+  except (KeyboardInterrupt, SystemExit):
+    logger.info("Watchdog interrupted")
+  finally:
+    watchdog.stop()
@@ -5,16 +5,21 @@ from quart import (
   # ~ current_app,
   flash,
   flask_patch,
+  g,
   jsonify,
   Quart,
   render_template,
   request,
   render_template_string,
+  websocket,
 )
+from quart.signals import before_render_template, template_rendered
 from flask_wtf import FlaskForm
 
 import asyncio
-from argon2 import PasswordHasher
+from asyncio.subprocess import Process
+from contextvars import ContextVar
+from datetime import datetime
 from argon2.exceptions import VerifyMismatchError
 from configparser import ConfigParser, NoSectionError
 from jinja2 import TemplateNotFound
@@ -30,12 +35,11 @@ from quart_auth import (
   current_user,
 )
 import secrets
-import subprocess
-from subprocess import Popen
+import time
 from wtforms import (
   Form,
   # ~ HiddenField,
-  # ~ IntegerField,
+  IntegerField,
   PasswordField,
   RadioField,
   # ~ SelectField,
@@ -45,15 +49,40 @@ from wtforms import (
   validators,
 )
 from . import name, version
+from .api import api, flag
+from .auth import hasher, HasherBusy
+from .catalog import catalog, get_rcon_commands
+from .client import RCONClient
+from .console import ConsoleBuffer, consoles
+from .events import event_log, parse_time
 from .config import (
+  config_file,
   edit_server,
   edit_user,
   get_servers,
+  get_user,
   get_users,
-  users_file,
-  servers_file,
+  storage,
+  store,
+)
+from .jobs import Job, jobs
+from .logs import log_viewer
+from .manager import (
+  populate_servers,
+  sampler,
+  server_action,
+  server_actions,
+  server_state,
+  servers,
+  supervisor,
+)
+from .metrics import gauge, histogram, registry
+from .rcon import (
+  get_mcr,
+  pool,
+  rcon_broadcast,
+  rcon_send,
 )
-from .rcon import get_mcr, get_rcon_commands, rcon_send
 from .script import (
   update_git,
   update_pipenv,
@@ -61,13 +90,8 @@ from .script import (
   update_restart,
   update_venv,
 )
-from .server import (
-  server_proper_stop,
-  server_restart,
-  server_status,
-  server_start as eco_server_start,
-  server_stop,
-)
+from .scheduler import delete_schedule, edit_schedule, scheduler
+from .server import server_start as eco_server_start
 from .system import (
   reboot_hard,
   reboot_soft,
@@ -78,53 +102,116 @@ logger: logging.Logger = logging.getLogger(__name__)
 app: Quart = Quart(__name__)
 app.secret_key: str = secrets.token_urlsafe(32)
 AuthManager(app)
+app.register_blueprint(api)
 
-def populate_servers(
-  servers: dict,
-  config: ConfigParser,
-  config_file: str,
-  *args,
-  **kwargs,
-) -> dict:
-  """Adds servers from config file's keys"""
-  try:
-    config.read(config_file)
-    for server in config.sections():
-      if server not in servers:
-        servers[server] = None
-  except Exception as e:
-    logger.exception(e)
-  return servers
-
-servers: dict[str, Popen | None] = {}
-try:
-  config: ConfigParser = ConfigParser()
-  servers = populate_servers(servers, config, servers_file)
-except Exception as e:
-  logger.exception(e)
+tasks: dict[str, asyncio.Task] = {}
 
 async def start_server(
-  process: Popen | None,
+  process: Process | None,
   _name: str,
   *args,
   **kwargs,
-) -> tuple[bool, Popen, str]:
+) -> tuple[bool, Process, str]:
   """Starts Eco Server"""
   return await eco_server_start(process, _name, *args, **kwargs)
 
+request_seconds = histogram("ecorcon_http_request_seconds",
+  "HTTP request time per route", ("endpoint", "method", "status"))
+render_seconds = histogram("ecorcon_template_render_seconds",
+  "Jinja template render time", ("template",))
+server_up = gauge("ecorcon_server_up",
+  "Whether the managed Eco server process is running", ("server",))
+server_cpu = gauge("ecorcon_server_cpu_percent",
+  "Last sampled CPU usage of Eco server process tree", ("server",))
+server_rss = gauge("ecorcon_server_rss_bytes",
+  "Last sampled resident memory of Eco server process tree", ("server",))
+server_threads = gauge("ecorcon_server_threads",
+  "Last sampled thread count of Eco server process tree", ("server",))
+render_started: ContextVar[float] = ContextVar("render_started",
+  default = 0.0)
+
+@registry.collector
+def collect_servers() -> None:
+  """Refresh Eco server gauges from the process table and sampler"""
+  for _name, process in servers.items():
+    server_up.set(int(process is not None and process.returncode is \
+      None), server = _name)
+  for _name, sample in sampler.latest().items():
+    if sample is not None:
+      server_cpu.set(sample["cpu_percent"], server = _name)
+      server_rss.set(sample["rss"], server = _name)
+      server_threads.set(sample["threads"], server = _name)
+
+@app.before_request
+async def request_started() -> None:
+  """Start request timer"""
+  g.request_started = time.perf_counter()
+
+@app.after_request
+async def request_finished(response):
+  """Observe request time"""
+  try:
+    request_seconds.observe(
+      time.perf_counter() - g.request_started,
+      endpoint = request.endpoint or "none",
+      method = request.method,
+      status = response.status_code,
+    )
+  except AttributeError:
+    pass
+  return response
+
+def render_start(sender, template, context, **kwargs) -> None:
+  """Start template render timer"""
+  render_started.set(time.perf_counter())
+
+def render_finish(sender, template, context, **kwargs) -> None:
+  """Observe template render time"""
+  started: float = render_started.get()
+  if started:
+    render_seconds.observe(time.perf_counter() - started,
+      template = template.name)
+
+before_render_template.connect(render_start, app)
+template_rendered.connect(render_finish, app)
+
+@app.template_filter("datetime")
+def format_datetime(timestamp: float | None) -> str:
+  """Local date and time of a timestamp"""
+  if timestamp is None:
+    return ""
+  return datetime.fromtimestamp(float(timestamp)).isoformat(" ",
+    "seconds")
+
 @app.before_serving
 async def startup() -> None:
   """Startup routine before serving Quart app"""
   global servers
-  global config
-  for _name in config.sections():
+  for _name, _server in (await get_servers()).items():
     try:
-      if bool(int(config[_name].get("boot"))):
-        _return: dict = await start_server(None, _name)
-        if _return["status"]:
-          servers[_name] = _return["process"]
+      if bool(int(_server.get("boot", 0))):
+        await server_action(_name, "start")
     except Exception as e:
       logger.exception(e)
+  tasks["rcon_reaper"] = asyncio.create_task(pool.reaper())
+  tasks["rcon_catalog"] = asyncio.create_task(catalog.run())
+  tasks["supervisor"] = asyncio.create_task(supervisor.run())
+  tasks["sampler"] = asyncio.create_task(sampler.run())
+  tasks["scheduler"] = asyncio.create_task(scheduler.run())
+  tasks["events"] = asyncio.create_task(event_log.run(supervisor))
+
+@app.after_serving
+async def shutdown() -> None:
+  """Shutdown routine after serving Quart app"""
+  for task in tasks.values():
+    task.cancel()
+  try:
+    await jobs.close()
+    await pool.close()
+    hasher.close()
+    event_log.close()
+  except Exception as e:
+    logger.exception(e)
 
 class LoginForm(FlaskForm):
   """Form for login"""
@@ -202,8 +289,142 @@ class ServerForm(FlaskForm):
     ],
   )
   confirm_field = PasswordField("RCON Password again")
+  host_field = StringField("RCON host", [validators.DataRequired()],
+    default = "127.0.0.1")
+  port_field = IntegerField("RCON port", [validators.DataRequired(),
+    validators.NumberRange(1, 65535)], default = 3002)
   submit = SubmitField("Update")
 
+## Form classes are built once, only dynamic choices are set per request
+server_action_map: dict[str, str] = {
+  "0": "status",
+  "1": "start",
+  "2": "stop",
+  "3": "restart",
+  "4": "kill",
+}
+system_function_map: dict = {
+  "0": ("Restart Windows Server", reboot_soft),
+  "1": ("Advanced - Force Windows Restart", reboot_hard),
+}
+script_function_map: dict = {
+  "0": ("Update Venv", update_venv),
+  "1": ("Update Pipenv", update_pipenv),
+  "3": ("Update version using git", update_git),
+  "4": (
+    "Reinstall this script (remember to update after)",
+    update_reinstall,
+  ),
+  "5": ("Restart this script (after update)", update_restart),
+}
+## (server names, choices), storage hands out new names only when
+## servers change
+server_choices: tuple[tuple[str, ...] | None, list[tuple]] = (None, [])
+
+def get_server_choices() -> list[tuple]:
+  """Server selection list, rebuilt only when servers change"""
+  global server_choices
+  names: tuple[str, ...] = storage.names("servers")
+  if server_choices[0] is not names:
+    server_choices = (names, [(str(index), server) for index, server \
+      in enumerate(names)])
+  return server_choices[1]
+
+class RCONForm(FlaskForm):
+  """Remote Console Form"""
+  command_field = RadioField(
+    "Select Command",
+    [validators.DataRequired()],
+    choices = [("0", "None")],
+  )
+  arguments_field = TextAreaField(
+    "Command Arguments (optional)",
+    default = "",
+  )
+  submit = SubmitField("Send")
+  async def validate_command_field(form, field) -> None:
+    """Populate command selection list"""
+    commands = await get_rcon_commands()
+    if commands[0]:
+      field.choices = commands[1]
+    else:
+      raise Exception(commands[1])
+
+class ServerActionForm(FlaskForm):
+  """Form for server and action selection"""
+  server_field: RadioField = RadioField(
+    "Select Eco Server",
+    [validators.DataRequired()],
+    choices = [("0", "None")],
+  )
+  action_field: RadioField = RadioField(
+    "Select Action",
+    [validators.DataRequired()],
+    choices = [(k, server_actions[v][0]) for k, v in \
+      sorted(server_action_map.items())],
+  )
+  submit: SubmitField = SubmitField("Send")
+  async def validate_server_field(form, field) -> None:
+    """Populate server selection list"""
+    try:
+      field.choices = get_server_choices()
+    except Exception as e:
+      logger.exception(e)
+
+class SystemForm(FlaskForm):
+  """Form for system management"""
+  command_field = RadioField(
+    "Select Command",
+    [validators.DataRequired()],
+    choices = [(k, v[0]) for k, v in sorted(system_function_map.items())],
+  )
+  submit = SubmitField("Send")
+
+class ScheduleForm(FlaskForm):
+  """Form for scheduled commands and server actions"""
+  name_field = StringField("Schedule name", [validators.DataRequired()],
+    default = "nightly-restart")
+  action_field: RadioField = RadioField(
+    "Action",
+    [validators.DataRequired()],
+    choices = [("rcon", "Send RCON command")] + [(k, v[0]) for k, v in \
+      server_actions.items() if v[1]],
+    default = "restart",
+  )
+  server_field = StringField("Server (empty for the [rcon] section)")
+  command_field = StringField("RCON command")
+  cron_field = StringField(
+    "Cron (minute hour day month weekday, like 0 4 * * *)")
+  interval_field = StringField("OR every this many seconds")
+  warnings_field = StringField("Announce this many seconds before",
+    default = "600, 300, 60, 10")
+  warning_field = StringField(
+    "Announcement ({action}, {remaining}, {name}, {seconds})")
+  catch_up_field: RadioField = RadioField(
+    "Missed runs after downtime",
+    [validators.DataRequired()],
+    choices = [("0", "Skip them"), ("1", "Run once")],
+    default = "0",
+  )
+  enabled_field: RadioField = RadioField(
+    "Enabled?",
+    [validators.DataRequired()],
+    choices = [("0", "Disabled"), ("1", "Enabled")],
+    default = "1",
+  )
+  submit = SubmitField("Save")
+  run = SubmitField("Run now")
+  delete = SubmitField("Delete")
+
+class ScriptForm(FlaskForm):
+  """Form for script management"""
+  command_field: RadioField = RadioField(
+    "Select Command",
+    [validators.DataRequired()],
+    choices = [(k, v[0]) for k, v in sorted(script_function_map.items())],
+  )
+  submit: SubmitField = SubmitField("Send")
+
 @app.route("/", defaults={"page": "index"})
 @app.route("/<page>")
 async def show(page):
@@ -232,25 +453,6 @@ async def rcon() -> str:
   """Send RCON Command"""
   response: str | None = None
   try:
-    class RCONForm(FlaskForm):
-      """Remote Console Form"""
-      command_field = RadioField(
-        "Select Command",
-        [validators.DataRequired()],
-        choices = [("0", "None")],
-      )
-      arguments_field = TextAreaField(
-        "Command Arguments (optional)",
-        default = "",
-      )
-      submit = SubmitField("Send")
-      async def validate_command_field(form, field) -> None:
-        """Populate command selection list"""
-        commands = await get_rcon_commands()
-        if commands[0]:
-          field.choices = commands[1]
-        else:
-          raise Exception(commands[1])
     form: FlaskForm = RCONForm(formdata = await request.form)
     await form.validate_command_field(form.command_field)
     if request.method == "POST":
@@ -278,11 +480,152 @@ async def rcon() -> str:
       title = "Remote Console",
       form = form,
       response = response,
+      catalog = [command.to_dict() for command in catalog.get()],
+    )
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
+@app.route("/rcon/commands", defaults = {"server_name": "default"})
+@app.route("/rcon/commands/<server_name>")
+# ~ @login_required
+async def rcon_commands_route(server_name: str) -> str:
+  """Command catalog as JSON, cached. With `refresh` waits for a fresh \
+copy from the server"""
+  _server_name: str | None = None if server_name == "default" else \
+    server_name
+  try:
+    commands: list = catalog.get(_server_name)
+    if request.args.get("refresh"):
+      commands = await catalog.refresh(_server_name)
+    return jsonify({"status": True, "exception": None,
+      "commands": [command.to_dict() for command in commands]})
+  except Exception as e:
+    logger.exception(e)
+    return jsonify({"status": False, "exception": repr(e),
+      "commands": []})
+
+@app.route("/rcon/batch", methods = ['POST'])
+# ~ @login_required
+async def rcon_batch() -> str:
+  """Send several RCON commands pipelined in one session. Accepts JSON \
+`{"commands": [...]}` or a `commands` form field with one command per \
+line"""
+  _return: dict[str, bool | list[str] | str | None] = {
+    "status": False,
+    "responses": [],
+    "exception": None,
+  }
+  try:
+    commands: list[str] = []
+    payload: dict | None = await request.get_json(silent = True)
+    if payload is not None:
+      commands = [str(command) for command in payload.get("commands",
+        [])]
+    else:
+      commands = (await request.form).get("commands", "").splitlines()
+    commands = [command.strip() for command in commands if \
+      command.strip()]
+    status, responses = await rcon_send(commands)
+    _return["status"] = status
+    if status:
+      _return["responses"] = responses
+    else:
+      _return["exception"] = responses
+  except Exception as e:
+    logger.exception(e)
+    _return["exception"] = repr(e)
+  return jsonify(_return)
+
+@app.route("/rcon/broadcast", methods = ['POST'])
+# ~ @login_required
+async def rcon_broadcast_route() -> str:
+  """Send one RCON command to every configured server, or to the \
+servers listed. Accepts JSON `{"command": "...", "servers": [...]}` or \
+`command` and `servers` form fields, servers separated by comma"""
+  _return: dict[str, bool | dict | str | None] = {
+    "status": False,
+    "results": {},
+    "exception": None,
+  }
+  try:
+    command: str = ""
+    server_names: list[str] | None = None
+    payload: dict | None = await request.get_json(silent = True)
+    if payload is not None:
+      command = str(payload.get("command", ""))
+      server_names = payload.get("servers")
+    else:
+      form: dict = await request.form
+      command = form.get("command", "")
+      if form.get("servers"):
+        server_names = [server.strip() for server in \
+          form["servers"].split(",") if server.strip()]
+    results: dict[str, tuple[bool, str | list[str]]] = \
+      await rcon_broadcast(command, server_names)
+    _return["results"] = {server_name: {"status": result[0],
+      "response": result[1]} for server_name, result in results.items()}
+    _return["status"] = all(result[0] for result in results.values())
+  except Exception as e:
+    logger.exception(e)
+    _return["exception"] = repr(e)
+  return jsonify(_return)
+
+@app.route("/rcon/console", defaults = {"server_name": "default"})
+@app.route("/rcon/console/<server_name>")
+# ~ @login_required
+async def rcon_console(server_name: str) -> str:
+  """Interactive remote console page"""
+  try:
+    return await render_template(
+      "rcon_console.html",
+      name = name,
+      version = version,
+      title = f"Remote Console - {server_name}",
+      server_name = server_name,
     )
   except Exception as e:
     logger.exception(e)
     return jsonify(repr(e))
 
+@app.websocket("/ws/rcon/<server_name>")
+# ~ @login_required
+async def rcon_websocket(server_name: str) -> None:
+  """Interactive remote console. One authenticated RCON session lives \
+as long as the websocket, every text message received is a command and \
+the response is streamed back as JSON messages with type `fragment`, \
+then `done` or `error`. Server name `default` uses the [rcon] section \
+of config.ini"""
+  mcr: RCONClient | None = await get_mcr(server_name = None if \
+    server_name == "default" else server_name)
+  if mcr is None:
+    await websocket.send_json({"type": "error",
+      "data": f"No RCON configuration for {server_name}"})
+    return
+  try:
+    try:
+      await mcr.connect()
+      await websocket.send_json({"type": "connected",
+        "data": repr(mcr)})
+    except Exception as e:
+      logger.exception(e)
+      await websocket.send_json({"type": "error", "data": repr(e)})
+    while True:
+      command: str = (await websocket.receive()).strip()
+      if not command:
+        continue
+      try:
+        async for fragment in mcr.stream(command):
+          await websocket.send_json({"type": "fragment",
+            "data": fragment})
+        await websocket.send_json({"type": "done", "data": command})
+      except Exception as e:
+        logger.exception(e)
+        ## Next command reconnects
+        await websocket.send_json({"type": "error", "data": repr(e)})
+  finally:
+    await mcr.disconnect()
+
 @app.route("/server", methods = ['GET', 'POST'])
 # ~ @login_required
 async def server() -> str:
@@ -293,52 +636,16 @@ async def server() -> str:
   exception: Exception | None = None
   form: FlaskForm | None = None
   alive: dict[str, bool] = {}
+  states: dict[str, str] = {}
   try:
-    config: ConfigParser = ConfigParser()
-    config.read(servers_file)
-    function_map: dict = {
-      "0": ("Eco Server Status", server_status),
-      "1": ("Start Eco Server", eco_server_start),
-      "2": ("Stop Eco Server", server_proper_stop),
-      "3": ("Restart Eco Server", server_restart),
-      "4": ("Advanced - Force Eco Server Stop", server_stop),
-    }
-    class ServerForm(FlaskForm):
-      """Form for server and action selection"""
-      server_field: RadioField = RadioField(
-        "Select Eco Server",
-        [validators.DataRequired()],
-        choices = [("0", "None")],
-      )
-      action_field: RadioField = RadioField(
-        "Select Action",
-        [validators.DataRequired()],
-        choices = [("0", "None")],
-      )
-      submit: SubmitField = SubmitField("Send")
-      async def validate_server_field(form, field) -> None:
-        """Populate server selection list"""
-        try:
-          field.choices = [(index, server) for index, server in \
-            enumerate(config.sections())]
-        except Exception as e3:
-          logger.exception(e3)
-          exception = e3
-      async def validate_action_field(form, field) -> None:
-        """Populate action selection list"""
-        field.choices = [(k, v[0]) for k, v in \
-          sorted(function_map.items())]
-    form = ServerForm(formdata = await request.form)
+    form = ServerActionForm(formdata = await request.form)
     await form.validate_server_field(form.server_field)
-    await form.validate_action_field(form.action_field)
     if request.method == "POST":
       try:
-        _name: str = config.sections()[int(
+        _name: str = storage.names("servers")[int(
           form["server_field"].data)]
-        process: Popen = servers[_name]
-        _return: dict = await function_map[
-          form["action_field"].data][1](process, _name)
-        servers[_name] = _return["process"]
+        _return: dict = await server_action(_name,
+          server_action_map[form["action_field"].data])
         message = _return["message"]
         exception = _return["exception"]
         status = _return["status"]
@@ -346,9 +653,10 @@ async def server() -> str:
         logger.exception(e2)
         exception = e2
     for _name, process in servers.items():
+      states[_name] = server_state(_name)
       alive[_name] = False
       try:
-        alive[_name] = (process.poll() is None)
+        alive[_name] = (process.returncode is None)
       except (ValueError, AttributeError):
         pass
       except Exception as e1:
@@ -366,11 +674,190 @@ async def server() -> str:
       message = message,
       exception = exception,
       alive = alive,
+      states = states,
+      metrics = sampler.latest(),
+      history = supervisor.history,
+    )
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
+@app.route("/console/<server_name>")
+# ~ @login_required
+async def console(server_name: str) -> str:
+  """Live console of an Eco server"""
+  try:
+    return await render_template(
+      "console.html",
+      name = name,
+      version = version,
+      title = f"{server_name} console",
+      server_name = server_name,
     )
   except Exception as e:
     logger.exception(e)
     return jsonify(repr(e))
 
+@app.route("/console/<server_name>/lines")
+# ~ @login_required
+async def console_lines(server_name: str) -> str:
+  """Last `lines` lines of an Eco server output as JSON"""
+  if server_name not in servers:
+    abort(404)
+  try:
+    count: int = request.args.get("lines", 100, type = int)
+    buffer: ConsoleBuffer | None = consoles.get(server_name)
+    return jsonify({
+      "server": server_name,
+      "sequence": buffer.sequence if buffer is not None else 0,
+      "lines": buffer.tail(count) if buffer is not None else [],
+    })
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
+@app.websocket("/ws/console/<server_name>")
+# ~ @login_required
+async def console_websocket(server_name: str) -> None:
+  """Stream Eco server output. Each message carries every line \
+available at that moment, a client slower than the server output skips \
+lines instead of growing a queue in memory"""
+  if server_name not in servers:
+    abort(404)
+  ## Not started since EcoSM started, wait for the first start
+  while (buffer := consoles.get(server_name)) is None:
+    await asyncio.sleep(1.0)
+  backlog: int = websocket.args.get("lines", 100, type = int)
+  sequence: int = max(0, buffer.sequence - backlog)
+  while True:
+    await buffer.wait(sequence)
+    lines, sequence, dropped = buffer.since(sequence)
+    if dropped:
+      lines.insert(0, f"### {dropped} lines skipped")
+    if lines:
+      await websocket.send("\n".join(lines))
+
+@app.route("/events/<server_name>")
+# ~ @login_required
+async def events(server_name: str) -> str:
+  """Player, chat and error events of an Eco server. Filters by `kind` \
+and `player`, and lists who was online `at` a given time"""
+  exception: Exception | None = None
+  _events: list[dict] = []
+  online: list[dict] | None = None
+  try:
+    _events = await event_log.recent(
+      server = server_name,
+      kind = request.args.get("kind") or None,
+      player = request.args.get("player") or None,
+      before = parse_time(request.args.get("before")),
+      limit = request.args.get("limit", 100, type = int),
+    )
+    at: float | None = parse_time(request.args.get("at"))
+    if at is not None:
+      online = await event_log.online(server_name, at)
+  except Exception as e:
+    logger.exception(e)
+    exception = e
+  try:
+    return await render_template(
+      "events.html",
+      name = name,
+      version = version,
+      title = f"{server_name} events",
+      server_name = server_name,
+      kinds = [kind for kind, _ in event_log.parser.patterns],
+      events = _events,
+      online = online,
+      exception = exception,
+    )
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
+@app.route("/logs/<server_name>")
+# ~ @login_required
+async def logs(server_name: str) -> str:
+  """Log files of an Eco server"""
+  exception: Exception | None = None
+  files: list[dict] = []
+  try:
+    files = await asyncio.to_thread(log_viewer.files, server_name)
+  except Exception as e:
+    logger.exception(e)
+    exception = e
+  try:
+    return await render_template(
+      "logs.html",
+      name = name,
+      version = version,
+      title = f"{server_name} logs",
+      server_name = server_name,
+      files = files,
+      exception = exception,
+    )
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
+@app.route("/logs/<server_name>/<path:file_name>")
+# ~ @login_required
+async def log_file(server_name: str, file_name: str) -> str:
+  """Page through a log file from the end, or search it with `q`"""
+  exception: Exception | None = None
+  page: dict | None = None
+  results: dict | None = None
+  count: int = request.args.get("count", 200, type = int)
+  regex: bool = flag(request.args.get("regex"))
+  ignore_case: bool = flag(request.args.get("ignore_case"))
+  try:
+    if request.args.get("q"):
+      results = await log_viewer.search(server_name, file_name,
+        request.args["q"],
+        regex = regex,
+        start = request.args.get("start", 0, type = int),
+        limit = count,
+        ignore_case = ignore_case,
+      )
+    else:
+      page = await log_viewer.read(server_name, file_name,
+        request.args.get("start", None, type = int), count)
+  except KeyError:
+    abort(404)
+  except Exception as e:
+    logger.exception(e)
+    exception = e
+  try:
+    return await render_template(
+      "log.html",
+      name = name,
+      version = version,
+      title = f"{server_name}: {file_name}",
+      server_name = server_name,
+      file_name = file_name,
+      count = count,
+      regex = regex,
+      ignore_case = ignore_case,
+      page = page,
+      results = results,
+      exception = exception,
+    )
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
+@app.route("/server/metrics")
+# ~ @login_required
+async def server_metrics() -> str:
+  """Sampled metrics history of host and Eco servers as JSON, only the \
+`last` samples if given"""
+  try:
+    return jsonify(sampler.to_dict(request.args.get("last", None,
+      type = int)))
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
 @app.route("/system", methods = ['GET', 'POST'])
 # ~ @login_required
 async def system() -> str:
@@ -378,26 +865,15 @@ async def system() -> str:
   status: bool = False
   message: str | None = None
   exception: Exception | None = None
+  job: Job | None = None
   try:
-    function_map: dict = {
-      "0": ("Restart Windows Server", reboot_soft),
-      "1": ("Advanced - Force Windows Restart", reboot_hard),
-    }
-    class SystemForm(FlaskForm):
-      """Form for system management"""
-      command_field = RadioField(
-        "Select Command",
-        [validators.DataRequired()],
-        choices = [(k, v[0]) for k, v in sorted(function_map.items())],
-      )
-      submit = SubmitField("Send")
     form: FlaskForm = SystemForm(formdata = await request.form)
     if request.method == "POST":
       try:
-        _return = await function_map[
-          form["command_field"].data][1]()
-        message = _return[1]
-        status = _return[0]
+        label, function = system_function_map[form["command_field"].data]
+        job = jobs.submit(label, function, stream = True)
+        message = f"{label}: job {job.id} queued"
+        status = True
       except Exception as e2:
         logger.exception(e2)
         exception = e2
@@ -413,6 +889,7 @@ async def system() -> str:
       form = form,
       message = message,
       exception = exception,
+      job = job,
     )
   except Exception as e:
     logger.exception(e)
@@ -425,38 +902,19 @@ async def script() -> str:
   status: bool = False
   message: str | None = None
   exception: Exception | None = None
+  job: Job | None = None
   try:
-    function_map: dict = {
-      "0": ("Update Venv", update_venv),
-      "1": ("Update Pipenv", update_pipenv),
-      "3": ("Update version using git", update_git),
-      "4": (
-        "Reinstall this script (remember to update after)",
-        update_reinstall,
-      ),
-      "5": ("Restart this script (after update)", update_restart),
-    }
-    class ScriptForm(FlaskForm):
-      """Form for script management"""
-      command_field: RadioField = RadioField(
-        "Select Command",
-        [validators.DataRequired()],
-        choices = [("0", "None")],
-      )
-      submit: SubmitField = SubmitField("Send")
-      async def validate_command_field(form, field) -> None:
-        """Populate command selection list"""
-        field.choices = [(k, v[0]) for k, v in \
-          sorted(function_map.items())]
     form: FlaskForm = ScriptForm(formdata = await request.form)
-    await form.validate_command_field(form.command_field)
     if request.method == "POST":
       try:
-        _return: dict = await function_map[
-          form["command_field"].data][1]()
-        message = _return["message"]
-        exception = _return["exception"]
-        status = _return["status"]
+        label, function = script_function_map[form["command_field"].data]
+        if function is update_restart:
+          ## Exits right away, there is no job to wait for
+          await function()
+        else:
+          job = jobs.submit(label, function, stream = True)
+          message = f"{label}: job {job.id} queued"
+          status = True
       except Exception as e1:
         logger.exception(e1)
         exception = e1
@@ -472,6 +930,115 @@ async def script() -> str:
       form = form,
       message = message,
       exception = exception,
+      job = job,
+    )
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
+@app.route("/jobs")
+# ~ @login_required
+async def jobs_page() -> str:
+  """Background jobs"""
+  try:
+    return await render_template(
+      "jobs.html",
+      name = name,
+      version = version,
+      title = "Background Jobs",
+      jobs = jobs.to_list(),
+    )
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
+@app.websocket("/ws/jobs/<job_id>")
+# ~ @login_required
+async def job_websocket(job_id: str) -> None:
+  """Stream job output as JSON messages with type `lines`, then one \
+`done` message with the final job status"""
+  job: Job | None = jobs.get(job_id)
+  if job is None:
+    await websocket.send_json({"type": "error",
+      "data": f"Unknown job {job_id}"})
+    return
+  async for lines, dropped in job.follow():
+    await websocket.send_json({"type": "lines", "data": lines,
+      "dropped": dropped})
+  status: dict = job.to_dict()
+  del status["output"]
+  await websocket.send_json({"type": "done", "data": status})
+
+@app.route("/jobs/<job_id>")
+# ~ @login_required
+async def job_page(job_id: str) -> str:
+  """One background job, updated live"""
+  job: Job | None = jobs.get(job_id)
+  if job is None:
+    abort(404)
+  try:
+    return await render_template(
+      "job.html",
+      name = name,
+      version = version,
+      title = f"Job {job.id}: {job.name}",
+      job = job.to_dict(),
+    )
+  except Exception as e:
+    logger.exception(e)
+    return jsonify(repr(e))
+
+@app.route("/schedules", methods = ['GET', 'POST'])
+# ~ @login_required
+async def schedules() -> str:
+  """Scheduled RCON commands and server actions"""
+  status: bool = False
+  message: str | None = None
+  exception: Exception | None = None
+  form: FlaskForm | None = None
+  try:
+    form = ScheduleForm(formdata = await request.form)
+    if request.method == "POST":
+      try:
+        _name: str = form["name_field"].data
+        if form["delete"].data:
+          _return: dict = await delete_schedule(_name)
+        elif form["run"].data:
+          job: Job = scheduler.run_now(_name)
+          _return = {"status": True, "exception": None, "message": \
+            f"Schedule {_name} started as job {job.id}"}
+        else:
+          _return = await edit_schedule(_name, {
+            "action": form["action_field"].data,
+            "server": form["server_field"].data,
+            "command": form["command_field"].data,
+            "cron": form["cron_field"].data,
+            "interval": form["interval_field"].data,
+            "warnings": form["warnings_field"].data,
+            "warning": form["warning_field"].data,
+            "catch_up": form["catch_up_field"].data,
+            "enabled": form["enabled_field"].data,
+          })
+        message = _return["message"]
+        exception = _return["exception"]
+        status = _return["status"]
+      except Exception as e2:
+        logger.exception(e2)
+        exception = e2
+  except Exception as e1:
+    logger.exception(e1)
+    exception = e1
+  try:
+    return await render_template(
+      "schedules.html",
+      name = name,
+      version = version,
+      title = "Schedules",
+      form = form,
+      message = message,
+      exception = exception,
+      schedules = scheduler.to_list(),
+      history = list(scheduler.history),
     )
   except Exception as e:
     logger.exception(e)
@@ -487,12 +1054,11 @@ async def login(*e: Exception) -> str:
     form: FlaskForm = LoginForm(formdata = await request.form)
     if request.method == "POST":
       try:
-        hasher: PasswordHasher = PasswordHasher()
-        config: ConfigParser = ConfigParser()
-        config.read(users_file)
-        user: dict = config[form["username_field"].data]
+        user: dict | None = await get_user(form["username_field"].data)
+        if user is None:
+          raise KeyError(form["username_field"].data)
         try:
-          hasher.verify(
+          await hasher.verify(
             user.get("password"),
             form['password_field'].data,
           )
@@ -507,6 +1073,9 @@ login still didn't work. Go figure."
         except VerifyMismatchError as e5:
           logger.exception(e5)
           response: str = "y u no give the proper password"
+        except HasherBusy as e6:
+          logger.warning(repr(e6))
+          response = str(e6)
       except KeyError as e4:
         logger.exception(e4)
         response = f"""we haz no such user as \
@@ -541,11 +1110,10 @@ async def register() -> str:
     form: FlaskForm = RegisterForm(formdata = await request.form)
     if request.method == "POST":
       try:
-        hasher: PasswordHasher = PasswordHasher()
         try:
           _return = await edit_user(
             form["username_field"].data,
-            hasher.hash(form["password_field"].data),
+            await hasher.hash(form["password_field"].data),
             form["level_field"].data,
             form["active_field"].data,
           )
@@ -584,7 +1152,6 @@ async def register() -> str:
 async def config_server() -> str:
   """Route for server configuration"""
   global servers
-  global config
   _servers: dict[str, dict[str, str]] = await get_servers()
   status: bool = False
   message: str | None = None
@@ -593,14 +1160,18 @@ async def config_server() -> str:
     form: FlaskForm = ServerForm(formdata = await request.form)
     if request.method == "POST":
       try:
-        hasher: PasswordHasher = PasswordHasher()
+        ## The RCON password is sent to the Eco server as is, so it
+        ## can't be hashed like user passwords
         _return = await edit_server(
           form["name_field"].data,
           form["path_field"].data,
-          hasher.hash(form["password_field"].data),
+          form["password_field"].data,
           form["boot_field"].data,
+          host = form["host_field"].data,
+          port = form["port_field"].data,
         )
-        servers = populate_servers(servers, config, servers_file)
+        servers = populate_servers(servers)
+        supervisor.notify()
         message = _return["message"]
         exception = _return["exception"]
         status = _return["status"]
@@ -625,6 +1196,12 @@ async def config_server() -> str:
     logger.exception(e)
     return jsonify(repr(e))
 
+@app.route("/metrics")
+async def metrics() -> tuple[str, int, dict[str, str]]:
+  """Prometheus text exposition"""
+  return (registry.render(), 200,
+    {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
 @app.route("/logout")
 async def logout() -> str:
   """Logout route"""